@@ -1,44 +1,339 @@
-from flask import Flask, render_template, request, Response, json, jsonify
-from json import JSONEncoder
-
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-import folium
-from folium.plugins import MousePosition
-from pykalman import KalmanFilter
-import numpy as np
-from datetime import date, datetime
-
-from scripts.utils import filter_person_and_date, create_geodataframe
-from scripts.KalmanFilter import kalman_filter
-from scripts.Segment import Segment
-from scripts.MapMatch import MapMatch
+import json
+import os
+import threading
+
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+
+# Heavy modules (pandas, geopandas, pykalman, requests) are only imported by the
+# scripts package, which is imported on first use in each route to keep startup fast
 
 app = Flask(__name__)
 
-# Load the gps walking data
-all_plt_data = pd.read_csv('static/data/all_plt_data.csv')
-# Again, load in demo data if you don't have access to all_plt_data
-# all_plt_data = pd.read_csv('static/data/demo_all_plt_data.csv')
+# Path to the gps walking data. Again, point this at 'static/data/demo_all_plt_data.csv'
+# if you don't have access to all_plt_data
+DATA_PATH = os.environ.get('WALKWISE_DATA', 'static/data/all_plt_data.csv')
+# When running several workers, build the memory-mapped dataset once with
+# `python -m scripts.SharedData static/data/all_plt_data.csv static/data/shared`
+# and point this at it, so all workers share the same read-only pages
+SHARED_DIR = os.environ.get('WALKWISE_SHARED_DIR')
+# Results precomputed with `python -m scripts.Materialize` are served from here when
+# the requested parameters match, instead of running the pipeline
+MATERIALIZED_DIR = os.environ.get('WALKWISE_MATERIALIZED_DIR')
+# Trajectory index built with `python -m scripts.Similarity build`, enables /similar
+SIMILARITY_INDEX = os.environ.get('WALKWISE_SIMILARITY_INDEX')
+# Density pyramid built with `python -m scripts.Heatmap build`, enables /heatmap
+HEATMAP_PYRAMID = os.environ.get('WALKWISE_HEATMAP')
+# Edge usage table built with `python -m scripts.EdgeUsage update`, enables /edge_usage
+EDGE_USAGE_DIR = os.environ.get('WALKWISE_EDGE_USAGE')
+# Catalog of person-days built with `python -m scripts.Catalog build` (or by Ingest and
+# SharedData), which the person and date dropdowns are served from without loading the
+# dataset. Defaults to the catalog.npz of the shared dataset, if it has one
+CATALOG_PATH = os.environ.get('WALKWISE_CATALOG')
+# Size of the process pool running the person-days of multi-day /preprocess requests
+PIPELINE_WORKERS = int(os.environ.get('WALKWISE_PIPELINE_WORKERS', os.cpu_count() or 1))
+
+_all_plt_data = None
+_data_version = None
+_data_lock = threading.Lock()
+_loader_thread = None
+_loader_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_similarity_index = None
+_similarity_lock = threading.Lock()
+_heatmap_pyramid = None
+_heatmap_lock = threading.Lock()
+_catalog = None
+_catalog_version = None
+_catalog_lock = threading.Lock()
+
+
+def get_all_plt_data():
+    """
+    Load the gps walking data on first use, either as a DataFrame or as
+    SharedTraces attached to the shared memory-mapped columns
+    """
+    global _all_plt_data
+    if _all_plt_data is None:
+        with _data_lock:
+            if _all_plt_data is None:
+                if SHARED_DIR:
+                    from scripts.SharedData import SharedTraces
+                    _all_plt_data = SharedTraces(SHARED_DIR)
+                else:
+                    from scripts.utils import load_all_plt_data
+                    _all_plt_data = load_all_plt_data(DATA_PATH)
+    return _all_plt_data
+
+
+def data_version():
+    """
+    Version of the dataset being served, part of every ETag: it changes whenever the
+    CSV or shared dataset is rebuilt, without having to load it
+    """
+    global _data_version
+    if _data_version is None:
+        from scripts.Materialize import data_version as path_version
+        _data_version = path_version(SHARED_DIR or DATA_PATH)
+    return _data_version
+
+
+def catalog_version():
+    """
+    Version of the catalog being served, part of the /dates ETag: the size and modification
+    time of its file, which ingests rewrite, or None if there is no catalog
+    """
+    from scripts.Catalog import FILENAME
+
+    if CATALOG_PATH:
+        path = os.path.join(CATALOG_PATH, FILENAME) if os.path.isdir(CATALOG_PATH) else CATALOG_PATH
+    elif SHARED_DIR:
+        path = os.path.join(SHARED_DIR, FILENAME)
+    else:
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def get_catalog():
+    """Load the catalog of person-days on first use and whenever its file changes, or None if there is none"""
+    global _catalog, _catalog_version
+    version = catalog_version()
+    with _catalog_lock:
+        if _catalog is None or version != _catalog_version:
+            from scripts.Catalog import Catalog
+            if CATALOG_PATH:
+                _catalog = Catalog.load(CATALOG_PATH)
+            elif version is not None:
+                _catalog = Catalog.find(SHARED_DIR) or False
+            else:
+                _catalog = False
+            _catalog_version = version
+    return _catalog or None
+
+
+def list_persons():
+    catalog = get_catalog()
+    if catalog:
+        return catalog.persons()
+    all_plt_data = get_all_plt_data()
+    if SHARED_DIR:
+        return all_plt_data.persons()
+    return sorted(all_plt_data['person'].unique().tolist())
+
+
+def list_dates(person):
+    catalog = get_catalog()
+    if catalog:
+        return catalog.dates(person)
+    all_plt_data = get_all_plt_data()
+    if SHARED_DIR:
+        return all_plt_data.dates(person)
+    import pandas as pd
+    dates = all_plt_data[all_plt_data['person'] == person]['date'].unique()
+    return [pd.to_datetime(date).strftime('%Y-%m-%d') for date in sorted(pd.to_datetime(dates))]
+
+
+def load_person_day(person, date):
+    """Get the rows of all_plt_data for a single person and date"""
+    all_plt_data = get_all_plt_data()
+    if SHARED_DIR:
+        return all_plt_data.person_day(person, date, legacy=False)
+    from scripts.utils import filter_person_and_date
+    return filter_person_and_date(all_plt_data, person, date)
+
+
+def load_materialized(key, person, date, encoding=None):
+    """
+    Get a precomputed response body (precompressed with encoding if given), or None if it
+    wasn't materialized from the data being served, so it's computed again
+    """
+    if not MATERIALIZED_DIR:
+        return None
+    from scripts.Materialize import MaterializedStore
+    return MaterializedStore(MATERIALIZED_DIR).load(key, person, date, encoding, data_version())
+
+
+def cached(body, tag, route, mimetype='application/json', materialized=None):
+    """
+    Respond with an ETag and the route's Cache-Control policy (see scripts.HttpCache):
+    304 if the browser already has this response, otherwise the compressed body
+    @param:
+        - body: response body, or a function computing it (only called when needed)
+        - materialized: optional (key, person, date) of precompressed bodies to send as they are
+    """
+    from scripts.HttpCache import CACHE_CONTROL, cached_response
+
+    load_encoded = None
+    if materialized:
+        def load_encoded(encoding):
+            return load_materialized(*materialized, encoding=encoding)
+    # Browsers only revalidate GET requests
+    if_none_match = request.headers.get('If-None-Match') if request.method in ('GET', 'HEAD') else None
+    status, headers, data = cached_response(body, tag, CACHE_CONTROL[route], if_none_match,
+                                            request.headers.get('Accept-Encoding'), load_encoded)
+    return app.response_class(data, status=status, headers=headers, mimetype=mimetype)
+
+
+def get_similarity_index():
+    """Load the trajectory similarity index on first use"""
+    global _similarity_index
+    with _similarity_lock:
+        if _similarity_index is None:
+            from scripts.Similarity import TrajectoryIndex
+            _similarity_index = TrajectoryIndex.load(SIMILARITY_INDEX)
+    return _similarity_index
+
+
+def get_heatmap_pyramid():
+    """Load the heatmap pyramid on first use"""
+    global _heatmap_pyramid
+    with _heatmap_lock:
+        if _heatmap_pyramid is None:
+            from scripts.Heatmap import HeatmapPyramid
+            _heatmap_pyramid = HeatmapPyramid.load(HEATMAP_PYRAMID)
+    return _heatmap_pyramid
+
+
+def get_executor():
+    """Start the process pool for multi-day /preprocess requests on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _executor = ProcessPoolExecutor(max_workers=PIPELINE_WORKERS)
+    return _executor
+
+
+def warm_up():
+    """Start loading the gps walking data in a background thread, if not already started"""
+    global _loader_thread
+    with _loader_lock:
+        if _loader_thread is None and _all_plt_data is None:
+            _loader_thread = threading.Thread(target=get_all_plt_data, daemon=True)
+            _loader_thread.start()
+
+
+@app.route('/ready')
+def ready():
+    """Readiness probe: 200 once the dataset is loaded, 503 (and start loading) otherwise"""
+    if _all_plt_data is None:
+        warm_up()
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'rows': len(_all_plt_data)})
+
 
 @app.route('/')
 def index():
     """Only info needed to render index is all unique people for dropdown"""
-    all_unique_people = all_plt_data['person'].unique().tolist()
-    all_unique_people.sort()
-    return render_template('index.html', persons=all_unique_people)
+    from scripts.HttpCache import etag
+
+    body = render_template('index.html', persons=list_persons())
+    return cached(body, etag(body), 'index', mimetype='text/html')
 
 
 @app.route('/dates/<int:person>')
 def get_dates(person):
-    """Get unique dates for a specific person"""
-    dates = all_plt_data[all_plt_data['person'] == person]['date'].unique()
-    dates = [pd.to_datetime(date).strftime('%Y-%m-%d') for date in sorted(pd.to_datetime(dates))]
-    return jsonify(dates)
+    """
+    Get unique dates for a specific person. With 'details', each date comes with its
+    catalog row (size, duration, distance, bounding box...), if there is a catalog
+    """
+    from scripts.HttpCache import etag
+
+    details = request.args.get('details') in ('1', 'true')
+
+    def body():
+        if not details:
+            return json.dumps(list_dates(person))
+        catalog = get_catalog()
+        if catalog:
+            return json.dumps(catalog.rows(person))
+        return json.dumps([{'date': date} for date in list_dates(person)])
+
+    return cached(body, etag(data_version(), catalog_version(), person, details), 'dates')
+
+
+@app.route('/similar/<int:person>/<date>')
+def similar(person, date):
+    """
+    The trajectories most similar to each segment of a person-day (see scripts.Similarity),
+    optionally only to one 'segment', with the top 'k' (default 10) per segment
+    """
+    from scripts.HttpCache import etag
+
+    if not SIMILARITY_INDEX:
+        return jsonify({'error': 'No similarity index, set WALKWISE_SIMILARITY_INDEX'}), 404
+    segment = request.args.get('segment', type=int)
+    k = request.args.get('k', default=10, type=int)
+    stat = os.stat(SIMILARITY_INDEX)
+
+    def body():
+        results = get_similarity_index().query(person, date, segment, k)
+        return results.to_json(orient='records')
+
+    return cached(body, etag(stat.st_size, stat.st_mtime_ns, person, date, segment, k), 'similar')
 
 
-@app.route('/init_map', methods=['POST'])
+@app.route('/heatmap')
+def heatmap():
+    """
+    Point density of the whole corpus in the current viewport (see scripts.Heatmap), for
+    the map's 'zoom' level and 'bbox' (min_long,min_lat,max_long,max_lat), optionally of
+    one time 'bucket' only
+    """
+    from scripts.HttpCache import etag
+
+    if not HEATMAP_PYRAMID:
+        return jsonify({'error': 'No heatmap pyramid, set WALKWISE_HEATMAP'}), 404
+    zoom = request.args.get('zoom', default=12, type=int)
+    bucket = request.args.get('bucket', type=int)
+    bbox = request.args.get('bbox')
+    try:
+        bbox = [float(value) for value in bbox.split(',')] if bbox else None
+    except ValueError:
+        bbox = None
+    if bbox is not None and len(bbox) != 4:
+        return jsonify({'error': 'bbox must be min_long,min_lat,max_long,max_lat'}), 400
+    stat = os.stat(HEATMAP_PYRAMID)
+
+    def body():
+        pyramid = get_heatmap_pyramid()
+        return json.dumps({**pyramid.heat_data(zoom, bbox, bucket), 'time_bucket': pyramid.options['time_bucket']})
+
+    return cached(body, etag(stat.st_size, stat.st_mtime_ns, zoom, bbox, bucket), 'heatmap')
+
+
+@app.route('/edge_usage')
+def edge_usage():
+    """
+    GeoJSON layer of the road edges walked at least 'min_traversals' times (default 1), with
+    their usage (see scripts.EdgeUsage), optionally only within 'bbox' (min_long,min_lat,max_long,max_lat)
+    """
+    from scripts.HttpCache import etag
+
+    if not EDGE_USAGE_DIR or not os.path.exists(os.path.join(EDGE_USAGE_DIR, 'usage.npz')):
+        return jsonify({'error': 'No edge usage table, set WALKWISE_EDGE_USAGE'}), 404
+    min_traversals = request.args.get('min_traversals', default=1, type=int)
+    bbox = request.args.get('bbox')
+    try:
+        bbox = [float(value) for value in bbox.split(',')] if bbox else None
+    except ValueError:
+        bbox = None
+    if bbox is not None and len(bbox) != 4:
+        return jsonify({'error': 'bbox must be min_long,min_lat,max_long,max_lat'}), 400
+    stat = os.stat(os.path.join(EDGE_USAGE_DIR, 'usage.npz'))
+
+    def body():
+        from scripts.EdgeUsage import EdgeUsage
+        return json.dumps(EdgeUsage(EDGE_USAGE_DIR).to_geojson(min_traversals, bbox))
+
+    return cached(body, etag(stat.st_size, stat.st_mtime_ns, min_traversals, bbox), 'edge_usage')
+
+
+@app.route('/init_map', methods=['GET', 'POST'])
 def init_map():
     """
     Process and return GeoJSON data for the selected person and date.
@@ -50,11 +345,25 @@ def init_map():
     
     @return: The processed data as a GeoJSON object
     """
-    person = int(request.form.get('person'))
-    date = request.form.get('date')
+    from scripts.HttpCache import etag
+
+    person = int(request.values.get('person'))
+    date = request.values.get('date')
+    tag = etag(data_version(), 'init_map', person, date)
+
+    def body():
+        materialized = load_materialized('init_map', person, date)
+        return materialized if materialized is not None else original_geojson(person, date)
+
+    return cached(body, tag, 'init_map', materialized=('init_map', person, date))
+
+
+def original_geojson(person, date):
+    """The /init_map response body: the original layer's GeoJSON, as a JSON string"""
+    from scripts.utils import create_geodataframe
 
     # Filter data for the selected person and date
-    person_data = filter_person_and_date(all_plt_data, person, date)
+    person_data = load_person_day(person, date)
     # kalman_data = kalman_filter(person_data)
     
     # Convert pandas dataframes to GeoDataFrames
@@ -76,78 +385,197 @@ def init_map():
     # Convert GeoDataFrame to GeoJSON
     # geojson = combined_gdf.to_json()
     geojson = gdf_original.to_json()
-    return jsonify(geojson)
+    return json.dumps(geojson)
 
 
-@app.route('/preprocess', methods=['POST'])
-def preprocess():
-    print('Preprocessing...')
-    person = int(request.form.get('person'))
-    date = request.form.get('date')
-    to_kalman_filter = request.form.get('kalmanFilter') == "true"
-    map_match = request.form.get('mapMatch') == "true"
-    n_iter = request.form.get('n_iter')
-    time_segment = request.form.get('timeSegment')
-    search_radius = request.form.get('searchRadius')
-    gps_accuracy = request.form.get('gpsAccuracy')
-    breakage_distance = request.form.get('breakageDistance')
-    interpolation_distance = request.form.get('interpolationDistance')
-
-    print(f"Person: {person}, Date: {date}, Kalman: {to_kalman_filter}, MapMatch: {map_match}, TimeSegment: {time_segment}, SearchRadius: {search_radius}")
-
-    original_df = filter_person_and_date(all_plt_data, person, date)
-    original_gdf = create_geodataframe(original_df, 'lat', 'long')
-    original_gdf['type'] = 'original'
-
-    full_geojson = json.loads(original_gdf.to_json())
-    df_to_match = original_df
-    colnames_to_match = ['lat', 'long', 'cst_datetime']
-
-    if to_kalman_filter:
-        if n_iter == "" or n_iter is None:
-            n_iter = 5
-        n_iter = int(n_iter)
-        if time_segment != "":
-            segment_df = Segment.segment_df(original_df, time_cutoff=int(time_segment))
-            kalman_df = Segment.kalman_filter_segments(segment_df, n_iter)
-           
-        else:
-            kalman_df = kalman_filter(original_df, n_iter)
-
-        kalman_gdf = create_geodataframe(kalman_df, 'kalman_lat', 'kalman_long')
-        kalman_gdf['type'] = 'kalman'
-
-        print(f"Kalman and segment{time_segment}")
-        
-        # Append ksegment_gdf to full_geojson
-        kalman_geojson = json.loads(kalman_gdf.to_json())
-        full_geojson['features'].extend(kalman_geojson['features'])
-        
-        df_to_match = kalman_df
-        colnames_to_match = ['kalman_lat', 'kalman_long', 'cst_datetime']
-
-    if map_match:
-
-        match_options = {
+def preprocess_params(values):
+    """
+    Read the preprocessing form (POST form or GET query string) of a single person-day into pipeline parameters
+    @return:
+        - person, date, params
+    """
+    person = int(values.get('person'))
+    date = values.get('date')
+    params = pipeline_params(values)
+    print(f"Person: {person}, Date: {date}, Kalman: {params['kalman_filter']}, MapMatch: {params['map_match']}, "
+          f"TimeSegment: {params['time_segment']}, SearchRadius: {params['match_options']['search_radius']}")
+    return person, date, params
+
+
+def request_person_days(values):
+    """
+    Read the person-days of a preprocessing form: 'person' may be a comma-separated list of
+    persons, and 'startDate' / 'endDate' a date range instead of a single 'date'
+    @return:
+        - person_days: list of (person, 'YYYY-MM-DD') tuples, only those with data
+          if several persons or a date range were requested
+    """
+    persons = [int(person) for person in str(values.get('person')).split(',') if person.strip()]
+    start_date = values.get('startDate') or values.get('date')
+    end_date = values.get('endDate') or values.get('date')
+    if len(persons) == 1 and start_date == end_date:
+        return [(persons[0], start_date)]
+    if not start_date or not end_date:
+        raise ValueError('A date range needs both a start and an end date')
+    from scripts.utils import person_days_in_range
+    return person_days_in_range(get_all_plt_data(), persons, start_date, end_date)
+
+
+def preprocess_etag(key, person_days):
+    """ETag of a /preprocess response, see scripts.HttpCache"""
+    from scripts.HttpCache import etag
+    return etag(data_version(), key, *person_days)
+
+
+def labelled_materialized(key, person, date):
+    """A materialized /preprocess response as a GeoJSON dict with 'person' and 'date' on every feature, or None"""
+    body = load_materialized(key, person, date)
+    if body is None:
+        return None
+    geojson = json.loads(body)
+    for feature in geojson['features']:
+        feature['properties'].update(person=person, date=date)
+    return geojson
+
+
+def combined_response(geojsons, errors):
+    """
+    The /preprocess response of several person-days: one FeatureCollection of all their
+    layers, with the person-days which failed listed under 'errors'
+    """
+    from scripts.Pipeline import Pipeline
+
+    combined = Pipeline.combine_geojson(geojsons)
+    combined['errors'] = [{'person': person, 'date': date, 'error': error}
+                          for (person, date), error in errors.items()]
+    return json.dumps(combined)
+
+
+def pipeline_params(values):
+    """Read the pipeline parameters of a preprocessing form"""
+    to_kalman_filter = values.get('kalmanFilter') == "true"
+    map_match = values.get('mapMatch') == "true"
+    matcher = values.get('matcher') or 'meili'
+    n_iter = values.get('n_iter')
+    time_segment = values.get('timeSegment')
+    segment_mode = values.get('segmentMode') or 'time'
+    search_radius = values.get('searchRadius')
+    gps_accuracy = values.get('gpsAccuracy')
+    breakage_distance = values.get('breakageDistance')
+    interpolation_distance = values.get('interpolationDistance')
+    kinematics = values.get('kinematics') == "true"
+    to_prefilter = values.get('prefilter') == "true"
+    to_compress = values.get('compress') == "true"
+    compress_options = {
+        'resample_s': values.get('resampleInterval'),
+        'stay_radius': values.get('stayRadius'),
+        'stay_min_duration': values.get('stayMinDuration'),
+    }
+    prefilter_limits = {
+        'max_speed': values.get('maxSpeed'),
+        'max_acceleration': values.get('maxAcceleration'),
+        'max_median_distance': values.get('maxMedianDistance'),
+    }
+
+    if n_iter == "" or n_iter is None:
+        n_iter = 5
+    params = {
+        'prefilter': to_prefilter,
+        # Empty form fields fall back to the default limits
+        'prefilter_limits': {name: float(value) for name, value in prefilter_limits.items() if value},
+        'compress': to_compress,
+        'compress_options': {name: float(value) for name, value in compress_options.items() if value},
+        'kalman_filter': to_kalman_filter,
+        'n_iter': int(n_iter),
+        'time_segment': int(time_segment) if time_segment else None,
+        'segment_mode': segment_mode,
+        'map_match': map_match,
+        'matcher': matcher,
+        'match_options': {
             'search_radius': search_radius,
             'gps_accuracy': gps_accuracy,
             'breakage_distance': breakage_distance,
             'interpolation_distance': interpolation_distance
-        }
-        meili_json = MapMatch.meili_match(df_to_match, colnames_to_match, match_options)
-        trace_df = MapMatch.make_tracedf(meili_json, original_df)
-        # print colnames of trace_df
-        print(trace_df.columns)
-        matched_gdf = create_geodataframe(trace_df, 'matched_lat', 'matched_long')
-        matched_gdf['type'] = 'matched'
-
-        print(f"Map Matched with options: {match_options}")
-
-        # Append matched_gdf to full_geojson
-        matched_geojson = json.loads(matched_gdf.to_json())
-        full_geojson['features'].extend(matched_geojson['features'])
-    
-    return jsonify(full_geojson)
+        },
+        'kinematics': kinematics,
+    }
+    return params
+
+
+@app.route('/preprocess', methods=['GET', 'POST'])
+def preprocess():
+    """
+    Run the pipeline on a person-day, or on several at once (see request_person_days), in
+    which case every feature also has 'person' and 'date' properties
+    """
+    from scripts.Materialize import params_key
+    from scripts.Pipeline import Pipeline
+
+    print('Preprocessing...')
+    person_days = request_person_days(request.values)
+    pipeline = Pipeline(pipeline_params(request.values))
+    key = params_key(pipeline.params)
+    tag = preprocess_etag(key, person_days)
+
+    if len(person_days) == 1 and not request.values.get('startDate'):
+        person, date = person_days[0]
+
+        def body():
+            materialized = load_materialized(key, person, date)
+            if materialized is not None:
+                return materialized
+            original_df = load_person_day(person, date)
+            layers = pipeline.run(original_df)
+            return json.dumps(Pipeline.to_geojson(layers))
+
+        return cached(body, tag, 'preprocess', materialized=(key, person, date))
+
+    def combined_body():
+        geojsons = {person_day: labelled_materialized(key, *person_day) for person_day in person_days}
+        to_run = {person_day: load_person_day(*person_day) for person_day, geojson in geojsons.items() if geojson is None}
+        print(f"Preprocessing {len(person_days)} person-days ({len(to_run)} not materialized)")
+        results, errors = pipeline.run_many(to_run, get_executor(), geojson=True)
+        geojsons.update(results)
+        return combined_response([geojsons[person_day] for person_day in person_days if geojsons[person_day]], errors)
+
+    return cached(combined_body, tag, 'preprocess')
+
+
+@app.route('/preprocess_stream')
+def preprocess_stream():
+    """
+    Server-sent events version of /preprocess (same parameters, in the query string).
+    Each layer is sent as a 'layer' event as soon as it is computed, with the matched
+    layer in several chunks, followed by a 'done' event (after a 'pipeline_error' event if a step failed).
+    """
+    from scripts.Pipeline import Pipeline
+
+    print('Preprocessing (streamed)...')
+    person, date, params = preprocess_params(request.args)
+    pipeline = Pipeline(params)
+
+    def events():
+        body = None
+        if MATERIALIZED_DIR:
+            from scripts.Materialize import params_key
+            body = load_materialized(params_key(pipeline.params), person, date)
+        if body is not None:
+            # All layers are already computed, so send them at once
+            yield f"event: layer\ndata: {body.decode()}\n\n"
+            yield "event: done\ndata: {}\n\n"
+            return
+        try:
+            original_df = load_person_day(person, date)
+            for layer_type, layer_df in pipeline.run_stream(original_df):
+                layer_geojson = Pipeline.layer_geojson(layer_df, layer_type)
+                yield f"event: layer\ndata: {json.dumps(layer_geojson)}\n\n"
+        except Exception as e:
+            yield f"event: pipeline_error\ndata: {json.dumps(str(e))}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    # Disable proxy buffering, so each event reaches the browser as soon as it's sent
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=headers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+import app as walkwise
+
+# ASGI serving mode, for many concurrent users in a single server process:
+#     uvicorn asgi:app --host 0.0.0.0 --port 5000
+# /preprocess and /preprocess_stream are served natively (see scripts.AsyncPipeline), with
+# Meili requests awaited and CPU-bound steps in a process pool of this many workers.
+# Every other route is passed on to the Flask app.
+CPU_WORKERS = int(os.environ.get('WALKWISE_CPU_WORKERS', os.cpu_count() or 1))
+MEILI_TIMEOUT = 120  # s
+
+
+class AsyncApp:
+    def __init__(self, flask_app):
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.executor = None
+        self.client = None
+
+    def startup(self):
+        import httpx
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=CPU_WORKERS)
+            self.client = httpx.AsyncClient(timeout=MEILI_TIMEOUT)
+            walkwise.warm_up()
+
+    async def shutdown(self):
+        if self.executor is not None:
+            await self.client.aclose()
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http':
+            route = (scope['method'], scope['path'])
+            if route in (('POST', '/preprocess'), ('GET', '/preprocess')):
+                return await self.preprocess(scope, receive, send)
+            if route == ('GET', '/preprocess_stream'):
+                return await self.preprocess_stream(scope, send)
+        # Run each request of the Flask app in its own thread, instead of one shared thread
+        async with ThreadSensitiveContext():
+            return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def respond(send, status, body: bytes, content_type='application/json', headers=None):
+        headers = [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type.encode()),
+                                (b'content-length', str(len(body)).encode()), *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    def header(scope, name: bytes):
+        """Value of a request header, or None"""
+        for key, value in scope['headers']:
+            if key == name:
+                return value.decode('latin-1')
+        return None
+
+    @staticmethod
+    def form_values(query: bytes) -> dict:
+        """Parse a urlencoded form or query string into {name: value}"""
+        return {name: values[0] for name, values in parse_qs(query.decode(), keep_blank_values=True).items()}
+
+    async def materialized(self, params, person, date):
+        """The materialized response for these parameters (see scripts.Materialize), if any"""
+        if not walkwise.MATERIALIZED_DIR:
+            return None
+        from scripts.Pipeline import Pipeline
+        from scripts.Materialize import params_key
+        key = params_key(Pipeline(params).params)
+        return await asyncio.to_thread(walkwise.load_materialized, key, person, date)
+
+    async def preprocess(self, scope, receive, send):
+        from scripts.AsyncPipeline import AsyncPipeline
+        from scripts.HttpCache import CACHE_CONTROL, cached_response
+        from scripts.Materialize import params_key
+        from scripts.Pipeline import Pipeline
+
+        self.startup()
+        body = scope['query_string']
+        if scope['method'] == 'POST':
+            body = b''
+            while True:
+                message = await receive()
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    break
+
+        print('Preprocessing (async)...')
+        values = self.form_values(body)
+        try:
+            person_days = await asyncio.to_thread(walkwise.request_person_days, values)
+            params = walkwise.pipeline_params(values)
+        except (TypeError, ValueError) as e:
+            return await self.respond(send, 400, json.dumps({'error': str(e)}).encode())
+
+        key = params_key(Pipeline(params).params)
+        tag = walkwise.preprocess_etag(key, person_days)
+        # Browsers only revalidate GET requests, see app.cached
+        if_none_match = self.header(scope, b'if-none-match') if scope['method'] == 'GET' else None
+        accept_encoding = self.header(scope, b'accept-encoding')
+        status, headers, response = cached_response(b'', tag, CACHE_CONTROL['preprocess'], if_none_match)
+        if status == 304:
+            return await self.respond(send, status, response, headers=headers)
+
+        pipeline = AsyncPipeline(params, self.executor, self.client)
+        load_encoded = None
+        try:
+            if len(person_days) == 1 and not values.get('startDate'):
+                person, date = person_days[0]
+                response = await self.materialized(params, person, date)
+                if response is None:
+                    person_df = await asyncio.to_thread(walkwise.load_person_day, person, date)
+                    response = (await pipeline.run_geojson(person_df)).encode()
+                load_encoded = partial(walkwise.load_materialized, key, person, date)
+            else:
+                response = (await self.preprocess_many(pipeline, key, person_days)).encode()
+        except Exception as e:
+            print(f"Person-days {person_days}: {e}")
+            return await self.respond(send, 500, json.dumps({'error': str(e)}).encode())
+        # Send the precompressed body if it was materialized, otherwise compress it in a
+        # thread, since compressing a large body is CPU-bound
+        status, headers, response = await asyncio.to_thread(cached_response, response, tag, CACHE_CONTROL['preprocess'],
+                                                            None, accept_encoding, load_encoded)
+        await self.respond(send, status, response, headers=headers)
+
+    async def preprocess_many(self, pipeline, key, person_days):
+        """The combined /preprocess response of several person-days, see app.preprocess"""
+        geojsons = {}
+        for person, date in person_days:
+            geojsons[(person, date)] = await asyncio.to_thread(walkwise.labelled_materialized, key, person, date)
+        to_run = {}
+        for (person, date), geojson in geojsons.items():
+            if geojson is None:
+                to_run[(person, date)] = await asyncio.to_thread(walkwise.load_person_day, person, date)
+        print(f"Preprocessing {len(person_days)} person-days ({len(to_run)} not materialized)")
+        results, errors = await pipeline.run_many_geojson(to_run)
+        geojsons.update(results)
+        return await asyncio.to_thread(walkwise.combined_response,
+                                       [geojsons[person_day] for person_day in person_days if geojsons[person_day]],
+                                       errors)
+
+    async def preprocess_stream(self, scope, send):
+        from scripts.AsyncPipeline import AsyncPipeline
+
+        self.startup()
+        print('Preprocessing (async, streamed)...')
+        try:
+            person, date, params = walkwise.preprocess_params(self.form_values(scope['query_string']))
+        except (TypeError, ValueError) as e:
+            return await self.respond(send, 400, json.dumps({'error': str(e)}).encode())
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+
+        async def event(name, data):
+            await send({'type': 'http.response.body', 'body': f"event: {name}\ndata: {data}\n\n".encode(),
+                        'more_body': True})
+
+        try:
+            response = await self.materialized(params, person, date)
+            if response is not None:
+                await event('layer', response.decode())
+            else:
+                person_df = await asyncio.to_thread(walkwise.load_person_day, person, date)
+                pipeline = AsyncPipeline(params, self.executor, self.client)
+                async for layer_type, layer_geojson in pipeline.stream_geojson(person_df):
+                    await event('layer', layer_geojson)
+        except Exception as e:
+            await event('pipeline_error', json.dumps(str(e)))
+        await event('done', '{}')
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+app = AsyncApp(walkwise.app)
@@ -0,0 +1,137 @@
+import asyncio
+import json
+
+import pandas as pd
+from .Pipeline import Pipeline
+from .MapMatch import MapMatch
+from .Matcher import get_matcher
+
+
+# Process pool tasks: module level functions, so they can be pickled by reference
+
+def prepare_task(params, person_df):
+    """Prefilter, compress and Kalman filter a person-day (see Pipeline.prepare)"""
+    return Pipeline(params).prepare(person_df)
+
+
+def points_task(params, person_df):
+    """Prefilter and compress a person-day (see Pipeline.prepare_points)"""
+    return Pipeline(params).prepare_points(person_df)
+
+
+def kalman_task(params, stages):
+    """Kalman filter the output of points_task (see Pipeline.prepare_kalman)"""
+    return Pipeline(params).prepare_kalman(stages)
+
+
+def finish_task(params, stages, properties=None, encode=True):
+    """Expand, add kinematics and encode all layers as a GeoJSON string, or dict if not encode (see Pipeline.finish)"""
+    geojson = Pipeline.to_geojson(Pipeline(params).finish(stages), **(properties or {}))
+    return json.dumps(geojson) if encode else geojson
+
+
+def layer_task(params, layer_type, layer_df, compressed_df=None, uncompressed_df=None):
+    """Expand, add kinematics to and encode a single layer (or chunk) as a GeoJSON string (see Pipeline.finish_layer)"""
+    layer_df = Pipeline.finish_layer(params, layer_type, layer_df, compressed_df, uncompressed_df)
+    return json.dumps(Pipeline.layer_geojson(layer_df, layer_type))
+
+
+class AsyncPipeline:
+    """
+    AsyncPipeline runs the same steps as Pipeline.run, for use inside an event loop: the
+    CPU-bound steps before and after map matching (Kalman filtering, segmentation and GeoJSON
+    encoding) run in a process pool, and Meili requests are awaited, so a single server
+    process can serve many person-days at once.
+    """
+    def __init__(self, params, executor, client):
+        """
+        @param:
+            - params: pipeline parameters (see Pipeline.DEFAULT_PARAMS)
+            - executor: a bounded concurrent.futures.ProcessPoolExecutor
+            - client: an httpx.AsyncClient for Meili requests
+        """
+        self.params = Pipeline(params).params
+        self.executor = executor
+        self.client = client
+
+    async def run_geojson(self, person_df: pd.DataFrame, properties: dict = None, encode: bool = True):
+        """
+        Run every enabled step on a single person-day, and return all layers as a GeoJSON string
+        @param:
+            - properties: other properties of every feature (see Pipeline.layer_geojson)
+            - encode: return the GeoJSON dict instead of a string
+        """
+        params = self.params
+        loop = asyncio.get_running_loop()
+        stages = await loop.run_in_executor(self.executor, prepare_task, params, person_df)
+
+        if params['map_match']:
+            stages['layers']['matched'] = await self.match(stages['df_to_match'], stages['colnames_to_match'])
+
+        return await loop.run_in_executor(self.executor, finish_task, params, stages, properties, encode)
+
+    async def run_many_geojson(self, person_days: dict):
+        """
+        Async version of Pipeline.run_many(geojson=True): every person-day runs concurrently
+        @param:
+            - person_days: dict of {(person, date): person_df}
+        @return:
+            - results: dict of {(person, date): GeoJSON dict} of the person-days which succeeded
+            - errors: dict of {(person, date): error message} of the person-days which failed
+        """
+        outputs = await asyncio.gather(*[self.run_geojson(person_df, {'person': person, 'date': date}, encode=False)
+                                         for (person, date), person_df in person_days.items()],
+                                       return_exceptions=True)
+        results, errors = {}, {}
+        for (person, date), output in zip(person_days, outputs):
+            if isinstance(output, Exception):
+                print(f"Person {person}, {date}: {output}")
+                errors[(person, date)] = str(output)
+            else:
+                results[(person, date)] = output
+        return results, errors
+
+    async def match(self, df_to_match: pd.DataFrame, colnames_to_match: list) -> pd.DataFrame:
+        """Map match df_to_match, awaiting Meili requests (see Pipeline.match_step)"""
+        params = self.params
+        if params['matcher'] == 'meili':
+            trace_df = await MapMatch.match_async(self.client, df_to_match, colnames_to_match,
+                                                  params['match_options'])
+        else:
+            # Other matchers manage their own connections, so run them in a thread
+            trace_df = await asyncio.to_thread(get_matcher(params['matcher']).match, df_to_match,
+                                               colnames_to_match, params['match_options'])
+        return Pipeline.annotate_trace(trace_df, df_to_match, colnames_to_match)
+
+    async def stream_geojson(self, person_df: pd.DataFrame, chunk_size: int = 500):
+        """
+        Async version of Pipeline.run_stream, yielding (layer name, GeoJSON string) pairs.
+        The steps before map matching run in the process pool, like run_geojson: the original
+        layer is sent as soon as the points are prefiltered and compressed, while the Kalman
+        filter runs, then the Kalman layer is sent while the matched layer is matched chunk by
+        chunk, and every layer is finished and encoded in the process pool too.
+        """
+        params = self.params
+        loop = asyncio.get_running_loop()
+        stages = await loop.run_in_executor(self.executor, points_task, params, person_df)
+        kalman = loop.run_in_executor(self.executor, kalman_task, params, stages)
+
+        yield 'original', await loop.run_in_executor(self.executor, layer_task, params, 'original',
+                                                     stages['layers']['original'])
+        stages = await kalman
+        compressed_df, uncompressed_df = stages['compressed_df'], stages['uncompressed_df']
+        if 'kalman' in stages['layers']:
+            yield 'kalman', await loop.run_in_executor(
+                self.executor, layer_task, params, 'kalman', stages['layers']['kalman'],
+                *Pipeline.expansion_rows(params, compressed_df, uncompressed_df))
+
+        if params['map_match']:
+            df_to_match, colnames_to_match = stages['df_to_match'], stages['colnames_to_match']
+            bounds = Pipeline.chunk_bounds(df_to_match, chunk_size,
+                                           params['time_segment'] or Pipeline.DEFAULT_PARAMS['time_segment'])
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                trace_df = await self.match(df_to_match.iloc[start:stop], colnames_to_match)
+                trace_df['trace_index'] += start
+                yield 'matched', await loop.run_in_executor(
+                    self.executor, layer_task, params, 'matched', trace_df,
+                    *Pipeline.expansion_rows(params, compressed_df, uncompressed_df, start, stop))
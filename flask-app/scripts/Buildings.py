@@ -0,0 +1,231 @@
+import argparse
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+from .Features import local_xy, segment_starts
+
+DEFAULT_OPTIONS = {
+    'radius': 50.0,  # m, buildings within this distance of a fix count towards its surroundings
+    'cell_size': 10.0,  # m, fixes are queried once per grid cell of this size
+    'window': 5,  # fixes, centered rolling average of the building height and density
+    # Observation noise standard deviation is multiplied by
+    # 1 + height_weight * building_height + density_weight * building_density
+    'height_weight': 0.05,  # per m
+    'density_weight': 1.0,
+}
+LEVEL_HEIGHT = 3.0  # m per 'building:levels', for buildings without a 'height' tag
+DEFAULT_HEIGHT = 9.0  # m, for buildings with neither tag
+QUERY_CHUNK = 200_000  # grid cells per tree query, to bound the memory used by (cell, building) pairs
+
+
+def _tag_number(values):
+    """First number in OSM tag values like '12', '12 m' or '3;4', NaN if there is none"""
+    return pd.Series(values, dtype='object').astype(str).str.extract(r'(\d+(?:\.\d+)?)')[0].astype(np.float64)
+
+
+class BuildingIndex:
+    """
+    BuildingIndex is a spatial index of building footprints (an STRtree over the polygons,
+    projected to meters), answering within-radius queries for many GPS fixes at once.
+
+    Fixes are snapped to a grid of cell_size cells first, and each occupied cell is queried
+    once, so stays and repeated visits cost a single lookup.
+    """
+    def __init__(self, polygons, heights, lat0):
+        """
+        @param:
+            - polygons: np.ndarray of shapely Polygons in local meters (see Features.local_xy)
+            - heights: np.ndarray of building heights in meters
+            - lat0: latitude of the projection
+        """
+        import shapely
+
+        self.polygons = polygons
+        self.heights = np.asarray(heights, dtype=np.float64)
+        self.areas = shapely.area(polygons)
+        self.lat0 = lat0
+        self.tree = shapely.STRtree(polygons)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    @staticmethod
+    def from_footprints(footprints):
+        """
+        Build the index from building footprints, e.g. an OSM extract
+        @param:
+            - footprints: gpd.GeoDataFrame of (Multi)Polygons in WGS84, with optional 'height'
+              and 'building:levels' columns (OSM tags)
+        """
+        import shapely
+
+        footprints = footprints.to_crs(4326).explode(index_parts=False)
+        footprints = footprints[footprints.geom_type == 'Polygon']
+        heights = np.full(len(footprints), np.nan)
+        if 'height' in footprints.columns:
+            heights = _tag_number(footprints['height']).to_numpy()
+        if 'building:levels' in footprints.columns:
+            levels = _tag_number(footprints['building:levels']).to_numpy()
+            heights = np.where(np.isnan(heights), levels * LEVEL_HEIGHT, heights)
+        heights = np.where(np.isnan(heights), DEFAULT_HEIGHT, heights)
+
+        polygons = footprints.geometry.to_numpy()
+        lat0 = float(np.mean(footprints.total_bounds[[1, 3]])) if len(footprints) else 0.0
+
+        def project(coords):
+            x, y = local_xy(coords[:, 1], coords[:, 0], lat0)
+            return np.column_stack([x, y])
+
+        return BuildingIndex(shapely.transform(polygons, project), heights, lat0)
+
+    @staticmethod
+    def read_osm(path):
+        """
+        Build the index from a file of OSM building footprints that geopandas can read (e.g. a
+        GeoJSON or GeoPackage exported with `osmium tags-filter ... building` and ogr2ogr)
+        """
+        import geopandas as gpd
+
+        footprints = gpd.read_file(path)
+        if 'building' in footprints.columns:
+            footprints = footprints[footprints['building'].notna() & (footprints['building'] != 'no')]
+        return BuildingIndex.from_footprints(footprints)
+
+    def save(self, path):
+        """Save the projected footprints and heights as flat arrays (see load)"""
+        import shapely
+
+        geometry_type, coords, offsets = shapely.to_ragged_array(self.polygons)
+        np.savez(path, coords=coords, ring_offsets=offsets[0], polygon_offsets=offsets[1],
+                 heights=self.heights, lat0=self.lat0)
+
+    @staticmethod
+    def load(path):
+        import shapely
+
+        with np.load(path) as saved:
+            polygons = shapely.from_ragged_array(shapely.GeometryType.POLYGON, saved['coords'],
+                                                 (saved['ring_offsets'], saved['polygon_offsets']))
+            return BuildingIndex(polygons, saved['heights'], float(saved['lat0']))
+
+    def query(self, lat, long, radius=50.0, cell_size=10.0):
+        """
+        Describe the buildings around many fixes in one call
+        @param:
+            - lat, long: arrays of coordinates
+            - radius: m, buildings within this distance of a fix are counted
+            - cell_size: m, fixes in the same grid cell share a single lookup
+        @return:
+            - height: np.ndarray of the footprint area weighted mean height (m) of the buildings
+              within radius of each fix, 0 where there are none
+            - density: np.ndarray of the fraction of the disk of radius around each fix
+              covered by footprints (their total area, capped at 1)
+        """
+        import shapely
+
+        x, y = local_xy(lat, long, self.lat0)
+        cells = np.column_stack([np.floor(x / cell_size), np.floor(y / cell_size)]).astype(np.int64)
+        cells, cell_of_fix = np.unique(cells, axis=0, return_inverse=True)
+        cell_of_fix = cell_of_fix.reshape(-1)
+
+        area_sum = np.zeros(len(cells))
+        height_area_sum = np.zeros(len(cells))
+        for start in range(0, len(cells), QUERY_CHUNK):
+            centers = (cells[start:start + QUERY_CHUNK] + 0.5) * cell_size
+            cell_idx, building_idx = self.tree.query(shapely.points(centers), predicate='dwithin', distance=radius)
+            areas = self.areas[building_idx]
+            area_sum[start:start + len(centers)] = np.bincount(cell_idx, weights=areas, minlength=len(centers))
+            height_area_sum[start:start + len(centers)] = np.bincount(
+                cell_idx, weights=areas * self.heights[building_idx], minlength=len(centers))
+
+        height = np.divide(height_area_sum, area_sum, out=np.zeros(len(cells)), where=area_sum > 0)
+        density = np.minimum(area_sum / (np.pi * radius ** 2), 1.0)
+        return height[cell_of_fix], density[cell_of_fix]
+
+
+@functools.lru_cache(maxsize=4)
+def load_building_index(path) -> BuildingIndex:
+    """Load a saved BuildingIndex once per process"""
+    return BuildingIndex.load(path)
+
+
+def rolling_mean(values, starts, window):
+    """
+    Centered rolling mean of window values, which never crosses the segment starts
+    @param:
+        - starts: bool array, True on the first value of each segment (see Features.segment_starts)
+    """
+    n = len(values)
+    if n == 0 or window <= 1:
+        return np.asarray(values, dtype=np.float64)
+    positions = np.arange(n)
+    segment_first = np.maximum.accumulate(np.where(starts, positions, 0))
+    segment_last = np.minimum.accumulate(np.where(np.append(starts[1:], True), positions, n)[::-1])[::-1]
+    lo = np.maximum(positions - window // 2, segment_first)
+    hi = np.minimum(positions + (window - 1) // 2, segment_last)
+    cumsum = np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+    return (cumsum[hi + 1] - cumsum[lo]) / (hi - lo + 1)
+
+
+def annotate(gps_df: pd.DataFrame, index: BuildingIndex, lat_col: str = 'lat', long_col: str = 'long',
+             segment_col: str = 'segment', **options) -> pd.DataFrame:
+    """
+    Annotate every fix with the buildings around it, as a rolling average along each segment,
+    and the observation noise scale they imply (see KalmanFilter.kalman_filter)
+    @param:
+        - gps_df: time-ordered pd.DataFrame with coordinate columns
+        - index: BuildingIndex
+        - options: overrides for DEFAULT_OPTIONS
+    @return:
+        - gps_df with 'building_height' (m), 'building_density' and 'obs_noise_scale' columns
+    """
+    options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+    height, density = index.query(gps_df[lat_col].to_numpy(), gps_df[long_col].to_numpy(),
+                                  options['radius'], options['cell_size'])
+    starts = segment_starts(gps_df, segment_col)
+    gps_df = gps_df.copy()
+    gps_df['building_height'] = rolling_mean(height, starts, int(options['window']))
+    gps_df['building_density'] = rolling_mean(density, starts, int(options['window']))
+    # Scale of the observation noise variance: urban canyons reflect and block the
+    # satellite signals, so fixes among tall and dense buildings are trusted less
+    noise_std = (1 + options['height_weight'] * gps_df['building_height']
+                 + options['density_weight'] * gps_df['building_density'])
+    gps_df['obs_noise_scale'] = noise_std ** 2
+    return gps_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a building footprint index, or annotate GPS data with it')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Build the index from an OSM building footprint extract')
+    build_parser.add_argument('footprints', help='GeoJSON / GeoPackage / Shapefile of building footprints')
+    build_parser.add_argument('index', help='Output .npz file')
+    annotate_parser = subparsers.add_parser('annotate', help='Annotate every fix of a dataset with its surroundings')
+    annotate_parser.add_argument('index', help='.npz file written by build')
+    annotate_parser.add_argument('data', help='all_plt_data.csv')
+    annotate_parser.add_argument('out', help='Output CSV with person, cst_epoch and the building columns')
+    annotate_parser.add_argument('--radius', type=float, default=DEFAULT_OPTIONS['radius'])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        index = BuildingIndex.read_osm(args.footprints)
+        index.save(args.index)
+        print(f"Indexed {len(index)} building footprints in {time.perf_counter() - start:.1f}s")
+        return
+
+    from .utils import load_all_plt_data
+
+    index = BuildingIndex.load(args.index)
+    data = load_all_plt_data(args.data).sort_values(['person', 'cst_epoch'], kind='stable')
+    # Every person's trace is one segment for the rolling average
+    annotated = annotate(data.assign(segment=data['person']), index, radius=args.radius)
+    annotated[['person', 'cst_epoch', 'building_height', 'building_density', 'obs_noise_scale']].to_csv(
+        args.out, index=False)
+    print(f"Annotated {len(annotated)} fixes in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+# Points further apart in time than this start a new segment, like the pipeline's default 60s time segment
+DEFAULT_OPTIONS = {
+    'time_gap': 60,
+}
+FILENAME = 'catalog.npz'
+
+
+class Catalog:
+    """
+    Catalog holds one row per person-day of a dataset: its size, extent and shape, so the
+    app's dropdowns and the batch scripts never have to scan the traces to find out what
+    there is and how large it is. It's built once at ingest and stored as one compact
+    array per column (see save), about 50 bytes per person-day.
+    """
+    COLUMNS = {
+        'person': np.int16,
+        'day': np.int32,  # days since the unix epoch (UTC, like the 'date' column)
+        'n_points': np.int32,
+        'start': np.int64,  # 'cst_epoch' of the first and last points
+        'stop': np.int64,
+        'distance_m': np.float32,  # summed within segments, so gaps don't count as walked
+        'min_lat': np.float32,
+        'min_long': np.float32,
+        'max_lat': np.float32,
+        'max_long': np.float32,
+        'n_segments': np.int16,
+        'valid_walking': np.bool_,
+        'version': np.int32,  # data version at which the person-day was last changed
+    }
+
+    def __init__(self, columns=None, version=0, options=None):
+        """
+        @param:
+            - columns: dict of {column: np.ndarray} sorted by person then day, empty if not given
+            - version: data version of the traces the catalog was built from
+            - options: overrides for DEFAULT_OPTIONS used to build it
+        """
+        columns = columns or {}
+        self.columns = {col: np.asarray(columns.get(col, np.empty(0, dtype)), dtype=dtype)
+                        for col, dtype in self.COLUMNS.items()}
+        self.version = version
+        self.options = {**DEFAULT_OPTIONS, **(options or {})}
+
+    def __len__(self):
+        return len(self.columns['person'])
+
+    @staticmethod
+    def day_rows(person, epoch, lat, long, time_gap=DEFAULT_OPTIONS['time_gap']):
+        """
+        Catalog rows of every person-day in a set of traces
+        @param:
+            - person, epoch, lat, long: arrays sorted by person then 'cst_epoch'
+            - time_gap: seconds between points which start a new segment
+        @return:
+            - dict of column arrays, without 'valid_walking' and 'version'
+        """
+        from .Features import haversine
+
+        person = np.asarray(person)
+        epoch = np.asarray(epoch, dtype=np.int64)
+        lat = np.asarray(lat, dtype=np.float64)
+        long = np.asarray(long, dtype=np.float64)
+        n = len(epoch)
+        if n == 0:
+            return {col: np.empty(0, dtype) for col, dtype in Catalog.COLUMNS.items()
+                    if col not in ('valid_walking', 'version')}
+
+        day = epoch // 86400
+        new_day = np.concatenate([[True], (person[1:] != person[:-1]) | (day[1:] != day[:-1])])
+        starts = np.flatnonzero(new_day)
+        stops = np.concatenate([starts[1:], [n]])
+        new_segment = new_day.copy()
+        new_segment[1:] |= np.diff(epoch) > time_gap
+        step_m = np.concatenate([[0.0], haversine(lat[:-1], long[:-1], lat[1:], long[1:])])
+        step_m[new_segment] = 0
+        return {
+            'person': person[starts],
+            'day': day[starts],
+            'n_points': stops - starts,
+            'start': epoch[starts],
+            'stop': epoch[stops - 1],
+            'distance_m': np.add.reduceat(step_m, starts),
+            'min_lat': np.minimum.reduceat(lat, starts),
+            'min_long': np.minimum.reduceat(long, starts),
+            'max_lat': np.maximum.reduceat(lat, starts),
+            'max_long': np.maximum.reduceat(long, starts),
+            'n_segments': np.add.reduceat(new_segment.astype(np.int64), starts),
+        }
+
+    @staticmethod
+    def build(data, valid_person_days=None, version=None, **options):
+        """
+        Catalog every person-day of a dataset
+        @param:
+            - data: TraceStore (read one person at a time), SharedTraces, or all_plt_data df
+            - valid_person_days: optional list of (person, 'YYYY-MM-DD') tuples of valid walking
+              days (see Materialize.read_valid_walking_dates), every person-day is valid if not given
+            - version: data version to record (defaults to that of a TraceStore or SharedTraces)
+            - options: overrides for DEFAULT_OPTIONS
+        """
+        catalog = Catalog(options=options)
+        if hasattr(data, 'read_days'):
+            # TraceStore
+            catalog.update_persons(data, data.persons(), valid_person_days)
+            return catalog
+
+        if hasattr(data, 'person_day'):
+            # SharedTraces, already sorted by person and time
+            columns = data.columns
+            version = data.version if version is None else version
+        else:
+            from .utils import timestamps_s
+
+            frame = data
+            if 'cst_epoch' not in frame.columns:
+                frame = frame.assign(cst_epoch=timestamps_s(frame, 'cst_datetime'))
+            frame = frame.sort_values(['person', 'cst_epoch'], kind='stable')
+            columns = {col: frame[col].to_numpy() for col in ('person', 'cst_epoch', 'lat', 'long')}
+        catalog.version = version or 0
+        rows = Catalog.day_rows(columns['person'], columns['cst_epoch'], columns['lat'], columns['long'],
+                                catalog.options['time_gap'])
+        catalog.columns = catalog._typed({**rows, 'version': np.full(len(rows['day']), catalog.version)},
+                                         valid_person_days)
+        return catalog
+
+    def _typed(self, rows, valid_person_days=None):
+        """Typed columns of rows, flagged as valid walking days if in valid_person_days (or if not given)"""
+        if 'valid_walking' not in rows:
+            if valid_person_days is None:
+                valid = np.ones(len(rows['person']), dtype=bool)
+            else:
+                valid_keys = {(int(person), str(date)) for person, date in valid_person_days}
+                dates = np.datetime_as_string(np.asarray(rows['day']).astype('datetime64[D]'))
+                valid = [(int(person), date) in valid_keys for person, date in zip(rows['person'], dates)]
+            rows = {**rows, 'valid_walking': valid}
+        return {col: np.asarray(rows[col], dtype=dtype) for col, dtype in self.COLUMNS.items()}
+
+    def update_persons(self, store, persons, valid_person_days=None):
+        """
+        Recatalog some persons of a TraceStore (e.g. those appended to by an ingest), reading
+        one person at a time and keeping the rows of every other person
+        @param:
+            - store: TraceStore
+            - persons: list of ints
+            - valid_person_days: see build. If not given, the person-days already catalogued
+              keep their flag and new ones are valid
+        """
+        persons = sorted(set(int(person) for person in persons))
+        keep = ~np.isin(self.columns['person'], persons)
+        # (valid flag, version, size) of the catalogued person-days of these persons
+        previous = {}
+        c = self.columns
+        old_rows = np.flatnonzero(~keep)
+        for i, date in zip(old_rows, self.dates_of(old_rows)):
+            size = (int(c['n_points'][i]), int(c['start'][i]), int(c['stop'][i]))
+            previous[(int(c['person'][i]), date)] = (bool(c['valid_walking'][i]), int(c['version'][i]), size)
+
+        parts = [{col: values[keep] for col, values in self.columns.items()}]
+        for person in persons:
+            arrays = store.read(person, ['lat', 'long', 'cst_epoch'], mmap=True)
+            rows = Catalog.day_rows(np.full(len(arrays['cst_epoch']), person, np.int16), arrays['cst_epoch'],
+                                    arrays['lat'], arrays['long'], self.options['time_gap'])
+            dates = np.datetime_as_string(rows['day'].astype('datetime64[D]'))
+            old = [previous.get((person, date), (True, None, None)) for date in dates]
+            sizes = zip(rows['n_points'].tolist(), rows['start'].tolist(), rows['stop'].tolist())
+            # Person-days whose points didn't change keep their version
+            rows['version'] = [version if old_size == size else store.version
+                               for (_, version, old_size), size in zip(old, sizes)]
+            if valid_person_days is None:
+                rows['valid_walking'] = [valid for valid, _, _ in old]
+            parts.append(self._typed(rows, valid_person_days))
+        columns = {col: np.concatenate([part[col] for part in parts]) for col in self.COLUMNS}
+        order = np.lexsort((columns['day'], columns['person']))
+        self.columns = {col: values[order] for col, values in columns.items()}
+        self.version = store.version
+
+    def dates_of(self, rows=slice(None)):
+        """'YYYY-MM-DD' dates of some rows (a mask or indices), all rows by default"""
+        return np.datetime_as_string(self.columns['day'][rows].astype('datetime64[D]')).tolist()
+
+    def persons(self):
+        return np.unique(self.columns['person']).tolist()
+
+    def dates(self, person, valid_only=False):
+        """Sorted 'YYYY-MM-DD' dates on which the person has data"""
+        rows = self.columns['person'] == person
+        if valid_only:
+            rows &= self.columns['valid_walking']
+        return self.dates_of(rows)
+
+    def person_days(self, persons=None, valid_only=False):
+        """
+        @param:
+            - persons: optional list of persons, all by default
+            - valid_only: only the valid walking days
+        @return:
+            - person_days: sorted list of (person, 'YYYY-MM-DD') tuples
+        """
+        rows = np.ones(len(self), dtype=bool)
+        if persons is not None:
+            rows &= np.isin(self.columns['person'], list(persons))
+        if valid_only:
+            rows &= self.columns['valid_walking']
+        return list(zip(self.columns['person'][rows].tolist(), self.dates_of(rows)))
+
+    def n_points(self, person_days):
+        """Points of each person-day, 0 for those not in the catalog"""
+        sizes = dict(zip(self.person_days(), self.columns['n_points'].tolist()))
+        return [sizes.get((int(person), str(date)), 0) for person, date in person_days]
+
+    def largest_first(self, person_days):
+        """
+        Order person-days from the most points to the fewest, so a process pool starts the
+        longest tasks first and a large person-day submitted last doesn't hold up the batch
+        """
+        sizes = self.n_points(person_days)
+        order = sorted(range(len(person_days)), key=lambda i: -sizes[i])
+        return [person_days[i] for i in order]
+
+    def rows(self, person):
+        """
+        The catalog rows of one person, as sent to the app's date dropdown
+        @return:
+            - list of dicts with 'date', 'n_points', 'duration_s', 'distance_m', 'bbox'
+              ([min_long, min_lat, max_long, max_lat]), 'n_segments', 'valid_walking' and 'version'
+        """
+        rows = np.flatnonzero(self.columns['person'] == person)
+        c = {col: values[rows].tolist() for col, values in self.columns.items()}
+        return [{
+            'date': date,
+            'n_points': c['n_points'][i],
+            'duration_s': c['stop'][i] - c['start'][i],
+            'distance_m': round(c['distance_m'][i], 1),
+            'bbox': [round(c[col][i], 6) for col in ('min_long', 'min_lat', 'max_long', 'max_lat')],
+            'n_segments': c['n_segments'][i],
+            'valid_walking': c['valid_walking'][i],
+            'version': c['version'][i],
+        } for i, date in enumerate(self.dates_of(rows))]
+
+    def to_frame(self):
+        import pandas as pd
+
+        frame = pd.DataFrame(self.columns)
+        frame.insert(1, 'date', self.dates_of())
+        frame.insert(frame.columns.get_loc('stop') + 1, 'duration_s', frame['stop'] - frame['start'])
+        return frame.drop(columns='day')
+
+    def save(self, path):
+        """Save as one array per column in an .npz, written to a temporary file first"""
+        meta = json.dumps({'version': self.version, 'options': self.options})
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, meta=np.array(meta), **self.columns)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def load(path):
+        """Load a catalog saved with save, or from the catalog.npz of a directory"""
+        if os.path.isdir(path):
+            path = os.path.join(path, FILENAME)
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            columns = {col: arrays[col] for col in Catalog.COLUMNS if col in arrays}
+        return Catalog(columns, meta['version'], meta['options'])
+
+    @staticmethod
+    def find(data_path):
+        """The catalog.npz of a TraceStore or shared dataset directory, or None if it has none"""
+        path = os.path.join(data_path, FILENAME)
+        return Catalog.load(path) if os.path.isdir(data_path) and os.path.exists(path) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog the size and extent of every person-day')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Build the catalog of a dataset')
+    build_parser.add_argument('data', help='Trace store or shared dataset directory (see Ingest, SharedData), '
+                                           'or all_plt_data.csv')
+    build_parser.add_argument('--out', default=None,
+                              help=f'Output .npz, {FILENAME} in the data directory by default')
+    build_parser.add_argument('--dates', default=None, help='valid_walking_dates.csv, to flag the valid walking days')
+    build_parser.add_argument('--time-gap', type=float, default=DEFAULT_OPTIONS['time_gap'])
+    show_parser = subparsers.add_parser('show', help='Print the catalog, or export it')
+    show_parser.add_argument('catalog', help=f'Catalog .npz, or a directory holding a {FILENAME}')
+    show_parser.add_argument('--person', type=int, default=None)
+    show_parser.add_argument('--csv', default=None, help='Write the catalog to this .csv')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        valid_person_days = None
+        if args.dates:
+            from .Materialize import read_valid_walking_dates
+            valid_person_days = read_valid_walking_dates(args.dates)
+        if os.path.isdir(args.data) and os.path.exists(os.path.join(args.data, 'meta.json')):
+            from .SharedData import SharedTraces
+            data = SharedTraces(args.data)
+        elif os.path.isdir(args.data):
+            from .TraceStore import TraceStore
+            data = TraceStore(args.data)
+        else:
+            from .utils import load_all_plt_data
+            data = load_all_plt_data(args.data)
+        catalog = Catalog.build(data, valid_person_days, time_gap=args.time_gap)
+        out = args.out or os.path.join(args.data, FILENAME)
+        catalog.save(out)
+        print(f"Catalogued {len(catalog)} person-days of {len(catalog.persons())} persons to {out}")
+    else:
+        catalog = Catalog.load(args.catalog)
+        frame = catalog.to_frame()
+        if args.person is not None:
+            frame = frame[frame['person'] == args.person]
+        if args.csv:
+            frame.to_csv(args.csv, index=False)
+            print(f"Wrote {len(frame)} person-days to {args.csv}")
+        else:
+            print(frame.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
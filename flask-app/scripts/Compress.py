@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+from .Features import local_xy, segment_starts
+from .StayPoint import detect_staypoints
+from .utils import timestamps_s
+
+DEFAULT_OPTIONS = {
+    'resample_s': None,  # keep at most one point per this many seconds, None to disable
+    'stay_radius': 10.0,  # m, max distance of a stay's points from its running centroid
+    'stay_min_duration': 30.0,  # s, shorter stationary runs are kept as they are
+}
+
+
+def _collapse_runs(gps_df, new_run, collapse_run, seconds, lat_col, long_col, representative):
+    """
+    Replace every run of rows marked for collapsing with a single representative row
+    @param:
+        - new_run: bool array, True on the first row of each run
+        - collapse_run: bool array with one value per run
+        - representative: 'mean' to average the run's coordinates, 'first' to keep its first point
+    @return:
+        - compressed DataFrame with 'orig_start' / 'orig_stop' (positions of the represented
+          rows in gps_df, stop exclusive) and 'duration' (s) columns
+    """
+    n = len(gps_df)
+    run_id = np.cumsum(new_run) - 1
+    keep = new_run | ~collapse_run[run_id]
+    orig_start = np.flatnonzero(keep)
+    orig_stop = np.append(orig_start[1:], n)
+
+    compressed = gps_df.iloc[orig_start].copy()
+    if representative == 'mean':
+        counts = orig_stop - orig_start
+        for col in (lat_col, long_col):
+            values = gps_df[col].to_numpy(dtype=np.float64)
+            compressed[col] = np.add.reduceat(values, orig_start) / counts
+    compressed['orig_start'] = orig_start
+    compressed['orig_stop'] = orig_stop
+    compressed['duration'] = seconds[orig_stop - 1] - seconds[orig_start]
+    return compressed.reset_index(drop=True)
+
+
+def collapse_stays(gps_df: pd.DataFrame, stay_radius: float = 10.0, stay_min_duration: float = 30.0,
+                   lat_col: str = 'lat', long_col: str = 'long', time_col: str = 'cst_datetime',
+                   segment_col: str = 'segment') -> pd.DataFrame:
+    """
+    Collapse stationary stretches of near-identical fixes into a single point with a duration.
+    Runs are the windows of StayPoint.detect_staypoints with stay_radius as the distance
+    threshold, found within each segment, so GPS jitter around a fixed position doesn't break
+    a run the way fixed grid cells would. Runs lasting at least stay_min_duration are replaced
+    by their mean position.
+    """
+    seconds = timestamps_s(gps_df, time_col)
+    x, y = local_xy(gps_df[lat_col], gps_df[long_col])
+
+    new_run = np.ones(len(gps_df), dtype=bool)
+    bounds = np.append(np.flatnonzero(segment_starts(gps_df, segment_col)), len(gps_df))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        for start, stop in detect_staypoints(x[first:last], y[first:last], seconds[first:last],
+                                             stay_radius, stay_min_duration):
+            new_run[first + start + 1:first + stop] = False
+
+    # Points outside every stay are runs of their own, which collapse to themselves
+    collapse_run = np.ones(int(new_run.sum()), dtype=bool)
+    return _collapse_runs(gps_df, new_run, collapse_run, seconds, lat_col, long_col, 'mean')
+
+
+def resample(gps_df: pd.DataFrame, resample_s: float, lat_col: str = 'lat', long_col: str = 'long',
+             time_col: str = 'cst_datetime', segment_col: str = 'segment') -> pd.DataFrame:
+    """
+    Keep the first point of every resample_s-second bucket, counted from the start of each segment
+    """
+    seconds = timestamps_s(gps_df, time_col)
+    starts = segment_starts(gps_df, segment_col)
+    segment_first = np.maximum.accumulate(np.where(starts, np.arange(len(gps_df)), 0))
+    bucket = (seconds - seconds[segment_first]) // resample_s
+
+    new_run = starts.copy()
+    new_run[1:] |= bucket[1:] != bucket[:-1]
+    collapse_run = np.ones(int(new_run.sum()), dtype=bool)
+    return _collapse_runs(gps_df, new_run, collapse_run, seconds, lat_col, long_col, 'first')
+
+
+def compress(gps_df: pd.DataFrame, lat_col: str = 'lat', long_col: str = 'long',
+             time_col: str = 'cst_datetime', segment_col: str = 'segment', **options) -> pd.DataFrame:
+    """
+    Collapse stays, then optionally resample to a fixed rate. The 'orig_start' / 'orig_stop'
+    columns always refer to rows of the input gps_df, see expand() to map results back.
+    @param:
+        - gps_df: time-ordered pd.DataFrame with coordinate and time columns
+        - options: overrides for DEFAULT_OPTIONS
+    """
+    options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+    if len(gps_df) == 0:
+        return gps_df.assign(orig_start=0, orig_stop=0, duration=0)
+
+    compressed = collapse_stays(gps_df, options['stay_radius'], options['stay_min_duration'],
+                                lat_col, long_col, time_col, segment_col)
+    if options['resample_s']:
+        stays = compressed
+        compressed = resample(stays, options['resample_s'], lat_col, long_col, time_col, segment_col)
+        # Compose both mappings so they point at the input rows again
+        compressed['orig_stop'] = stays['orig_stop'].to_numpy()[compressed['orig_stop'].to_numpy() - 1]
+        compressed['orig_start'] = stays['orig_start'].to_numpy()[compressed['orig_start'].to_numpy()]
+        seconds = timestamps_s(gps_df, time_col)
+        compressed['duration'] = (seconds[compressed['orig_stop'].to_numpy() - 1]
+                                  - seconds[compressed['orig_start'].to_numpy()])
+
+    print(f"Compressed {len(gps_df)} points to {len(compressed)}")
+    return compressed
+
+
+def expand(result_df: pd.DataFrame, compressed_df: pd.DataFrame, original_df: pd.DataFrame = None,
+           restore_cols=('cst_datetime', 'cst_epoch', 'date', 'time')) -> pd.DataFrame:
+    """
+    Expand results computed on compressed points (e.g. Kalman output or make_tracedf results,
+    which have one row per compressed point) back to one row per original point
+    @param:
+        - result_df: pd.DataFrame with one row per row of compressed_df
+        - compressed_df: output of compress()
+        - original_df: the uncompressed input, to restore each row's own restore_cols
+    """
+    counts = (compressed_df['orig_stop'] - compressed_df['orig_start']).to_numpy()
+    expanded = result_df.iloc[np.repeat(np.arange(len(result_df)), counts)].reset_index(drop=True)
+    if original_df is not None:
+        for col in restore_cols:
+            if col in original_df.columns and col in expanded.columns:
+                expanded[col] = original_df[col].to_numpy()
+    return expanded
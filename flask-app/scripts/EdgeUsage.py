@@ -0,0 +1,404 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from .Features import haversine
+from .utils import timestamps_s
+
+DEFAULT_OPTIONS = {
+    'max_gap': 60,  # s, longer steps between matched points (lost signal, breaks) aren't spent on an edge
+}
+# Per-edge accumulators, all additive so a person-day's usage can be added and subtracted again
+ACCUMULATORS = {
+    'traversals': np.int64,  # passes along the edge: runs of consecutive points matched to it
+    'person_days': np.int64,  # person-days with at least one point on the edge
+    'points': np.int64,  # matched points on the edge
+    'dwell_s': np.float64,  # time spent on the edge
+    'distance_m': np.float64,  # distance walked on the edge, between matched points
+}
+EDGE_COLUMNS = ['edge_id', 'way_id', 'edge_name', 'length_m', 'coords']
+
+
+def day_usage(edge_trace_df: pd.DataFrame, max_gap=DEFAULT_OPTIONS['max_gap']):
+    """
+    Usage of every edge traversed in a person-day
+    @param:
+        - edge_trace_df: pd.DataFrame from MapMatch.match_edges, with one row per point in time order
+        - max_gap: s, steps longer than this are left out of the dwell time and distance
+    @return:
+        - edge_ids: sorted np.ndarray of the int64 ids of the traversed edges
+        - usage: dict of {accumulator name: np.ndarray aligned with edge_ids} (see ACCUMULATORS)
+    """
+    edge = edge_trace_df['edge_id'].to_numpy(dtype=np.int64)
+    on_edge = edge >= 0
+    edge = edge[on_edge]
+    seconds = timestamps_s(edge_trace_df)[on_edge]
+    lat = edge_trace_df['matched_lat'].to_numpy(dtype=np.float64)[on_edge]
+    long = edge_trace_df['matched_long'].to_numpy(dtype=np.float64)[on_edge]
+
+    edge_ids, edge_of_point = np.unique(edge, return_inverse=True)
+    n = len(edge_ids)
+    # Steps between consecutive matched points, spent on the edge of the first point
+    step_seconds = np.diff(seconds).astype(np.float64)
+    step_distance = haversine(lat[:-1], long[:-1], lat[1:], long[1:])
+    in_step = (step_seconds > 0) & (step_seconds <= max_gap)
+    # A traversal starts on every change of edge, and after every gap
+    starts = np.ones(len(edge), dtype=bool)
+    starts[1:] = (edge[1:] != edge[:-1]) | ~in_step
+    usage = {
+        'traversals': np.bincount(edge_of_point[starts], minlength=n),
+        'person_days': np.ones(n, dtype=np.int64),
+        'points': np.bincount(edge_of_point, minlength=n),
+        'dwell_s': np.bincount(edge_of_point[:-1][in_step], weights=step_seconds[in_step], minlength=n),
+        'distance_m': np.bincount(edge_of_point[:-1][in_step], weights=step_distance[in_step], minlength=n),
+    }
+    return edge_ids, {name: usage[name].astype(dtype) for name, dtype in ACCUMULATORS.items()}
+
+
+class EdgeUsage:
+    """
+    EdgeUsage aggregates how the road network is used across the corpus: traversals, dwell
+    time and walking speed per edge, in arrays aligned with a sorted array of int64 edge ids.
+
+    The usage of every person-day is stored next to the totals, so rerunning a person-day
+    subtracts its old usage before adding the new one, and the table never has to be rebuilt
+    from scratch. Person-days are stored as they are updated but the totals only on save(),
+    so the 'updating' file marks the time in between: if it's left behind, an update was
+    interrupted and the next one recovers the totals first (see recover).
+
+    Layout:
+        <root>/usage.npz   sorted edge ids and the total of each accumulator
+        <root>/edges.pkl   pd.DataFrame of the EDGE_COLUMNS of every edge seen so far
+        <root>/days/<person>/<date>.npz   the usage of one person-day and its input fingerprint
+        <root>/updating   present while person-days changed since the last save()
+    """
+    def __init__(self, root):
+        self.root = root
+        self.updating = False
+        os.makedirs(root, exist_ok=True)
+        self.edge_ids = np.zeros(0, dtype=np.int64)
+        self.totals = {name: np.zeros(0, dtype=dtype) for name, dtype in ACCUMULATORS.items()}
+        self.edges = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in
+                                   zip(EDGE_COLUMNS, [np.int64, np.int64, object, np.float64, object])})
+        if os.path.exists(self.usage_path):
+            with np.load(self.usage_path) as saved:
+                self.edge_ids = saved['edge_ids']
+                self.totals = {name: saved[name] for name in ACCUMULATORS}
+        if os.path.exists(self.edges_path):
+            self.edges = pd.read_pickle(self.edges_path)
+
+    def __len__(self):
+        return len(self.edge_ids)
+
+    @property
+    def usage_path(self):
+        return os.path.join(self.root, 'usage.npz')
+
+    @property
+    def edges_path(self):
+        return os.path.join(self.root, 'edges.pkl')
+
+    @property
+    def updating_path(self):
+        return os.path.join(self.root, 'updating')
+
+    @property
+    def interrupted(self):
+        """Whether person-days were changed by an update which never saved its totals"""
+        return not self.updating and os.path.exists(self.updating_path)
+
+    def start_updating(self):
+        """Mark the stored person-days as ahead of the saved totals, until save()"""
+        if not self.updating:
+            open(self.updating_path, 'w').close()
+            self.updating = True
+
+    def day_path(self, person, date):
+        return os.path.join(self.root, 'days', str(person), f'{date}.npz')
+
+    def load_day(self, person, date):
+        """
+        The stored usage of a person-day
+        @return:
+            - fingerprint, edge_ids, usage (see day_usage), or None if it isn't stored
+        """
+        path = self.day_path(person, date)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            return str(saved['fingerprint']), saved['edge_ids'], {name: saved[name] for name in ACCUMULATORS}
+
+    def day_fingerprint(self, person, date):
+        day = self.load_day(person, date)
+        return day[0] if day else None
+
+    def iter_days(self):
+        """Yield (person, date) for every stored person-day"""
+        days_dir = os.path.join(self.root, 'days')
+        if not os.path.isdir(days_dir):
+            return
+        for person in sorted(os.listdir(days_dir), key=int):
+            for filename in sorted(os.listdir(os.path.join(days_dir, person))):
+                if filename.endswith('.npz'):
+                    yield int(person), filename[:-len('.npz')]
+
+    def accumulate(self, edge_ids, usage, sign=1):
+        """Add (sign=1) or subtract (sign=-1) usage to the totals, growing them for new edges"""
+        if len(edge_ids) == 0:
+            return
+        missing = np.setdiff1d(edge_ids, self.edge_ids, assume_unique=True)
+        if len(missing):
+            merged = np.union1d(self.edge_ids, missing)
+            old_positions = np.searchsorted(merged, self.edge_ids)
+            for name, dtype in ACCUMULATORS.items():
+                grown = np.zeros(len(merged), dtype=dtype)
+                grown[old_positions] = self.totals[name]
+                self.totals[name] = grown
+            self.edge_ids = merged
+        # edge_ids are unique, so plain fancy indexing adds each value once
+        positions = np.searchsorted(self.edge_ids, edge_ids)
+        for name in ACCUMULATORS:
+            self.totals[name][positions] += sign * usage[name]
+
+    def update_day(self, person, date, fingerprint, edge_trace_df, edge_df=None, **options):
+        """
+        Replace the usage of a person-day
+        @param:
+            - fingerprint: fingerprint of the inputs (see ResultCache.fingerprint)
+            - edge_trace_df, edge_df: output of MapMatch.match_edges
+            - options: overrides for DEFAULT_OPTIONS
+        """
+        options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+        self.start_updating()
+        self.remove_day(person, date)
+        edge_ids, usage = day_usage(edge_trace_df, options['max_gap'])
+        self.accumulate(edge_ids, usage)
+
+        path = self.day_path(person, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path + '.tmp.npz', fingerprint=fingerprint, edge_ids=edge_ids, **usage)
+        os.replace(path + '.tmp.npz', path)
+
+        if edge_df is not None and len(edge_df):
+            # Keep the first geometry seen of every edge
+            new_edges = edge_df.drop_duplicates('edge_id')
+            new_edges = new_edges[~new_edges['edge_id'].isin(self.edges['edge_id'])]
+            if len(new_edges):
+                self.edges = pd.concat([self.edges, new_edges[EDGE_COLUMNS]], ignore_index=True)
+
+    def remove_day(self, person, date):
+        """Subtract the usage of a person-day from the totals and forget it"""
+        day = self.load_day(person, date)
+        if day is not None:
+            self.start_updating()
+            self.accumulate(day[1], day[2], sign=-1)
+            os.remove(self.day_path(person, date))
+
+    def rebuild(self):
+        """Recompute the totals from the stored person-days, e.g. after an interrupted update"""
+        self.edge_ids = np.zeros(0, dtype=np.int64)
+        self.totals = {name: np.zeros(0, dtype=dtype) for name, dtype in ACCUMULATORS.items()}
+        for person, date in self.iter_days():
+            _, edge_ids, usage = self.load_day(person, date)
+            self.accumulate(edge_ids, usage)
+
+    def recover(self):
+        """
+        Bring the totals back in line with the stored person-days after an interrupted update:
+        forget the person-days with edges missing from the saved edges, so the next update
+        matches them again, and recompute the totals from the others
+        """
+        known = self.edges['edge_id'].to_numpy(dtype=np.int64)
+        n_forgotten = 0
+        for person, date in list(self.iter_days()):
+            if not np.isin(self.load_day(person, date)[1], known).all():
+                os.remove(self.day_path(person, date))
+                n_forgotten += 1
+        self.rebuild()
+        self.save()
+        print(f"Recovered the totals of an interrupted update ({n_forgotten} person-days to match again)")
+
+    def save(self):
+        np.savez(self.usage_path + '.tmp.npz', edge_ids=self.edge_ids, **self.totals)
+        os.replace(self.usage_path + '.tmp.npz', self.usage_path)
+        pd.to_pickle(self.edges, self.edges_path + '.tmp')
+        os.replace(self.edges_path + '.tmp', self.edges_path)
+        # Totals and edges are saved, so they match the stored person-days again
+        if os.path.exists(self.updating_path):
+            os.remove(self.updating_path)
+        self.updating = False
+
+    def to_frame(self, min_traversals=1) -> pd.DataFrame:
+        """
+        The edge-level usage table
+        @return:
+            - pd.DataFrame of every edge traversed at least min_traversals times, with its
+              totals, 'mean_speed' (m/s, distance over dwell time) and edge attributes
+        """
+        used = self.totals['traversals'] >= min_traversals
+        table = pd.DataFrame({'edge_id': self.edge_ids[used], **{name: self.totals[name][used] for name in ACCUMULATORS}})
+        dwell = table['dwell_s'].to_numpy()
+        table['mean_speed'] = np.divide(table['distance_m'].to_numpy(), dwell, out=np.full(len(table), np.nan),
+                                        where=dwell > 0)
+        return table.merge(self.edges, on='edge_id', how='left')
+
+    def to_geojson(self, min_traversals=1, bbox=None) -> dict:
+        """
+        The usage table as a GeoJSON FeatureCollection of LineStrings, e.g. to draw as a layer
+        @param:
+            - bbox: optional (min_long, min_lat, max_long, max_lat), to only keep the edges
+              intersecting it (e.g. one map tile)
+        """
+        table = self.to_frame(min_traversals)
+        table = table[table['coords'].map(lambda coords: isinstance(coords, list) and len(coords) >= 2)]
+        if bbox is not None:
+            min_long, min_lat, max_long, max_lat = bbox
+            bounds = np.array([np.r_[np.min(coords, axis=0), np.max(coords, axis=0)] for coords in table['coords']])
+            if len(bounds):
+                table = table[(bounds[:, 0] <= max_long) & (bounds[:, 2] >= min_long)
+                              & (bounds[:, 1] <= max_lat) & (bounds[:, 3] >= min_lat)]
+        properties = table.drop(columns='coords').astype(object).where(table.drop(columns='coords').notna(), None)
+        features = [{'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': coords},
+                     'properties': row}
+                    for coords, row in zip(table['coords'], properties.to_dict(orient='records'))]
+        return {'type': 'FeatureCollection', 'features': features}
+
+
+def _match_task(task):
+    """Worker: map match one person-day onto road edges"""
+    from .MapMatch import MapMatch
+    from .Pipeline import Pipeline
+
+    person, date, day_fingerprint, params, person_df = task
+    try:
+        stages = Pipeline(params).prepare(person_df)
+        edge_trace_df, edge_df = MapMatch.match_edges(stages['df_to_match'], stages['colnames_to_match'],
+                                                      params['match_options'])
+    except Exception as e:
+        print(f"Person {person}, {date}: {e}")
+        return person, date, None, None, None
+    return person, date, day_fingerprint, edge_trace_df, edge_df
+
+
+def update(data, person_days, root, params=None, workers=None, catalog=None, **options):
+    """
+    Add the edge usage of person-days to the table under root, map matching only the
+    person-days that are new or whose data or parameters changed
+    @param:
+        - data: all_plt_data df, or SharedTraces
+        - person_days: list of (person, 'YYYY-MM-DD') tuples
+        - params: pipeline parameters of the layer to match (Materialize.DEFAULT_PARAMS if not given)
+        - workers: number of worker processes
+        - catalog: optional Catalog of data, to match the largest person-days first
+        - options: overrides for DEFAULT_OPTIONS
+    @return:
+        - usage: the updated EdgeUsage
+    """
+    from .Materialize import DEFAULT_PARAMS
+    from .Pipeline import Pipeline
+    from .ResultCache import fingerprint
+    from .utils import filter_person_and_date
+
+    params = Pipeline(params or DEFAULT_PARAMS).params
+    options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+    usage = EdgeUsage(root)
+    if usage.interrupted:
+        usage.recover()
+    n_skipped = 0
+    if catalog is not None:
+        person_days = catalog.largest_first(person_days)
+
+    def tasks():
+        nonlocal n_skipped
+        for person, date in person_days:
+            if hasattr(data, 'person_day'):
+                person_df = data.person_day(person, date, legacy=False)
+            else:
+                person_df = filter_person_and_date(data, person, date)
+            if not len(person_df):
+                continue
+            day_fingerprint = fingerprint(person_df, {**params, 'edge_usage': options})
+            if usage.day_fingerprint(person, date) == day_fingerprint:
+                n_skipped += 1
+                continue
+            yield person, date, day_fingerprint, params, person_df
+
+    n_done = n_failed = 0
+    # Person-days are matched in the pool and accumulated here, as they come in
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for person, date, day_fingerprint, edge_trace_df, edge_df in executor.map(_match_task, tasks()):
+            if edge_trace_df is None:
+                n_failed += 1
+                continue
+            usage.update_day(person, date, day_fingerprint, edge_trace_df, edge_df, **options)
+            n_done += 1
+    usage.save()
+    print(f"Updated {n_done} person-days ({n_skipped} unchanged, {n_failed} failed), {len(usage)} edges")
+    return usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate road edge usage across map matched traces')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    update_parser = subparsers.add_parser('update', help='Map match new or changed person-days and add their usage')
+    update_parser.add_argument('data', help='all_plt_data.csv, or a shared dataset directory (see SharedData)')
+    update_parser.add_argument('usage_dir', help='Directory of the edge usage table')
+    update_parser.add_argument('--dates', default='../notebooks/data/valid_walking_dates.csv',
+                               help='valid_walking_dates.csv')
+    update_parser.add_argument('--params', default=None, help='JSON file of pipeline parameters, instead of the defaults')
+    update_parser.add_argument('--max-gap', type=float, default=DEFAULT_OPTIONS['max_gap'])
+    update_parser.add_argument('--workers', type=int, default=None)
+    update_parser.add_argument('--catalog', default=None,
+                               help='Catalog of the data (see Catalog), the catalog.npz of a shared dataset by default')
+    export_parser = subparsers.add_parser('export', help='Write the edge table and its GeoJSON layer')
+    export_parser.add_argument('usage_dir', help='Directory of the edge usage table')
+    export_parser.add_argument('out', help='Output .csv (edge table) or .geojson (layer)')
+    export_parser.add_argument('--min-traversals', type=int, default=1)
+    rebuild_parser = subparsers.add_parser('rebuild', help='Recompute the totals from the stored person-days')
+    rebuild_parser.add_argument('usage_dir', help='Directory of the edge usage table')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'update':
+        from .Materialize import read_valid_walking_dates
+
+        params = None
+        if args.params:
+            with open(args.params) as f:
+                params = json.load(f)
+        if os.path.isdir(args.data):
+            from .SharedData import SharedTraces
+            data = SharedTraces(args.data)
+        else:
+            from .utils import load_all_plt_data
+            data = load_all_plt_data(args.data)
+        from .Catalog import Catalog
+        catalog = Catalog.load(args.catalog) if args.catalog else Catalog.find(args.data)
+        update(data, read_valid_walking_dates(args.dates), args.usage_dir, params, args.workers, catalog,
+               max_gap=args.max_gap)
+    elif args.command == 'rebuild':
+        usage = EdgeUsage(args.usage_dir)
+        usage.rebuild()
+        usage.save()
+        print(f"Rebuilt the usage of {len(usage)} edges")
+    else:
+        usage = EdgeUsage(args.usage_dir)
+        if args.out.endswith('.csv'):
+            table = usage.to_frame(args.min_traversals)
+            table.drop(columns='coords').to_csv(args.out, index=False)
+            n_edges = len(table)
+        else:
+            geojson = usage.to_geojson(args.min_traversals)
+            with open(args.out, 'w') as f:
+                json.dump(geojson, f)
+            n_edges = len(geojson['features'])
+        print(f"Exported {n_edges} edges")
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
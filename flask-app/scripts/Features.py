@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+from .utils import timestamps_s
+
+EARTH_RADIUS_M = 6371008.8
+
+KINEMATIC_COLUMNS = ['step_distance', 'step_seconds', 'speed', 'bearing',
+                     'heading_change', 'turn_rate', 'acceleration', 'dwell']
+
+
+def haversine(lat1, long1, lat2, long2):
+    """Vectorized great-circle distance in meters between two arrays of coordinates"""
+    lat1, long1, lat2, long2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, long1, lat2, long2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def initial_bearing(lat1, long1, lat2, long2):
+    """Vectorized compass bearing in degrees [0, 360) from the first to the second coordinates"""
+    lat1, long1, lat2, long2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, long1, lat2, long2))
+    y = np.sin(long2 - long1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(long2 - long1)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+
+def local_xy(lat, long, lat0=None):
+    """
+    Equirectangular projection to meters around lat0 (default: the mean latitude), accurate
+    enough for distances of a few kilometers
+    @return:
+        - x, y: np.ndarrays of meters east and north
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    long = np.asarray(long, dtype=np.float64)
+    if lat0 is None:
+        lat0 = np.nanmean(lat) if len(lat) else 0.0
+    x = np.radians(long) * EARTH_RADIUS_M * np.cos(np.radians(lat0))
+    y = np.radians(lat) * EARTH_RADIUS_M
+    return x, y
+
+
+def segment_starts(gps_df, segment_col: str = 'segment'):
+    """
+    Boolean array which is True on the first row of every segment (or only on the
+    first row if gps_df has no segment column)
+    """
+    starts = np.zeros(len(gps_df), dtype=bool)
+    if len(gps_df) == 0:
+        return starts
+    starts[0] = True
+    if segment_col in gps_df.columns:
+        segments = gps_df[segment_col].to_numpy()
+        starts[1:] = segments[1:] != segments[:-1]
+    return starts
+
+
+def kinematic_features(gps_df: pd.DataFrame, lat_col: str = 'lat', long_col: str = 'long',
+                       time_col: str = 'cst_datetime', segment_col: str = 'segment',
+                       dwell_speed: float = 0.3) -> pd.DataFrame:
+    """
+    Compute per-point kinematics in one vectorized pass, never differencing across segments.
+    Every step value on row i describes the step from row i-1 to row i, and is NaN on the
+    first row of each segment.
+    @param:
+        - gps_df: time-ordered pd.DataFrame with coordinate and time columns
+        - lat_col, long_col: coordinate columns (e.g. 'kalman_lat', 'kalman_long')
+        - time_col: name of the time column
+        - segment_col: rows are only compared within the same value of this column, if present
+        - dwell_speed: speed in m/s under which a point is flagged as dwelling
+    @return:
+        - copy of gps_df with KINEMATIC_COLUMNS added:
+            step_distance (m), step_seconds (s), speed (m/s), bearing (deg),
+            heading_change (deg, in [-180, 180)), turn_rate (deg/s), acceleration (m/s^2), dwell (bool)
+    """
+    gps_df = gps_df.copy()
+    n = len(gps_df)
+    lat = gps_df[lat_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    long = gps_df[long_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    seconds = timestamps_s(gps_df, time_col).astype(np.float64)
+    starts = segment_starts(gps_df, segment_col)
+
+    step_distance = np.full(n, np.nan)
+    step_seconds = np.full(n, np.nan)
+    bearing = np.full(n, np.nan)
+    if n > 1:
+        step_distance[1:] = haversine(lat[:-1], long[:-1], lat[1:], long[1:])
+        step_seconds[1:] = np.diff(seconds)
+        bearing[1:] = initial_bearing(lat[:-1], long[:-1], lat[1:], long[1:])
+    step_distance[starts] = np.nan
+    step_seconds[starts] = np.nan
+    step_seconds[step_seconds <= 0] = np.nan  # duplicated timestamps have no defined speed
+    bearing[starts] = np.nan
+    # A point that didn't move has no heading
+    bearing[step_distance == 0] = np.nan
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speed = step_distance / step_seconds
+
+    # Second-order values are NaN on the second row of each segment too, since
+    # the first step of a segment is NaN
+    heading_change = np.full(n, np.nan)
+    acceleration = np.full(n, np.nan)
+    if n > 1:
+        heading_change[1:] = (bearing[1:] - bearing[:-1] + 180) % 360 - 180
+        acceleration[1:] = (speed[1:] - speed[:-1]) / step_seconds[1:]
+    heading_change[starts] = np.nan
+    acceleration[starts] = np.nan
+    turn_rate = heading_change / step_seconds
+
+    gps_df['step_distance'] = step_distance
+    gps_df['step_seconds'] = step_seconds
+    gps_df['speed'] = speed
+    gps_df['bearing'] = bearing
+    gps_df['heading_change'] = heading_change
+    gps_df['turn_rate'] = turn_rate
+    gps_df['acceleration'] = acceleration
+    gps_df['dwell'] = (speed < dwell_speed) | (step_distance == 0)
+    return gps_df
@@ -0,0 +1,297 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+DEFAULT_OPTIONS = {
+    'min_zoom': 3,  # web map zoom levels of the pyramid
+    'max_zoom': 18,
+    'cell_px': 8,  # size of a grid cell in screen pixels, at every zoom level
+    'time_bucket': None,  # or one of TIME_BUCKETS, to also count points per time bucket
+}
+# Number of buckets of each kind of time bucket
+TIME_BUCKETS = {'hour': 24, 'weekday': 7, 'month': 12}
+TILE_SIZE = 256  # px, of a web map tile
+MAX_LATITUDE = 85.05112878  # of the web mercator projection
+MAX_CELL_BITS = 26  # cells per axis at the max zoom are at most 2**MAX_CELL_BITS, so keys fit in int64
+REDUCE_ROWS = 4_000_000  # unique cells buffered while building, before they're merged
+# Points are bucketed by local time in Beijing, China Standard Time (see TraceStore.CST)
+UTC_OFFSET_S = 8 * 3600
+
+
+def mercator(lat, long):
+    """
+    Web mercator coordinates of WGS84 coordinates
+    @return:
+        - x, y: np.ndarrays in [0, 1), from the top left corner of the world map
+    """
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(long, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return np.clip(x, 0, np.nextafter(1, 0)), np.clip(y, 0, np.nextafter(1, 0))
+
+
+def inverse_mercator(x, y):
+    """WGS84 lat, long of web mercator coordinates in [0, 1)"""
+    long = np.asarray(x, dtype=np.float64) * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=np.float64)))))
+    return lat, long
+
+
+def time_buckets(seconds, time_bucket, utc_offset_s=UTC_OFFSET_S):
+    """
+    Time bucket of every timestamp, in local time
+    @param:
+        - seconds: int64 seconds since the unix epoch, in UTC like cst_epoch (see utils.timestamps_s)
+        - time_bucket: 'hour' (of the day), 'weekday' (0 is Monday) or 'month' (0 is January)
+        - utc_offset_s: offset of the local time from UTC, China Standard Time by default
+    """
+    seconds = np.asarray(seconds, dtype=np.int64) + utc_offset_s
+    if time_bucket == 'hour':
+        return (seconds // 3600 % 24).astype(np.int64)
+    if time_bucket == 'weekday':
+        # The unix epoch was a Thursday
+        return ((seconds // 86400 + 3) % 7).astype(np.int64)
+    if time_bucket == 'month':
+        return (seconds.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64) % 12).astype(np.int64)
+    raise ValueError(f"Unknown time bucket: {time_bucket}, expected one of {list(TIME_BUCKETS)}")
+
+
+class HeatmapPyramid:
+    """
+    HeatmapPyramid holds the point density of the whole corpus at every web map zoom level:
+    points are counted in a grid of cell_px screen pixels per zoom level (optionally per time
+    bucket too), so drawing a heatmap of any viewport only sends the occupied cells in it.
+
+    The cells of the max zoom are counted with np.unique over integer cell keys, and every
+    lower zoom level is derived from the one above by halving the cell coordinates and
+    summing, so points are only projected once.
+
+    Every level holds arrays sorted by cell x, then y, then bucket:
+        x, y: int32 cell coordinates at that zoom level
+        bucket: time bucket of the cell (0 without time buckets)
+        count: number of points in the cell
+    """
+    def __init__(self, levels: dict, options: dict):
+        """
+        @param:
+            - levels: dict of {zoom: dict of the x, y, bucket and count arrays}
+            - options: the DEFAULT_OPTIONS the pyramid was built with
+        """
+        self.levels = levels
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self._scales = {}
+
+    def __len__(self):
+        """Number of points counted"""
+        return int(self.levels[self.options['max_zoom']]['count'].sum()) if self.levels else 0
+
+    @staticmethod
+    def _bits(options):
+        bits = options['max_zoom'] + int(np.log2(TILE_SIZE / options['cell_px']))
+        if bits > MAX_CELL_BITS or options['cell_px'] & (options['cell_px'] - 1):
+            raise ValueError("cell_px must be a power of two, and max_zoom at most "
+                             f"{MAX_CELL_BITS - int(np.log2(TILE_SIZE / options['cell_px']))}")
+        return bits
+
+    @staticmethod
+    def cell_keys(lat, long, seconds=None, **options):
+        """
+        Integer key of the max zoom cell (and time bucket) of every point
+        """
+        options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+        bits = HeatmapPyramid._bits(options)
+        x, y = mercator(lat, long)
+        keys = ((x * (1 << bits)).astype(np.int64) << bits) | (y * (1 << bits)).astype(np.int64)
+        if options['time_bucket']:
+            keys = keys * TIME_BUCKETS[options['time_bucket']] + time_buckets(seconds, options['time_bucket'])
+        return keys
+
+    @staticmethod
+    def build(chunks, **options):
+        """
+        Count the points of many chunks into a pyramid, without holding all points at once
+        @param:
+            - chunks: iterable of (lat, long, seconds) arrays (see points_from_data)
+            - options: overrides for DEFAULT_OPTIONS
+        """
+        options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+        bits = HeatmapPyramid._bits(options)
+        n_buckets = TIME_BUCKETS[options['time_bucket']] if options['time_bucket'] else 1
+
+        def reduce(keys, counts):
+            keys = np.concatenate(keys)
+            counts = np.concatenate(counts)
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            return unique_keys, np.bincount(inverse.reshape(-1), weights=counts).astype(np.int64)
+
+        keys, counts, n_buffered = [], [], 0
+        for lat, long, seconds in chunks:
+            chunk_keys, chunk_counts = np.unique(HeatmapPyramid.cell_keys(lat, long, seconds, **options),
+                                                 return_counts=True)
+            keys.append(chunk_keys)
+            counts.append(chunk_counts.astype(np.int64))
+            n_buffered += len(chunk_keys)
+            if n_buffered > REDUCE_ROWS:
+                merged = reduce(keys, counts)
+                keys, counts, n_buffered = [merged[0]], [merged[1]], len(merged[0])
+        keys, counts = reduce(keys, counts) if keys else (np.zeros(0, np.int64), np.zeros(0, np.int64))
+
+        levels = {}
+        bucket = keys % n_buckets
+        cells = keys // n_buckets
+        x, y = cells >> bits, cells & ((1 << bits) - 1)
+        for zoom in range(options['max_zoom'], options['min_zoom'] - 1, -1):
+            if zoom < options['max_zoom']:
+                # Four cells make one cell of the zoom level below
+                level_keys = (((x >> 1) << bits) | (y >> 1)) * n_buckets + bucket
+                level_keys, inverse = np.unique(level_keys, return_inverse=True)
+                counts = np.bincount(inverse.reshape(-1), weights=counts).astype(np.int64)
+                bucket = level_keys % n_buckets
+                x, y = (level_keys // n_buckets) >> bits, (level_keys // n_buckets) & ((1 << bits) - 1)
+            levels[zoom] = {'x': x.astype(np.int32), 'y': y.astype(np.int32), 'bucket': bucket.astype(np.int16),
+                            'count': counts}
+        return HeatmapPyramid(levels, options)
+
+    def save(self, path):
+        arrays = {f'z{zoom}_{name}': values for zoom, level in self.levels.items() for name, values in level.items()}
+        np.savez(path, **arrays, min_zoom=self.options['min_zoom'], max_zoom=self.options['max_zoom'],
+                 cell_px=self.options['cell_px'], time_bucket=self.options['time_bucket'] or '')
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as saved:
+            options = {'min_zoom': int(saved['min_zoom']), 'max_zoom': int(saved['max_zoom']),
+                       'cell_px': int(saved['cell_px']), 'time_bucket': str(saved['time_bucket']) or None}
+            levels = {zoom: {name: saved[f'z{zoom}_{name}'] for name in ('x', 'y', 'bucket', 'count')}
+                      for zoom in range(options['min_zoom'], options['max_zoom'] + 1)}
+        return HeatmapPyramid(levels, options)
+
+    def query(self, zoom, bbox=None, bucket=None):
+        """
+        The occupied cells of a zoom level
+        @param:
+            - zoom: web map zoom level, clamped to the levels of the pyramid
+            - bbox: optional (min_long, min_lat, max_long, max_lat) of the viewport
+            - bucket: optional time bucket, otherwise the counts of all buckets are summed
+        @return:
+            - lat, long: np.ndarrays of the cell centers
+            - count: np.ndarray of the number of points in each cell
+        """
+        zoom = int(min(max(zoom, self.options['min_zoom']), self.options['max_zoom']))
+        level = self.levels[zoom]
+        start, stop = 0, len(level['x'])
+        n_cells = 1 << (zoom + int(np.log2(TILE_SIZE / self.options['cell_px'])))
+        if bbox is not None:
+            min_long, min_lat, max_long, max_lat = bbox
+            (min_x, max_x), (max_y, min_y) = (
+                (values * n_cells).astype(np.int64) for values in mercator([min_lat, max_lat], [min_long, max_long]))
+            # Cells are sorted by x, so the x range is a slice
+            start, stop = np.searchsorted(level['x'], [min_x, max_x + 1])
+            in_bbox = (level['y'][start:stop] >= min_y) & (level['y'][start:stop] <= max_y)
+        else:
+            in_bbox = np.ones(stop, dtype=bool)
+        if bucket is not None:
+            in_bbox &= level['bucket'][start:stop] == bucket
+        x, y, count = (level[name][start:stop][in_bbox] for name in ('x', 'y', 'count'))
+        if self.options['time_bucket'] and bucket is None and len(x):
+            # Sum the buckets of each cell, which are next to each other
+            first = np.ones(len(x), dtype=bool)
+            first[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+            count = np.add.reduceat(count, np.flatnonzero(first))
+            x, y = x[first], y[first]
+        lat, long = inverse_mercator((x + 0.5) / n_cells, (y + 0.5) / n_cells)
+        return lat, long, count
+
+    def scale(self, zoom, quantile=0.99):
+        """Count of a cell drawn at full intensity at a zoom level, so a few hot spots don't wash the rest out"""
+        zoom = int(min(max(zoom, self.options['min_zoom']), self.options['max_zoom']))
+        if (zoom, quantile) not in self._scales:
+            count = self.levels[zoom]['count']
+            self._scales[(zoom, quantile)] = float(np.quantile(count, quantile)) if len(count) else 1.0
+        return self._scales[(zoom, quantile)]
+
+    def heat_data(self, zoom, bbox=None, bucket=None):
+        """
+        A heatmap layer of a viewport, e.g. for Leaflet.heat or folium's HeatMap
+        @return:
+            - dict of 'max' (see scale) and 'points', a list of [lat, long, count]
+        """
+        lat, long, count = self.query(zoom, bbox, bucket)
+        points = np.column_stack([lat.round(6), long.round(6), count]).tolist()
+        return {'max': self.scale(zoom), 'points': points}
+
+
+def points_from_data(data, chunk_rows=1_000_000):
+    """
+    Yield (lat, long, seconds) chunks of every point of a dataset
+    @param:
+        - data: all_plt_data df (see utils.load_all_plt_data), SharedTraces or TraceStore
+    """
+    from .utils import timestamps_s
+
+    if hasattr(data, 'columns') and isinstance(data.columns, dict):
+        # SharedTraces: slices of the memory-mapped columns
+        columns = data.columns
+        for start in range(0, len(data), chunk_rows):
+            stop = start + chunk_rows
+            yield columns['lat'][start:stop], columns['long'][start:stop], columns['cst_epoch'][start:stop]
+    elif hasattr(data, 'read'):
+        # TraceStore: one person at a time
+        for person in data.persons():
+            arrays = data.read(person, ['lat', 'long', 'cst_epoch'], mmap=True)
+            yield arrays['lat'], arrays['long'], arrays['cst_epoch']
+    else:
+        seconds = timestamps_s(data)
+        for start in range(0, len(data), chunk_rows):
+            chunk = data.iloc[start:start + chunk_rows]
+            yield chunk['lat'].to_numpy(), chunk['long'].to_numpy(), seconds[start:start + chunk_rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the density heatmap pyramid of a dataset')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Count every point of a dataset at every zoom level')
+    build_parser.add_argument('data', help='all_plt_data.csv, a shared dataset directory (see SharedData) '
+                                           'or a TraceStore directory')
+    build_parser.add_argument('out', help='Output .npz file')
+    build_parser.add_argument('--min-zoom', type=int, default=DEFAULT_OPTIONS['min_zoom'])
+    build_parser.add_argument('--max-zoom', type=int, default=DEFAULT_OPTIONS['max_zoom'])
+    build_parser.add_argument('--cell-px', type=int, default=DEFAULT_OPTIONS['cell_px'])
+    build_parser.add_argument('--time-bucket', choices=list(TIME_BUCKETS), default=None)
+    query_parser = subparsers.add_parser('query', help='Print the cells of a viewport')
+    query_parser.add_argument('pyramid', help='.npz file written by build')
+    query_parser.add_argument('zoom', type=int)
+    query_parser.add_argument('--bbox', default=None, help='min_long,min_lat,max_long,max_lat')
+    query_parser.add_argument('--bucket', type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        if os.path.exists(os.path.join(args.data, 'meta.json')):
+            from .SharedData import SharedTraces
+            data = SharedTraces(args.data)
+        elif os.path.isdir(args.data):
+            from .TraceStore import TraceStore
+            data = TraceStore(args.data)
+        else:
+            from .utils import load_all_plt_data
+            data = load_all_plt_data(args.data)
+        pyramid = HeatmapPyramid.build(points_from_data(data), min_zoom=args.min_zoom, max_zoom=args.max_zoom,
+                                       cell_px=args.cell_px, time_bucket=args.time_bucket)
+        pyramid.save(args.out)
+        print(f"Counted {len(pyramid)} points in {len(pyramid.levels[args.max_zoom]['count'])} cells "
+              f"at zoom {args.max_zoom} in {time.perf_counter() - start:.1f}s")
+        return
+
+    pyramid = HeatmapPyramid.load(args.pyramid)
+    loaded = time.perf_counter()
+    bbox = [float(value) for value in args.bbox.split(',')] if args.bbox else None
+    lat, long, count = pyramid.query(args.zoom, bbox, args.bucket)
+    print(f"{len(count)} cells holding {count.sum()} points (full intensity at {pyramid.scale(args.zoom):.0f})")
+    print(f"Loaded in {loaded - start:.2f}s, queried in {time.perf_counter() - loaded:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
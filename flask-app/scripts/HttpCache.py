@@ -0,0 +1,116 @@
+import gzip
+import hashlib
+import json
+
+# Brotli is optional (pip install brotli); without it responses are gzipped only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Cache-Control policy of each route. The dataset only changes between ingests, and every
+# response carries an ETag, so browsers revalidate with If-None-Match and get a 304 back
+# when nothing changed. /preprocess also depends on the map matching service, so it is
+# always revalidated.
+CACHE_CONTROL = {
+    'index': 'no-cache',
+    'dates': 'public, max-age=300',
+    'init_map': 'public, max-age=300',
+    'preprocess': 'no-cache',
+    'similar': 'public, max-age=300',
+    'edge_usage': 'public, max-age=300',
+    'heatmap': 'public, max-age=300',
+}
+# Encodings in order of preference
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Smaller bodies are sent as they are
+MIN_COMPRESS_SIZE = 1024  # bytes
+
+
+def etag(*parts) -> str:
+    """
+    Weak ETag of a response, derived from everything it depends on (e.g. the data version,
+    the person-day and the pipeline parameters). Weak, since the same response is sent
+    under several encodings.
+    """
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode())
+    return f'W/"{digest.hexdigest()[:20]}"'
+
+
+def etag_matches(if_none_match, tag) -> bool:
+    """Whether an If-None-Match header matches the ETag (weak comparison)"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or tag.removeprefix('W/') in [c.removeprefix('W/') for c in candidates]
+
+
+def accepted_encoding(accept_encoding):
+    """
+    The preferred available encoding accepted by an Accept-Encoding header, or None
+    """
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, quality = item.strip().partition(';q=')
+        try:
+            accepted[name.strip().lower()] = float(quality) if quality else 1.0
+        except ValueError:
+            continue
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding, level=None) -> bytes:
+    """
+    Compress a response body
+    @param:
+        - encoding: 'br' or 'gzip'
+        - level: compression level, defaults to a fast one for on the fly compression
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=5 if level is None else level)
+    if encoding == 'gzip':
+        # mtime=0, so the same body always gives the same bytes
+        return gzip.compress(body, compresslevel=6 if level is None else level, mtime=0)
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def precompress(body: bytes) -> dict:
+    """Compress a body at the highest levels, for storing next to cached results"""
+    levels = {'br': 11, 'gzip': 9}
+    return {encoding: compress(body, encoding, levels[encoding]) for encoding in ENCODINGS}
+
+
+def cached_response(body, tag, cache_control, if_none_match=None, accept_encoding=None, load_encoded=None):
+    """
+    Build a response with validators: 304 Not Modified when the client already has it,
+    otherwise the body compressed with the best encoding the client accepts.
+    @param:
+        - body: response body (bytes or str), or a function returning it, so it is
+          only computed when the client doesn't already have it
+        - tag: ETag of the response (see etag)
+        - cache_control: Cache-Control header (see CACHE_CONTROL)
+        - if_none_match, accept_encoding: request headers
+        - load_encoded: optional function of an encoding, returning a precompressed body or None
+    @return:
+        - status, headers (dict), body (bytes)
+    """
+    headers = {'ETag': tag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if etag_matches(if_none_match, tag):
+        return 304, headers, b''
+
+    encoding = accepted_encoding(accept_encoding)
+    encoded = load_encoded(encoding) if encoding and load_encoded else None
+    if encoded is None:
+        if callable(body):
+            body = body()
+        if isinstance(body, str):
+            body = body.encode()
+        if encoding and len(body) >= MIN_COMPRESS_SIZE:
+            encoded = compress(body, encoding)
+        else:
+            return 200, headers, body
+    headers['Content-Encoding'] = encoding
+    return 200, headers, encoded
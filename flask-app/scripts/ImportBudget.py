@@ -0,0 +1,68 @@
+import argparse
+import subprocess
+import sys
+
+# Cold-start budgets for the modules imported when a worker starts. Each entry holds the
+# maximum cumulative import time in milliseconds, and heavy modules which must stay lazy.
+BUDGETS = {
+    'app': {
+        'max_ms': 300,
+        'forbidden': ['pandas', 'numpy', 'geopandas', 'shapely', 'pykalman', 'folium', 'requests'],
+    },
+    'scripts.Pipeline': {
+        'max_ms': 800,
+        'forbidden': ['geopandas', 'shapely', 'pykalman', 'folium', 'requests'],
+    },
+}
+
+
+def measure_importtime(module, python=sys.executable):
+    """
+    Import a module in a fresh interpreter with `python -X importtime`
+    @return:
+        - dict of {imported module name: (self_us, cumulative_us)}
+    """
+    result = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    timings = {}
+    for line in result.stderr.splitlines():
+        # Lines look like 'import time:       123 |        456 |   package.module'
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def check_budget(module, max_ms, forbidden, top=10):
+    """
+    Check a module's cold-start import time and lazily-imported dependencies against its budget
+    @return:
+        - ok: whether the module is within budget
+    """
+    timings = measure_importtime(module)
+    total_ms = timings[module][1] / 1000
+    heavy = [name for name in forbidden if name in timings]
+    ok = total_ms <= max_ms and not heavy
+
+    print(f"{module}: {total_ms:.0f} ms (budget {max_ms} ms) {'OK' if ok else 'OVER BUDGET'}")
+    if heavy:
+        print(f"  eagerly imports: {', '.join(heavy)}")
+    slowest = sorted(timings.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    for name, (self_us, _) in slowest:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check cold-start import times against their budgets')
+    parser.add_argument('modules', nargs='*', default=list(BUDGETS), help='Modules to check (default: all)')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list')
+    args = parser.parse_args()
+
+    results = [check_budget(module, top=args.top, **BUDGETS[module]) for module in args.modules]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import argparse
+import hashlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .Catalog import Catalog, FILENAME as CATALOG_FILENAME
+from .TraceStore import TraceStore, EXCEL_EPOCH_OFFSET_DAYS
+
+# Every .plt file starts with 6 header lines, followed by rows of
+# lat, long, 0, altitude (feet), date_numb_days, date, time
+PLT_HEADER_LINES = 6
+PLT_COLUMNS = {0: 'lat', 1: 'long', 3: 'altitude', 4: 'date_numb_days'}
+# Parsed rows of a person held in memory before they're appended to the store as one part
+FLUSH_ROWS = 5_000_000
+
+_known_digests = set()
+
+
+def find_plt_files(geolife_dir):
+    """
+    Walk a Geolife-style directory tree (<geolife_dir>/<person>/Trajectory/*.plt)
+    @return:
+        - list of (person, path) tuples, sorted by person then path
+    """
+    plt_files = []
+    for person_dir in sorted(os.listdir(geolife_dir)):
+        trajectory_dir = os.path.join(geolife_dir, person_dir, 'Trajectory')
+        if not person_dir.isdigit() or not os.path.isdir(trajectory_dir):
+            continue
+        for filename in sorted(os.listdir(trajectory_dir)):
+            if filename.lower().endswith('.plt'):
+                plt_files.append((int(person_dir), os.path.join(trajectory_dir, filename)))
+    return plt_files
+
+
+def parse_plt(content: bytes) -> dict:
+    """
+    Parse the raw bytes of a .plt file into column arrays
+    @return:
+        - dict with 'lat', 'long', 'altitude' and 'cst_epoch' arrays
+    """
+    plt_df = pd.read_csv(io.BytesIO(content), skiprows=PLT_HEADER_LINES, header=None,
+                         usecols=list(PLT_COLUMNS), dtype=np.float64, engine='c')
+    plt_df.columns = [PLT_COLUMNS[col] for col in plt_df.columns]
+
+    # Convert times once, straight from the fractional day count instead of the date/time strings
+    days = plt_df['date_numb_days'].to_numpy()
+    cst_epoch = np.rint((days - EXCEL_EPOCH_OFFSET_DAYS) * 86400).astype(np.int64)
+    return {
+        'lat': plt_df['lat'].to_numpy(),
+        'long': plt_df['long'].to_numpy(),
+        'altitude': plt_df['altitude'].to_numpy(dtype=np.float32),
+        'cst_epoch': cst_epoch,
+    }
+
+
+def _init_worker(known_digests):
+    global _known_digests
+    _known_digests = known_digests
+
+
+def _ingest_file(person_path):
+    """Worker: hash a .plt file and parse it unless its content was already ingested"""
+    person, path = person_path
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+    if digest in _known_digests:
+        return person, path, digest, None
+    return person, path, digest, parse_plt(content)
+
+
+def ingest(geolife_dir, store_dir, workers=None):
+    """
+    Parse every new .plt file under geolife_dir in parallel and append them to the store as
+    they come in, one part per person (or per FLUSH_ROWS rows of a person), so only the files
+    of the person being read are held in memory. Then update the store's catalog of
+    person-days (see Catalog)
+    @param:
+        - geolife_dir: directory containing one numbered folder per person
+        - store_dir: root of the TraceStore
+        - workers: number of worker processes (default: number of CPUs)
+    @return:
+        - store: the updated TraceStore
+        - n_new_files: number of files appended to the store
+    """
+    store = TraceStore(store_dir)
+    plt_files = find_plt_files(geolife_dir)
+
+    pending = []  # parsed column dicts of the current person, not appended yet
+    pending_sources = {}  # digest -> path of the pending files
+    pending_rows = 0
+    appended_persons = []
+    n_new_files = 0
+
+    def flush(person):
+        nonlocal pending, pending_sources, pending_rows, n_new_files
+        if not pending:
+            return
+        columns = {col: np.concatenate([p[col] for p in pending]) for col in pending[0]}
+        store.append(person, columns, sources=pending_sources)
+        print(f"Person {person}: appended {len(columns['cst_epoch'])} rows from {len(pending)} files")
+        if person not in appended_persons:
+            appended_persons.append(person)
+        n_new_files += len(pending_sources)
+        pending, pending_sources, pending_rows = [], {}, 0
+
+    chunksize = max(1, len(plt_files) // (8 * (workers or os.cpu_count() or 1)))
+    pending_person = None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(store.source_digests(),)) as executor:
+        # Files come back in order, so all the files of a person come one after the other
+        for person, path, digest, columns in executor.map(_ingest_file, plt_files, chunksize=chunksize):
+            if person != pending_person:
+                flush(pending_person)
+                pending_person = person
+            # Skip files already in the store, or duplicated within this run
+            if columns is None or store.has_source(digest) or digest in pending_sources:
+                continue
+            pending.append(columns)
+            pending_sources[digest] = path
+            pending_rows += len(columns['cst_epoch'])
+            if pending_rows >= FLUSH_ROWS:
+                flush(person)
+        flush(pending_person)
+
+    # Only the persons appended to are read again, unless the store has no catalog yet
+    catalog = Catalog.find(store_dir)
+    if catalog is None:
+        catalog = Catalog.build(store)
+        catalog.save(os.path.join(store_dir, CATALOG_FILENAME))
+    elif appended_persons:
+        catalog.update_persons(store, appended_persons)
+        catalog.save(os.path.join(store_dir, CATALOG_FILENAME))
+
+    return store, n_new_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest raw Geolife .plt files into the trace store')
+    parser.add_argument('geolife_dir', help='Geolife Data/ directory, with one folder per person')
+    parser.add_argument('store_dir', help='Root directory of the trace store')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--export-csv', default=None,
+                        help='Also rebuild an all_plt_data.csv style export at this path')
+    args = parser.parse_args()
+
+    store, n_new_files = ingest(args.geolife_dir, args.store_dir, workers=args.workers)
+    print(f"Ingested {n_new_files} new files, store is at version {store.version}")
+
+    if args.export_csv:
+        store.read_frame(legacy=True).to_csv(args.export_csv, index=False)
+        print(f"Exported {args.export_csv}")
+
+
+if __name__ == '__main__':
+    main()
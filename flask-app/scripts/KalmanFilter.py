@@ -1,21 +1,23 @@
 import pandas as pd
 import numpy as np
-from pykalman import KalmanFilter
 
-#TODO:
-# maybe average building height as a parameter
-# rolling average of building height, address lookup for each gps point, 
-# adding building height of nearest building to rolling average
+# Building height and density around each fix are added by Buildings.annotate, as an
+# 'obs_noise_scale' column which kalman_filter uses for the observation noise of each timestep
 
-def kalman_filter(gps_data: pd.DataFrame, n_iter=5):
+
+def kalman_filter(gps_data: pd.DataFrame, n_iter=5, noise_col='obs_noise_scale'):
     """ 
     Apply Kalman Filter to 'lat' and 'long' columns of the input df
     @param: 
         - gps_data: pd.DataFrame with 'lat' and 'long' columns
+        - noise_col: optional column scaling the observation noise variance of each
+          timestep (see Buildings.annotate), used if gps_data has it
     @return: 
         - The gps_data with 2 additional columns: 'lat_filtered' and 'long_filtered'
     """
 
+    from pykalman import KalmanFilter  # imported lazily, pykalman is slow to import
+
     if len(gps_data) < 2:
         print("note: df has <2 rows, skipping kalman filter")
         gps_data['kalman_lat'] = gps_data['lat']
@@ -31,15 +33,23 @@ def kalman_filter(gps_data: pd.DataFrame, n_iter=5):
                          [0, 1]]
     observation_matrix = [[1, 0], 
                           [0, 1]]
+    # Use the 'lat' and 'long' columns as the observed values
+    measurements = np.asarray(gps_data[['lat', 'long']])
+
+    if noise_col in gps_data.columns:
+        # Observation noise with covariance R * scale_t is the same as observing
+        # z_t / sqrt(scale_t) through H / sqrt(scale_t) with covariance R, which EM can still
+        # estimate. (pykalman ignores all but the first matrix of a per-timestep
+        # observation_covariance, so it can't be passed directly.)
+        weights = 1 / np.sqrt(gps_data[noise_col].to_numpy(dtype=np.float64))
+        observation_matrix = np.eye(2)[None] * weights[:, None, None]
+        measurements = measurements * weights[:, None]
+
     kf1 = KalmanFilter(transition_matrices=transition_matrix,
                       observation_matrices=observation_matrix,
                       initial_state_mean=initial_state_mean, 
                       n_dim_obs=2)
 
-    # Use the 'lat' and 'long' columns as the observed values
-    measurements = np.asarray(gps_data[['lat', 'long']])
-
-    
     kf1 = kf1.em(measurements, n_iter=n_iter) # Use expectation-maximization to estimate the initial parameters
     (smoothed_state_means, smoothed_state_covariances) = kf1.smooth(measurements) # Apply Kalman smoothing
 
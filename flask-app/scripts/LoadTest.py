@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+# Form of the preprocessing request sent for every person-day (see app.preprocess_params)
+DEFAULT_FORM = {
+    'kalmanFilter': 'true',
+    'n_iter': '5',
+    'timeSegment': '60',
+    'mapMatch': 'true',
+}
+
+
+async def _worker(client, url, queue, form, latencies, errors):
+    while True:
+        try:
+            person, date = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        try:
+            response = await client.post(url, data={'person': person, 'date': date, **form})
+            if response.status_code != 200:
+                errors.append(f"Person {person}, {date}: {response.status_code}")
+        except Exception as e:
+            errors.append(f"Person {person}, {date}: {e}")
+        latencies.append(time.perf_counter() - start)
+
+
+async def load_test(base_url, person_days, concurrency=16, form=None, timeout=600):
+    """
+    Send one /preprocess request per person-day from `concurrency` concurrent clients
+    @return:
+        - results: dict with the throughput (requests/s), latency percentiles (s) and errors
+    """
+    import httpx
+
+    queue = asyncio.Queue()
+    for person_day in person_days:
+        queue.put_nowait(person_day)
+    latencies, errors = [], []
+    url = base_url.rstrip('/') + '/preprocess'
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[_worker(client, url, queue, {**DEFAULT_FORM, **(form or {})}, latencies, errors)
+                               for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50': float(np.percentile(latencies, 50)),
+        'p95': float(np.percentile(latencies, 95)),
+        'errors': errors,
+    }
+
+
+async def _person_days(base_url, persons):
+    """All (person, date) pairs of the given persons, from the app's /dates endpoint"""
+    import httpx
+
+    async with httpx.AsyncClient() as client:
+        person_days = []
+        for person in persons:
+            response = await client.get(f"{base_url.rstrip('/')}/dates/{person}")
+            person_days.extend((person, date) for date in response.json())
+    return person_days
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure /preprocess throughput under concurrent users')
+    parser.add_argument('base_url', help='e.g. http://127.0.0.1:5000')
+    parser.add_argument('--persons', type=int, nargs='+', required=True)
+    parser.add_argument('--requests', type=int, default=64, help='Total number of requests, cycling over person-days')
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    person_days = asyncio.run(_person_days(args.base_url, args.persons))
+    person_days = [person_days[i % len(person_days)] for i in range(args.requests)]
+    results = asyncio.run(load_test(args.base_url, person_days, args.concurrency))
+    print(f"{results['requests']} requests in {results['seconds']:.1f}s: {results['throughput']:.2f} req/s, "
+          f"p50 {results['p50']:.2f}s, p95 {results['p95']:.2f}s, {len(results['errors'])} errors")
+    for error in results['errors'][:10]:
+        print(error)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
+import numpy as np
 import pandas as pd
-import requests
 import json
+from .Matcher import Matcher
+from .Polyline import decode, decode_many, encode, linestrings
+from .utils import timestamps_s
 
-class MapMatch:
+class MapMatch(Matcher):
     HEADERS = {'Content-Type': 'application/json'}
     URL = 'http://localhost:8002/trace_route'
+    ATTRIBUTES_URL = 'http://localhost:8002/trace_attributes'
+    # Attributes requested from trace_attributes (see make_edgedf / make_edge_tracedf)
+    EDGE_ATTRIBUTES = ['edge.id', 'edge.way_id', 'edge.length', 'edge.speed', 'edge.names',
+                       'edge.begin_shape_index', 'edge.end_shape_index',
+                       'matched.point', 'matched.type', 'matched.edge_index', 'matched.distance_along_edge',
+                       'shape']
     def __init__(self):
         """
         MapMatch is a utility class encapsulating all functions required for 
@@ -13,13 +22,16 @@ class MapMatch:
         pass
 
     @staticmethod
-    def prepare_meili(person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}):
+    def prepare_meili(person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}, steps=True):
         """
-        Prepare a person_df for map matching with Meili
+        Prepare a person_df for map matching with Meili, without modifying it. Coordinates are
+        sent as a precision 6 encoded polyline and times as the durations between points
         @param:
             - person_df: a pandas DataFrame containing the person's data
             - colnames: a list of the column names for latitude, longitude, and time
              - match_options: a dictionary of user-specified options to override defaults
+            - steps: request the legs' steps (see make_matchdf), or only the tracepoints
+              (see make_tracedf), which skips building maneuvers and instructions
         @return:
             - request_body: a JSON string to be sent to the Meili API
         """
@@ -32,50 +44,166 @@ class MapMatch:
             'interpolation_distance': 10,
             'shape_match': 'map_snap',
             'costing': 'auto',
-            'format': 'osrm'
+            'format': 'osrm',
         }
-        meili_options.update(match_options)  # Merge user-specified options into the default options
+        if not steps:
+            meili_options['directions_type'] = 'none'  # Meili then leaves legs[].steps empty
+        # Merge user-specified options into the default options (empty form fields keep the defaults)
+        meili_options.update({k: v for k, v in match_options.items() if v is not None and v != ''})
 
         lat_col, long_col, time_col = colnames
-        person_df['time'] = pd.to_datetime(person_df[time_col]).dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-        prepared_df = person_df[[long_col, lat_col, 'time']].copy()
-        prepared_df.columns = ['lon', 'lat', 'time']
-        
-        meili_coordinates = prepared_df.to_json(orient='records')
+        seconds = timestamps_s(person_df, time_col)
         request_body_dict = {
-            "shape": json.loads(meili_coordinates),  # Convert string to list of dicts
-            **meili_options  # Merge match_options into the request body
+            'encoded_polyline': encode(person_df[lat_col], person_df[long_col], precision=6),
+            'begin_time': int(seconds[0]) if len(seconds) else 0,
+            'durations': np.diff(seconds).tolist(),
+            **meili_options
         }
-        request_body = json.dumps(request_body_dict)  # Convert the entire request body to a JSON string
-        return request_body
+        return json.dumps(request_body_dict)
 
+    @staticmethod
+    def prepare_trace_attributes(person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}):
+        """
+        Prepare a person_df for Meili's trace_attributes, which returns the road network edges
+        each point was matched to instead of an OSRM-style route
+        @return:
+            - request_body: a JSON string to be sent to the trace_attributes API
+        """
+        request_body_dict = json.loads(MapMatch.prepare_meili(person_df, colnames, match_options))
+        for key in ('format', 'directions_type'):
+            request_body_dict.pop(key, None)
+        request_body_dict['filters'] = {'attributes': MapMatch.EDGE_ATTRIBUTES, 'action': 'include'}
+        return json.dumps(request_body_dict)
 
     @classmethod
-    def meili_match(cls, person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}):
+    def meili_match(cls, person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}, steps=True):
         """
         Match a person's data to the road network using Meili
         @param:
             - person_df: a pandas DataFrame containing the person's data
             - colnames: a list of the column names for latitude, longitude, and time
+            - steps: request the legs' steps, needed by make_matchdf (see prepare_meili)
         @return:
             - matched_df: a pandas DataFrame containing the matched data
         """
-        request_body = MapMatch.prepare_meili(person_df, colnames, match_options)
+        import requests  # imported lazily, only needed when map matching
+
+        request_body = MapMatch.prepare_meili(person_df, colnames, match_options, steps)
         response = requests.post(cls.URL, data=request_body, headers=cls.HEADERS)
         if response.status_code == 200:
             return response.json()
         else:
             raise Exception(f"Failed to match map: {response.status_code}\n{response.text}")
-        
+
+    @classmethod
+    def match(cls, person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}):
+        """
+        Matcher interface: match person_df with Meili and return its trace_df, requesting
+        only the tracepoints
+        """
+        meili_json = cls.meili_match(person_df, colnames, match_options, steps=False)
+        return MapMatch.make_tracedf(meili_json, person_df)
+
+    @classmethod
+    async def match_async(cls, client, person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}):
+        """
+        Like match(), but awaits the Meili request instead of blocking on it
+        @param:
+            - client: an httpx.AsyncClient, shared between requests
+        """
+        request_body = MapMatch.prepare_meili(person_df, colnames, match_options, steps=False)
+        response = await client.post(cls.URL, content=request_body, headers=cls.HEADERS)
+        if response.status_code != 200:
+            raise Exception(f"Failed to match map: {response.status_code}\n{response.text}")
+        return MapMatch.make_tracedf(response.json(), person_df)
+
+    @classmethod
+    def match_edges(cls, person_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}):
+        """
+        Match person_df with Meili's trace_attributes, keeping the road edge of every point
+        @return:
+            - edge_trace_df: pd.DataFrame with one row per input point (see make_edge_tracedf)
+            - edge_df: pd.DataFrame with one row per traversed edge (see make_edgedf)
+        """
+        import requests  # imported lazily, only needed when map matching
+
+        request_body = MapMatch.prepare_trace_attributes(person_df, colnames, match_options)
+        response = requests.post(cls.ATTRIBUTES_URL, data=request_body, headers=cls.HEADERS)
+        if response.status_code != 200:
+            raise Exception(f"Failed to match edges: {response.status_code}\n{response.text}")
+        attributes_json = response.json()
+        return MapMatch.make_edge_tracedf(attributes_json, person_df), MapMatch.make_edgedf(attributes_json)
+
+    @staticmethod
+    def edge_ids(edges):
+        """
+        Integer ids of trace_attributes edges: Valhalla's GraphId ('id') when it is returned,
+        otherwise the OSM way id, which is shared by all the edges of a way
+        """
+        return np.array([edge.get('id', edge.get('way_id', -1)) for edge in edges], dtype=np.int64)
+
+    @staticmethod
+    def make_edgedf(attributes_json):
+        """
+        Create a dataframe of the edges of a trace_attributes response, with their geometry
+        @return:
+            - edge_df: pd.DataFrame of edge_id, way_id, edge_name, length_m, speed_kmh and
+              coords (list of [long, lat] along the edge, cut from the matched shape)
+        """
+        edges = attributes_json.get('edges', [])
+        shape_lat, shape_long = decode(attributes_json.get('shape', ''), precision=6)
+        coords = []
+        for edge in edges:
+            begin, end = edge.get('begin_shape_index', 0), edge.get('end_shape_index', 0)
+            coords.append(np.column_stack([shape_long[begin:end + 1], shape_lat[begin:end + 1]]).round(6).tolist())
+        return pd.DataFrame({
+            'edge_id': MapMatch.edge_ids(edges),
+            'way_id': np.array([edge.get('way_id', -1) for edge in edges], dtype=np.int64),
+            'edge_name': [(edge.get('names') or [''])[0] for edge in edges],
+            # trace_attributes reports kilometers and km/h by default
+            'length_m': np.array([edge.get('length', np.nan) for edge in edges], dtype=np.float64) * 1000,
+            'speed_kmh': np.array([edge.get('speed', np.nan) for edge in edges], dtype=np.float64),
+            'coords': coords,
+        })
+
     @staticmethod
-    def make_matchdf(meili_json):
+    def make_edge_tracedf(attributes_json, person_df):
+        """
+        Create a dataframe of the matched point of every input coordinate and the id of the
+        edge it lies on (-1 if it wasn't matched)
+        """
+        points = attributes_json.get('matched_points', [])
+        edge_ids = MapMatch.edge_ids(attributes_json.get('edges', []))
+        edge_index = np.array([point.get('edge_index', -1) if point.get('type') != 'unmatched' else -1
+                               for point in points], dtype=np.int64)
+        # Valhalla returns an out of range edge_index for points it couldn't place on an edge
+        on_edge = (edge_index >= 0) & (edge_index < len(edge_ids))
+        trace_df = pd.DataFrame({
+            'trace_index': np.arange(len(points)),
+            'matched_lat': [point.get('lat') for point in points],
+            'matched_long': [point.get('lon') for point in points],
+            'match_type': [point.get('type', '') for point in points],
+            'edge_index': np.where(on_edge, edge_index, -1),
+            'edge_id': np.where(on_edge, edge_ids[np.where(on_edge, edge_index, 0)] if len(edge_ids) else -1, -1),
+            'distance_along_edge': [point.get('distance_along_edge') for point in points],
+        })
+        for col in ['cst_datetime', 'cst_epoch', 'date', 'time']:
+            if col in person_df.columns:
+                trace_df[col] = person_df[col].to_numpy()
+        return trace_df
+
+    @staticmethod
+    def make_matchdf(meili_json, geometry=False):
         """
         Create a dataframe of 'matchings' array from meili json response which includes 
         bearing / intersection / duration / distance / transportation type information
         @param:
-            - meili_json: a json response from meili API
+            - meili_json: a json response from meili API, requested with steps (the default of
+              meili_match, unlike match() which skips them)
+            - geometry: decode every 'step_geometry' polyline into a LineString
         @return:   
-            - matching_df: pd.DataFrame containing matching information
+            - matching_df: pd.DataFrame containing matching information, or a gpd.GeoDataFrame
+              of the step LineStrings if geometry is True
         """
         matching_rows = []
         for matching_index, matching in enumerate(meili_json['matchings']):
@@ -129,7 +257,26 @@ class MapMatch:
 
         # Create a DataFrame from the list of rows
         matching_df = pd.DataFrame(matching_rows)
+        if geometry:
+            matching_df = MapMatch.step_geometries(matching_df)
         return matching_df
+
+    @staticmethod
+    def step_geometries(matching_df):
+        """
+        Decode the step geometries of a make_matchdf dataframe all at once (Meili encodes
+        them with precision 6), and build their LineStrings from the flat coordinates. A response
+        requested without steps (see prepare_meili) has no steps to decode
+        @return:
+            - gpd.GeoDataFrame of matching_df with a LineString geometry per step (None if
+              the step has less than 2 coordinates)
+        """
+        import geopandas as gpd
+
+        polylines = matching_df['step_geometry'] if 'step_geometry' in matching_df.columns else []
+        lat, long, offsets = decode_many(polylines, precision=6)
+        geometry = gpd.GeoSeries(linestrings(lat, long, offsets), index=matching_df.index, crs='EPSG:4326')
+        return gpd.GeoDataFrame(matching_df, geometry=geometry)
     
     @staticmethod
     def make_tracedf(meili_json, person_df):
@@ -149,9 +296,6 @@ class MapMatch:
                     'trace_distance_from_start': None,
                     'trace_name': None,
                     'trace_waypoint_index': None,
-                    'cst_datetime': person_df.iloc[trace_index]['cst_datetime'],
-                    'date': person_df.iloc[trace_index]['date'],
-                    'time': person_df.iloc[trace_index]['time']
                 }
             else:
                 trace_row = {
@@ -163,11 +307,12 @@ class MapMatch:
                     'trace_distance_from_start': tracepoint.get('distance_from_start', 0),
                     'trace_name': tracepoint.get('name', ''),
                     'waypoint_index': tracepoint.get('waypoint_index', None),
-                    'cst_datetime': person_df.iloc[trace_index]['cst_datetime'],
-                    'date': person_df.iloc[trace_index]['date'],
-                    'time': person_df.iloc[trace_index]['time']
                 }
             trace_rows.append(trace_row)
 
         trace_df = pd.DataFrame(trace_rows)
+        # Tracepoints line up with the input rows, so copy their times column-wise
+        for col in ['cst_datetime', 'cst_epoch', 'date', 'time']:
+            if col in person_df.columns:
+                trace_df[col] = person_df[col].to_numpy()
         return trace_df
\ No newline at end of file
@@ -0,0 +1,43 @@
+import abc
+
+import pandas as pd
+
+# Columns of every matcher's trace_df, in order (see MapMatch.make_tracedf)
+TRACE_COLUMNS = ['trace_index', 'matchings_index', 'matched_lat', 'matched_long', 'alternatives_count',
+                 'trace_distance_from_start', 'trace_name', 'waypoint_index', 'cst_datetime', 'date', 'time']
+
+
+class Matcher(abc.ABC):
+    """
+    Matcher is the interface shared by all map matching backends. Every backend takes
+    a DataFrame of GPS points and returns a trace_df with one row per input point,
+    holding the TRACE_COLUMNS ('matched_lat' / 'matched_long' are None if unmatched).
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Backends are used as classes and never instantiated, so check them when they're defined
+        missing = sorted(name for name in Matcher.__abstractmethods__
+                         if getattr(getattr(cls, name), '__isabstractmethod__', False))
+        if missing:
+            raise TypeError(f"Matcher backend {cls.__name__} doesn't implement {', '.join(missing)}")
+
+    @classmethod
+    @abc.abstractmethod
+    def match(cls, gps_df: pd.DataFrame, colnames=['lat', 'long', 'cst_datetime'], match_options={}) -> pd.DataFrame:
+        """Match gps_df, see the class docstring"""
+
+
+def get_matcher(name: str = 'meili'):
+    """
+    Get a matcher class by name
+    @param:
+        - name: 'meili' (Valhalla's Meili, see MapMatch) or 'osrm' (see OSRMMatch)
+    """
+    # Imported here, as both backends import this module
+    if name == 'meili':
+        from .MapMatch import MapMatch
+        return MapMatch
+    if name == 'osrm':
+        from .OSRMMatch import OSRMMatch
+        return OSRMMatch
+    raise ValueError(f"Unknown matcher: {name}")
@@ -0,0 +1,246 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# Parameters materialized by default: the Kalman filtered, time segmented and Meili
+# matched layers, as requested by the app with a 60s time segment and other fields left empty
+DEFAULT_PARAMS = {
+    'kalman_filter': True,
+    'n_iter': 5,
+    'time_segment': 60,
+    'map_match': True,
+}
+
+
+def _normalize(value):
+    """Normalize parameter values so the same settings always give the same key"""
+    if isinstance(value, dict):
+        # Empty form fields fall back to the defaults, so they're the same as missing ones
+        return {k: _normalize(v) for k, v in value.items() if v is not None and v != ''}
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def params_key(params: dict) -> str:
+    """
+    Key of a full set of pipeline parameters (see Pipeline.params). Form values ('50'),
+    ints (50) and floats (50.0) of the same setting all give the same key.
+    """
+    normalized = json.dumps(_normalize(params), sort_keys=True, default=str)
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def data_version(path):
+    """
+    Version of a CSV or shared dataset as the app serves it (see app.data_version): the size
+    and modification time of the CSV, or of the shared dataset's meta.json
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'meta.json')
+    stat = os.stat(path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def read_valid_walking_dates(path):
+    """
+    Read valid_walking_dates.csv, where each person's dates are stored as a stringified
+    numpy array, e.g. "['2008-06-18' '2008-06-13' ...]"
+    @return:
+        - person_days: list of (person, 'YYYY-MM-DD') tuples
+    """
+    import pandas as pd
+
+    valid_dates = pd.read_csv(path)
+    person_days = []
+    for person, dates in valid_dates[['person', 'date']].itertuples(index=False):
+        for date in sorted(re.findall(r'\d{4}-\d{2}-\d{2}', dates)):
+            person_days.append((int(person), date))
+    return person_days
+
+
+class MaterializedStore:
+    """
+    MaterializedStore holds precomputed responses of the app, exactly as they are served,
+    so they can be sent without loading the dataset or running the pipeline.
+
+    Layout:
+        <root>/init_map/<person>/<date>.json   /init_map response (the original layer)
+        <root>/<params key>/params.json   the parameters of this set of results
+        <root>/<params key>/<person>/<date>.json   /preprocess response for these parameters
+    Every response is also stored precompressed next to it (<date>.json.gz, and .json.br
+    if brotli is installed), see HttpCache, and with the version of the data it was computed
+    from (<date>.json.version, see data_version), so responses of older data aren't served.
+    """
+    SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key, person, date):
+        return os.path.join(self.root, key, str(person), f'{date}.json')
+
+    def load(self, key, person, date, encoding=None, version=None):
+        """
+        The stored response body, or None if it wasn't materialized
+        @param:
+            - encoding: 'gzip' or 'br' to get the precompressed body instead
+            - version: data version the body must have been computed from, None to accept any
+        """
+        path = self.path(key, person, date)
+        if version is not None and self.version(key, person, date) != version:
+            return None
+        if encoding:
+            path += self.SUFFIXES[encoding]
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def version(self, key, person, date):
+        """The data version of a stored response, or None if it has none"""
+        try:
+            with open(self.path(key, person, date) + '.version') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, person, date, body: str, version=None):
+        from .HttpCache import precompress
+
+        path = self.path(key, person, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Drop the version first, so the bodies are never taken for those of another version
+        if os.path.exists(path + '.version'):
+            os.remove(path + '.version')
+        body = body.encode()
+        encoded = {self.SUFFIXES[encoding]: data for encoding, data in precompress(body).items()}
+        # Write the compressed bodies first, so they're never older than the plain one
+        for suffix, data in [*encoded.items(), ('', body)]:
+            with open(path + suffix + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + suffix + '.tmp', path + suffix)
+        # Drop bodies of encodings no longer produced (e.g. brotli was uninstalled)
+        for suffix in set(self.SUFFIXES.values()) - set(encoded):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        if version is not None:
+            with open(path + '.version.tmp', 'w') as f:
+                f.write(version)
+            os.replace(path + '.version.tmp', path + '.version')
+
+    def save_params(self, key, params):
+        os.makedirs(os.path.join(self.root, key), exist_ok=True)
+        with open(os.path.join(self.root, key, 'params.json'), 'w') as f:
+            json.dump(params, f, indent=2, default=str)
+
+
+def _materialize_task(task):
+    """Worker: compute and store both responses of one person-day"""
+    return materialize_person_day(*task)
+
+
+def materialize_person_day(root, key, params, person, date, person_df, version=None):
+    """
+    Compute and store both responses of one person-day
+    @param:
+        - version: data_version of the dataset person_df comes from, stored with the responses
+    @return:
+        - whether the pipeline succeeded (the /init_map response is stored either way)
+    """
+    from .Pipeline import Pipeline
+
+    store = MaterializedStore(root)
+    original_geojson = Pipeline.layer_geojson(person_df, 'original')
+    # /init_map responds with the GeoJSON as a string
+    store.save('init_map', person, date, json.dumps(json.dumps(original_geojson)), version)
+    try:
+        layers = Pipeline(params).run(person_df)
+    except Exception as e:
+        print(f"Person {person}, {date}: {e}")
+        return False
+    store.save(key, person, date, json.dumps(Pipeline.to_geojson(layers)), version)
+    return True
+
+
+def materialize(data, person_days, root, params=None, workers=None, catalog=None, version=None):
+    """
+    Precompute the app's responses for every person-day across a process pool
+    @param:
+        - data: all_plt_data df, or SharedTraces
+        - person_days: list of (person, 'YYYY-MM-DD') tuples
+        - root: directory of the MaterializedStore
+        - params: pipeline parameters, DEFAULT_PARAMS if not given
+        - workers: number of worker processes
+        - catalog: optional Catalog of data, to run the largest person-days first
+        - version: data_version of data, the app only serves responses of the version it serves
+    @return:
+        - key: params_key of the materialized parameters
+    """
+    from .Pipeline import Pipeline
+    from .utils import filter_person_and_date
+
+    params = Pipeline(params or DEFAULT_PARAMS).params
+    key = params_key(params)
+    MaterializedStore(root).save_params(key, params)
+    if catalog is not None:
+        person_days = catalog.largest_first(person_days)
+
+    def tasks():
+        for person, date in person_days:
+            if hasattr(data, 'person_day'):
+                person_df = data.person_day(person, date, legacy=False)
+            else:
+                person_df = filter_person_and_date(data, person, date)
+            if len(person_df):
+                yield root, key, params, person, date, person_df, version
+
+    n_done = n_failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for done in executor.map(_materialize_task, tasks()):
+            n_done += done
+            n_failed += not done
+    print(f"Materialized {n_done} person-days under {os.path.join(root, key)} ({n_failed} failed)")
+    return key
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the app responses of every valid walking person-day')
+    parser.add_argument('data', help='all_plt_data.csv, or a shared dataset directory (see SharedData)')
+    parser.add_argument('out_dir', help='Directory of the materialized results')
+    parser.add_argument('--dates', default='../notebooks/data/valid_walking_dates.csv', help='valid_walking_dates.csv')
+    parser.add_argument('--params', default=None, help='JSON file of pipeline parameters, instead of the defaults')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--catalog', default=None,
+                        help='Catalog of the data (see Catalog), the catalog.npz of a shared dataset by default')
+    args = parser.parse_args()
+
+    params = None
+    if args.params:
+        with open(args.params) as f:
+            params = json.load(f)
+    if os.path.isdir(args.data):
+        from .SharedData import SharedTraces
+        data = SharedTraces(args.data)
+    else:
+        from .utils import load_all_plt_data
+        data = load_all_plt_data(args.data)
+    from .Catalog import Catalog
+    catalog = Catalog.load(args.catalog) if args.catalog else Catalog.find(args.data)
+    materialize(data, read_valid_walking_dates(args.dates), args.out_dir, params, args.workers, catalog,
+                data_version(args.data))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+from .Matcher import Matcher
+from .Polyline import encode
+from .utils import timestamps_s
+
+
+class OSRMMatch(Matcher):
+    """
+    OSRMMatch map matches with the match service of osrm-routed, as an alternative to
+    Meili which is much faster on long traces. Traces are split into overlapping batches
+    which are sent concurrently over a pooled HTTP session, then merged back into a
+    single trace_df with one row per input point.
+    """
+    URL = 'http://127.0.0.1:9000/match/v1/foot/'
+    BATCH_SIZE = 100  # osrm-routed's default --max-matching-size
+    OVERLAP = 10  # points shared by consecutive batches, so matchings don't break at batch edges
+    MAX_WORKERS = 8
+    DEFAULT_RADIUS = 50  # m, used when no gps_accuracy is given
+
+    _session = None
+    _session_lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        """Shared requests.Session, keeping up to MAX_WORKERS connections alive"""
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    import requests  # imported lazily, only needed when map matching
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.MAX_WORKERS)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    cls._session = session
+        return cls._session
+
+    @classmethod
+    def batch_ranges(cls, n):
+        """
+        Split n points into overlapping batches
+        @return:
+            - list of (start, stop, owned_start, owned_stop): the rows sent in the batch, and the
+              rows whose tracepoints are taken from it (the earlier batch owns the first half
+              of every overlap, the later batch the second half)
+        """
+        step = cls.BATCH_SIZE - cls.OVERLAP
+        starts = list(range(0, max(n - cls.OVERLAP, 1), step))
+        ranges = []
+        for i, start in enumerate(starts):
+            stop = min(start + cls.BATCH_SIZE, n)
+            owned_start = 0 if i == 0 else start + cls.OVERLAP // 2
+            owned_stop = n if i == len(starts) - 1 else starts[i + 1] + cls.OVERLAP // 2
+            ranges.append((start, stop, owned_start, owned_stop))
+        return ranges
+
+    @classmethod
+    def request_batch(cls, lat, long, seconds, radius):
+        """
+        Match one batch of points
+        @return:
+            - response json, or None if OSRM found no matching at all
+        """
+        params = {
+            'timestamps': ';'.join(map(str, seconds)),
+            'radiuses': ';'.join([str(radius)] * len(lat)),
+            'gaps': 'split',
+            'tidy': 'false',
+            'overview': 'false',
+        }
+        # Polylines may contain '?', '\\' and other characters which aren't valid in a URL path
+        url = f"{cls.URL}polyline({quote(encode(lat, long, precision=5), safe='')})"
+        response = cls.session().get(url, params=params)
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code == 400 and response.json().get('code') == 'NoMatch':
+            return None
+        raise Exception(f"Failed to match map: {response.status_code}\n{response.text}")
+
+    @classmethod
+    def match(cls, gps_df, colnames=['lat', 'long', 'cst_datetime'], match_options={}):
+        """
+        Match gps_df to the road network using OSRM, without modifying it
+        @param:
+            - gps_df: time-ordered pd.DataFrame of GPS points
+            - colnames: a list of the column names for latitude, longitude, and time
+            - match_options: only 'gps_accuracy' (used as the search radius) applies to OSRM
+        @return:
+            - trace_df: a pd.DataFrame with one row per input point, like MapMatch.make_tracedf,
+              plus the 'snap_distance' reported by OSRM
+        """
+        lat_col, long_col, time_col = colnames
+        n = len(gps_df)
+        lat = gps_df[lat_col].to_numpy(dtype=np.float64)
+        long = gps_df[long_col].to_numpy(dtype=np.float64)
+        # OSRM rejects timestamps going backwards
+        seconds = np.maximum.accumulate(timestamps_s(gps_df, time_col)) if n else np.empty(0, dtype=np.int64)
+        radius = match_options.get('gps_accuracy') or cls.DEFAULT_RADIUS
+
+        ranges = cls.batch_ranges(n) if n else []
+        with ThreadPoolExecutor(max_workers=cls.MAX_WORKERS) as executor:
+            responses = list(executor.map(
+                lambda r: cls.request_batch(lat[r[0]:r[1]], long[r[0]:r[1]], seconds[r[0]:r[1]], radius),
+                ranges))
+
+        columns = {
+            'matchings_index': np.full(n, np.nan),
+            'matched_lat': np.full(n, np.nan),
+            'matched_long': np.full(n, np.nan),
+            'alternatives_count': np.full(n, np.nan),
+            'trace_name': np.full(n, None, dtype=object),
+            'waypoint_index': np.full(n, np.nan),
+            'snap_distance': np.full(n, np.nan),
+        }
+        matchings_offset = 0
+        for (start, stop, owned_start, owned_stop), response in zip(ranges, responses):
+            if response is None:
+                continue
+            for i in range(owned_start, owned_stop):
+                tracepoint = response['tracepoints'][i - start]
+                if tracepoint is None:
+                    continue
+                columns['matchings_index'][i] = tracepoint['matchings_index'] + matchings_offset
+                columns['matched_long'][i], columns['matched_lat'][i] = tracepoint['location']
+                columns['alternatives_count'][i] = tracepoint.get('alternatives_count', 0)
+                columns['trace_name'][i] = tracepoint.get('name', '')
+                columns['waypoint_index'][i] = tracepoint.get('waypoint_index', np.nan)
+                columns['snap_distance'][i] = tracepoint.get('distance', np.nan)
+            matchings_offset += len(response['matchings'])
+
+        trace_df = pd.DataFrame({'trace_index': np.arange(n), **columns})
+        trace_df['trace_distance_from_start'] = None  # not reported by OSRM
+        for col in ['cst_datetime', 'cst_epoch', 'date', 'time']:
+            if col in gps_df.columns:
+                trace_df[col] = gps_df[col].to_numpy()
+        return trace_df
@@ -0,0 +1,180 @@
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# Memory for the rows being processed at once. It only covers row data: the interpreter and
+# imported modules (about 100 MB) come on top of it, so it isn't a ceiling on the peak RSS
+DEFAULT_BUDGET_MB = 1024
+# Peak memory per input row of a person-day through the pipeline, from the frames of every
+# layer to the encoded GeoJSON (measured with Kalman filtering, about 5 KB plus some headroom)
+ROW_BYTES = 6_000
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory so far
+    @return:
+        - own, children: MB of this process, and of the largest finished child process
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KB on Linux, but in bytes on macOS
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+    return own / scale, children / scale
+
+
+def chunk_rows(memory_budget_mb=DEFAULT_BUDGET_MB, workers=0):
+    """Rows per chunk, so the chunks processed at the same time fit in the memory budget"""
+    return max(int(memory_budget_mb * 2 ** 20 / ROW_BYTES / max(workers, 1)), 1)
+
+
+def person_day_chunks(store, persons=None, max_rows=None):
+    """
+    Read a TraceStore sequentially, person by person and day by day, in chunks of whole
+    person-days holding at most max_rows rows (a larger person-day is a chunk of its own)
+    @param:
+        - store: TraceStore
+        - persons: optional list of persons, all persons of the store by default
+        - max_rows: rows per chunk, see chunk_rows
+    @return:
+        - generator of lists of (person, 'YYYY-MM-DD', dict of column arrays)
+    """
+    max_rows = max_rows or chunk_rows()
+    chunk, n_rows = [], 0
+    for person in persons or store.persons():
+        for date, columns in store.read_days(person):
+            n = len(columns['cst_epoch'])
+            if chunk and n_rows + n > max_rows:
+                yield chunk
+                chunk, n_rows = [], 0
+            chunk.append((person, date, columns))
+            n_rows += n
+    if chunk:
+        yield chunk
+
+
+def _chunk_task(root, key, params, chunk, version=None):
+    """
+    Run the pipeline on every person-day of a chunk, storing each result as soon as it's done
+    @return:
+        - n_done, n_failed, n_rows
+    """
+    import pandas as pd
+    from .Materialize import materialize_person_day
+    from .utils import typed_plt_data
+
+    n_done = n_rows = 0
+    for person, date, columns in chunk:
+        person_df = typed_plt_data(pd.DataFrame(columns))
+        n_done += materialize_person_day(root, key, params, person, date, person_df, version)
+        n_rows += len(person_df)
+        del person_df
+    # Pipeline layers reference each other, so free them before the next chunk is read
+    gc.collect()
+    return n_done, len(chunk) - n_done, n_rows
+
+
+def run(store, root, params=None, memory_budget_mb=DEFAULT_BUDGET_MB, persons=None, workers=0, version=None):
+    """
+    Run the pipeline on every person-day of a TraceStore in bounded memory, and store the
+    results like Materialize (as the app's responses, in a MaterializedStore). Person-days are
+    read from the store sequentially in chunks, and only `workers` chunks are read ahead,
+    so the memory used doesn't depend on the size of the corpus.
+    @param:
+        - store: TraceStore
+        - root: directory of the MaterializedStore
+        - params: pipeline parameters, Materialize.DEFAULT_PARAMS if not given
+        - memory_budget_mb: memory for the row data of the chunks being processed, split between
+          the workers (not counting the memory of the interpreter and modules of each process)
+        - workers: number of worker processes, 0 to run every chunk in this process
+        - version: data_version of the dataset the app serves (see Materialize.data_version),
+          which only serves results stored with the version it serves
+    @return:
+        - key: params_key of the stored results
+    """
+    from .Materialize import DEFAULT_PARAMS, MaterializedStore, params_key
+    from .Pipeline import Pipeline
+
+    params = Pipeline(params or DEFAULT_PARAMS).params
+    key = params_key(params)
+    MaterializedStore(root).save_params(key, params)
+    max_rows = chunk_rows(memory_budget_mb, workers)
+    chunks = person_day_chunks(store, persons, max_rows)
+
+    start = time.perf_counter()
+    totals = [0, 0, 0]
+
+    def report(result):
+        for i, value in enumerate(result):
+            totals[i] += value
+        own, children = peak_rss_mb()
+        print(f"{totals[0] + totals[1]} person-days, {totals[2]} rows in {time.perf_counter() - start:.1f}s "
+              f"(peak RSS {own:.0f} MB, workers {children:.0f} MB)")
+
+    if not workers:
+        for chunk in chunks:
+            report(_chunk_task(root, key, params, chunk, version))
+            del chunk
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            while True:
+                # Don't read further ahead than the workers can take
+                if len(pending) >= workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        report(future.result())
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.add(executor.submit(_chunk_task, root, key, params, chunk, version))
+                del chunk
+            for future in wait(pending).done:
+                report(future.result())
+
+    print(f"Processed {totals[0]} person-days under {os.path.join(root, key)} ({totals[1]} failed) "
+          f"in chunks of up to {max_rows} rows")
+    return key
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the pipeline on a whole trace store in bounded memory')
+    parser.add_argument('store_dir', help='Root directory of the trace store (see Ingest)')
+    parser.add_argument('out_dir', help='Directory of the results (a MaterializedStore, see Materialize)')
+    parser.add_argument('--params', default=None, help='JSON file of pipeline parameters, instead of the defaults')
+    parser.add_argument('--persons', type=int, nargs='*', default=None, help='Only process these persons')
+    parser.add_argument('--memory-budget-mb', type=float, default=DEFAULT_BUDGET_MB,
+                        help='Memory for the row data processed at once, split between the workers '
+                             '(modules loaded by each process come on top of it)')
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes, 0 to run in this process')
+    parser.add_argument('--served', default=None,
+                        help='The CSV or shared dataset the app serves, built from this store: the app '
+                             'only serves results stamped with its version (see Materialize.data_version)')
+    parser.add_argument('--max-rss-mb', type=float, default=None,
+                        help='Fail if the peak RSS of this process or of a worker exceeds this')
+    args = parser.parse_args()
+
+    from .Materialize import data_version
+    from .TraceStore import TraceStore
+
+    params = None
+    if args.params:
+        with open(args.params) as f:
+            params = json.load(f)
+    run(TraceStore(args.store_dir), args.out_dir, params, args.memory_budget_mb, args.persons, args.workers,
+        data_version(args.served) if args.served else None)
+
+    own, children = peak_rss_mb()
+    print(f"Peak RSS: {own:.0f} MB, largest worker: {children:.0f} MB")
+    if args.max_rss_mb is not None and max(own, children) > args.max_rss_mb:
+        print(f"Peak RSS exceeded the ceiling of {args.max_rss_mb:.0f} MB")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,532 @@
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+from .utils import filter_person_and_date, create_geodataframe, typed_plt_data, person_days_in_range, timestamps_s
+from .KalmanFilter import kalman_filter
+from .Segment import Segment
+from .StayPoint import DEFAULT_OPTIONS as STAYPOINT_OPTIONS
+from .Matcher import get_matcher
+from .Features import kinematic_features, segment_starts
+from .Prefilter import prefilter
+from .Compress import compress, expand
+from .ResultCache import ResultCache, fingerprint
+from .TraceStore import TraceStore
+
+
+# Process pool tasks of Pipeline.run_many: module level functions, so they can be pickled by reference
+
+def _prepare_task(params, person_df):
+    return Pipeline(params).prepare(person_df)
+
+
+def _finish_task(params, stages, properties=None):
+    """Finish a person-day, and encode its layers as GeoJSON if properties are given"""
+    layers = Pipeline(params).finish(stages)
+    return layers if properties is None else Pipeline.to_geojson(layers, **properties)
+
+
+class Pipeline:
+    """
+    Pipeline runs all preprocessing steps for one person-day and returns each
+    stage as a separate layer, in the same order as they are drawn on the map:
+        - original: the raw GPS data
+        - kalman: Kalman filtered data (optionally time segmented)
+        - matched: map matched data (Meili or OSRM)
+    """
+    # Coordinate columns of each layer
+    LAYER_COLUMNS = {
+        'original': ('lat', 'long'),
+        'kalman': ('kalman_lat', 'kalman_long'),
+        'matched': ('matched_lat', 'matched_long'),
+    }
+
+    DEFAULT_PARAMS = {
+        'prefilter': False,
+        'prefilter_limits': {},  # overrides for Prefilter.DEFAULT_LIMITS
+        'compress': False,
+        'compress_options': {},  # overrides for Compress.DEFAULT_OPTIONS
+        'expand': False,  # expand compressed results back to one row per original point
+        'kalman_filter': True,
+        'n_iter': 5,
+        'time_segment': 60,  # None to Kalman filter the whole day at once
+        'segment_mode': 'time',  # or 'staypoint', see Segment.segment_df
+        'staypoint_options': {},  # overrides for StayPoint.DEFAULT_OPTIONS
+        'buildings': None,  # BuildingIndex .npz file, to weigh fixes by their surroundings when Kalman filtering
+        'building_options': {},  # overrides for Buildings.DEFAULT_OPTIONS
+        'map_match': False,
+        'matcher': 'meili',  # or 'osrm', see Matcher.get_matcher
+        'match_options': {},
+        'kinematics': False,
+    }
+
+    def __init__(self, params=None):
+        self.params = {**Pipeline.DEFAULT_PARAMS, **(params or {})}
+
+    def run(self, person_df: pd.DataFrame) -> dict:
+        """
+        Run every enabled step on a single person-day
+        @param:
+            - person_df: pd.DataFrame for one person and date (see filter_person_and_date)
+        @return:
+            - layers: dict of {layer name: pd.DataFrame}
+        """
+        stages = self.prepare(person_df)
+        if self.params['map_match']:
+            stages['layers']['matched'] = Pipeline.match_step(stages['df_to_match'], stages['colnames_to_match'],
+                                                              self.params['match_options'], self.params['matcher'])
+        return self.finish(stages)
+
+    def prepare(self, person_df: pd.DataFrame) -> dict:
+        """
+        Run the steps before map matching (prefilter, compress and Kalman filter)
+        @return:
+            - stages: dict of the layers so far, the frames needed by finish(), and the
+              'df_to_match' / 'colnames_to_match' to map match
+        """
+        return self.prepare_kalman(self.prepare_points(person_df))
+
+    def prepare_points(self, person_df: pd.DataFrame) -> dict:
+        """
+        First half of prepare(): prefilter and compress, which is all the original layer needs
+        @return:
+            - stages: like prepare(), matching the compressed points as they are
+        """
+        params = self.params
+        layers = {'original': person_df}
+        if params['prefilter']:
+            # Keep outliers in the original layer (flagged), but drop them from every later step
+            layers['original'] = Pipeline.prefilter_step(person_df, params)
+            person_df = layers['original'][~layers['original']['outlier'].to_numpy()]
+        uncompressed_df = person_df
+        if params['compress']:
+            person_df = compress(person_df, **params['compress_options'])
+
+        return {
+            'layers': layers,
+            'compressed_df': person_df,
+            'uncompressed_df': uncompressed_df,
+            'df_to_match': person_df,
+            'colnames_to_match': ['lat', 'long', 'cst_datetime'],
+        }
+
+    def prepare_kalman(self, stages: dict) -> dict:
+        """
+        Second half of prepare(): Kalman filter the output of prepare_points(), if enabled, and
+        match the Kalman filtered points instead
+        """
+        params = self.params
+        if params['kalman_filter']:
+            stages['layers']['kalman'] = Pipeline.kalman_step(stages['compressed_df'], params['n_iter'],
+                                                              params['time_segment'], params['segment_mode'],
+                                                              params['staypoint_options'], params['buildings'],
+                                                              params['building_options'])
+            stages['df_to_match'] = stages['layers']['kalman']
+            stages['colnames_to_match'] = ['kalman_lat', 'kalman_long', 'cst_datetime']
+        return stages
+
+    def finish(self, stages: dict) -> dict:
+        """
+        Run the steps after map matching (expand and kinematics) on the output of prepare(),
+        with the 'matched' layer added if map matching is enabled
+        """
+        params = self.params
+        layers = stages['layers']
+        if params['compress'] and params['expand']:
+            for layer_type in ['kalman', 'matched']:
+                if layer_type in layers:
+                    layers[layer_type] = expand(layers[layer_type], stages['compressed_df'],
+                                                stages['uncompressed_df'])
+
+        if params['kinematics']:
+            layers = Pipeline.kinematics_step(layers)
+
+        return layers
+
+    def run_many(self, person_days: dict, executor=None, match_workers: int = 8, geojson: bool = False):
+        """
+        Run the pipeline on several person-days at once (e.g. several persons, or a date range):
+        the steps before and after map matching run in a process pool, one task per person-day,
+        and the map matching requests of all person-days are sent concurrently from threads.
+        Wall-clock time is then close to that of the slowest person-day, given enough workers:
+        person-days are submitted from the most points to the fewest.
+        @param:
+            - person_days: dict of {(person, date): person_df}
+            - executor: a concurrent.futures.ProcessPoolExecutor, or None to start one
+            - match_workers: maximum number of concurrent map matching requests
+            - geojson: encode each person-day's layers as GeoJSON in the pool (see to_geojson),
+              with 'person' and 'date' properties on every feature
+        @return:
+            - results: dict of {(person, date): layers (or GeoJSON dict)} of the person-days which succeeded
+            - errors: dict of {(person, date): error message} of the person-days which failed
+        """
+        if executor is None:
+            with ProcessPoolExecutor() as executor:
+                return self.run_many(person_days, executor, match_workers, geojson)
+
+        params = self.params
+        # Largest person-days first, so the biggest one isn't left running alone at the end
+        keys = sorted(person_days, key=lambda key: len(person_days[key]), reverse=True)
+        errors = {}
+
+        def collect(futures):
+            results = {}
+            for key, future in zip(keys, futures):
+                if key in errors:
+                    continue
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    print(f"Person {key[0]}, {key[1]}: {e}")
+                    errors[key] = str(e)
+            return results
+
+        stages = collect([executor.submit(_prepare_task, params, person_days[key]) for key in keys])
+        if params['map_match']:
+            with ThreadPoolExecutor(max_workers=match_workers) as threads:
+                matched = collect([threads.submit(Pipeline.match_step, stages[key]['df_to_match'],
+                                                  stages[key]['colnames_to_match'], params['match_options'],
+                                                  params['matcher']) if key in stages else None for key in keys])
+            for key, trace_df in matched.items():
+                stages[key]['layers']['matched'] = trace_df
+        results = collect([executor.submit(_finish_task, params, stages[key],
+                                           {'person': key[0], 'date': key[1]} if geojson else None)
+                           if key in stages else None for key in keys])
+        return results, errors
+
+    def run_stream(self, person_df: pd.DataFrame, chunk_size: int = 500):
+        """
+        Like run(), but yield each layer as soon as it is computed: the original layer first,
+        then the Kalman layer, then the matched layer in chunks of whole time segments
+        (of about chunk_size rows each) which are map matched one after the other
+        @return:
+            - generator of (layer name, pd.DataFrame) pairs; the chunks of a layer share its name
+        """
+        params = self.params
+        stages = self.prepare_points(person_df)
+
+        def finish(layer_type, layer_df, start=0, stop=None):
+            """Expand and add kinematics to the rows [start, stop) of the compressed points' results"""
+            return Pipeline.finish_layer(params, layer_type, layer_df,
+                                         *Pipeline.expansion_rows(params, stages['compressed_df'],
+                                                                  stages['uncompressed_df'], start, stop))
+
+        yield 'original', Pipeline.finish_layer(params, 'original', stages['layers']['original'])
+
+        stages = self.prepare_kalman(stages)
+        if 'kalman' in stages['layers']:
+            yield 'kalman', finish('kalman', stages['layers']['kalman'])
+        df_to_match, colnames_to_match = stages['df_to_match'], stages['colnames_to_match']
+
+        if params['map_match']:
+            bounds = Pipeline.chunk_bounds(df_to_match, chunk_size,
+                                           params['time_segment'] or Pipeline.DEFAULT_PARAMS['time_segment'])
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                trace_df = Pipeline.match_step(df_to_match.iloc[start:stop], colnames_to_match,
+                                               params['match_options'], params['matcher'])
+                trace_df['trace_index'] += start
+                yield 'matched', finish('matched', trace_df, start, stop)
+
+    @staticmethod
+    def expansion_rows(params, compressed_df, uncompressed_df, start=0, stop=None):
+        """
+        The rows [start, stop) of compressed_df, and the uncompressed rows they stand for,
+        needed to expand the results of these rows (see finish_layer)
+        """
+        if not (params['compress'] and params['expand']):
+            return None, None
+        compressed_df = compressed_df.iloc[start:stop]
+        orig_start = compressed_df['orig_start'].iloc[0] if len(compressed_df) else 0
+        orig_stop = compressed_df['orig_stop'].iloc[-1] if len(compressed_df) else 0
+        return compressed_df, uncompressed_df.iloc[orig_start:orig_stop]
+
+    @staticmethod
+    def finish_layer(params, layer_type, layer_df, compressed_df=None, uncompressed_df=None):
+        """
+        Expand (given the rows of expansion_rows) and add kinematics to a single layer, or a
+        chunk of it, like finish() does for all layers
+        """
+        if layer_type != 'original' and compressed_df is not None:
+            layer_df = expand(layer_df, compressed_df, uncompressed_df)
+        if params['kinematics']:
+            layer_df = kinematic_features(layer_df, *Pipeline.LAYER_COLUMNS[layer_type])
+        return layer_df
+
+    @staticmethod
+    def chunk_bounds(gps_df, chunk_size=500, time_gap=60):
+        """
+        Row positions splitting gps_df into chunks of at least chunk_size rows (except the last),
+        only cutting between time segments: those of its 'segment' column, or else wherever
+        consecutive rows are more than time_gap seconds apart, so no chunk cuts through a
+        continuous trace (a trace without gaps is a single chunk)
+        """
+        n = len(gps_df)
+        if 'segment' in gps_df.columns:
+            candidates = np.flatnonzero(segment_starts(gps_df))
+        else:
+            candidates = np.flatnonzero(np.diff(timestamps_s(gps_df)) > time_gap) + 1
+        bounds = [0]
+        for candidate in candidates:
+            if candidate - bounds[-1] >= chunk_size:
+                bounds.append(int(candidate))
+        if n > bounds[-1]:
+            bounds.append(n)
+        return bounds
+
+    def run_person_day(self, data: pd.DataFrame, person: int, date: str) -> dict:
+        """Filter data for a single person and date, and run the pipeline on it"""
+        return self.run(filter_person_and_date(data, person, date))
+
+    def run_person_days(self, data, persons, start_date=None, end_date=None, **kwargs):
+        """
+        Run the pipeline on every person-day of several persons over a date range (see run_many)
+        @param:
+            - data: all_plt_data df, or SharedTraces
+            - persons: list of ints
+            - start_date, end_date: inclusive 'YYYY-MM-DD' bounds, None for no bound
+            - kwargs: passed on to run_many
+        """
+        person_days = {}
+        for person, date in person_days_in_range(data, persons, start_date, end_date):
+            if hasattr(data, 'person_day'):
+                person_days[(person, date)] = data.person_day(person, date, legacy=False)
+            else:
+                person_days[(person, date)] = filter_person_and_date(data, person, date)
+        return self.run_many(person_days, **kwargs)
+
+    def run_incremental(self, person_df: pd.DataFrame, cache: ResultCache, person: int, date: str) -> dict:
+        """
+        Run the pipeline on a single person-day, reusing the stored outputs of every time
+        segment whose input rows and parameters are unchanged. Segments which changed are
+        recomputed and stored, and since every segment runs on its own (see run_segment),
+        the others don't depend on them.
+        Unlike run(), the Kalman and matching steps always work per time segment here.
+        @param:
+            - person_df: pd.DataFrame for one person and date
+            - cache: ResultCache holding the outputs of previous runs
+            - person, date: key of the person-day in the cache
+        @return:
+            - layers: dict of {layer name: pd.DataFrame}, like run()
+        """
+        params = self.params
+        day_fingerprint = fingerprint(person_df, params)
+        manifest = cache.load_manifest(person, date)
+
+        if (manifest['day_fingerprint'] == day_fingerprint
+                and all(cache.has_segment(person, date, fp) for fp in manifest['segments'])):
+            # Nothing changed for this day, skip segmentation entirely
+            segment_layers = [cache.load_segment(person, date, fp) for fp in manifest['segments']]
+            n_recomputed = 0
+        else:
+            time_segment = params['time_segment'] or Pipeline.DEFAULT_PARAMS['time_segment']
+            segment_df = Segment.segment_df(person_df, time_cutoff=int(time_segment), mode=params['segment_mode'],
+                                            **params['staypoint_options'])
+            segments = [df for _, df in segment_df.groupby('segment', sort=True)]
+            segment_fingerprints = [fingerprint(df, params) for df in segments]
+
+            dirty = {i for i, fp in enumerate(segment_fingerprints) if not cache.has_segment(person, date, fp)}
+
+            segment_layers = []
+            for i, (df, fp) in enumerate(zip(segments, segment_fingerprints)):
+                if i in dirty:
+                    one_segment_layers = self.run_segment(df)
+                    cache.save_segment(person, date, fp, one_segment_layers)
+                else:
+                    one_segment_layers = cache.load_segment(person, date, fp)
+                segment_layers.append(one_segment_layers)
+            cache.save_manifest(person, date, day_fingerprint, segment_fingerprints)
+            n_recomputed = len(dirty)
+
+        print(f"Person {person}, {date}: recomputed {n_recomputed} of {len(segment_layers)} segments")
+
+        layers = {'original': person_df}
+        if params['prefilter']:
+            # Flagged within the same segments as run_segment drops them
+            layers['original'] = Pipeline.prefilter_step(person_df, params)
+        if params['kinematics']:
+            layers = Pipeline.kinematics_step(layers)
+        for layer_type in ['kalman', 'matched']:
+            # Stored segments keep the 'segment' of the run which stored them, so number them again
+            layer_dfs = [one_segment_layers[layer_type].assign(segment=i)
+                         for i, one_segment_layers in enumerate(segment_layers) if layer_type in one_segment_layers]
+            if layer_dfs:
+                layers[layer_type] = pd.concat(layer_dfs, ignore_index=True)
+        return layers
+
+    def run_segment(self, segment_df: pd.DataFrame) -> dict:
+        """Run the Kalman, matching and kinematics steps on a single time segment"""
+        params = self.params
+        segment_layers = {}
+        if params['prefilter']:
+            # A single segment, so the points dropped are those flagged by prefilter_step
+            segment_df = prefilter(segment_df, **params['prefilter_limits'])
+        uncompressed_df = segment_df
+        if params['compress']:
+            segment_df = compress(segment_df, **params['compress_options'])
+        df_to_match = segment_df
+        colnames_to_match = ['lat', 'long', 'cst_datetime']
+
+        if params['kalman_filter']:
+            segment_layers['kalman'] = kalman_filter(
+                Pipeline.buildings_step(segment_df, params['buildings'], params['building_options']), params['n_iter'])
+            df_to_match = segment_layers['kalman']
+            colnames_to_match = ['kalman_lat', 'kalman_long', 'cst_datetime']
+
+        if params['map_match']:
+            segment_layers['matched'] = Pipeline.match_step(df_to_match, colnames_to_match,
+                                                            params['match_options'], params['matcher'])
+
+        if params['compress'] and params['expand']:
+            segment_layers = {layer_type: expand(layer_df, segment_df, uncompressed_df)
+                              for layer_type, layer_df in segment_layers.items()}
+
+        if params['kinematics']:
+            segment_layers = Pipeline.kinematics_step(segment_layers)
+        return segment_layers
+
+    @staticmethod
+    def prefilter_step(person_df, params):
+        """
+        Flag the outliers of a person-day (see Prefilter.prefilter) one time segment at a time,
+        in the segments of run_incremental, so steps across a time gap are never taken for jumps
+        and the flags are the same whether the day is run whole or segment by segment
+        @return:
+            - person_df with a boolean 'outlier' column
+        """
+        if len(person_df) == 0:
+            return prefilter(person_df, drop=False, **params['prefilter_limits'])
+        time_segment = params['time_segment'] or Pipeline.DEFAULT_PARAMS['time_segment']
+        segment_df = Segment.segment_df(person_df, time_cutoff=int(time_segment), mode=params['segment_mode'],
+                                        **params['staypoint_options'])
+        # segment_df is sorted by time, so put its segments back in the order of person_df
+        segments = np.empty(len(person_df), dtype=np.int64)
+        segments[np.argsort(timestamps_s(person_df), kind='stable')] = segment_df['segment'].to_numpy()
+        flagged = prefilter(person_df.assign(prefilter_segment=segments), segment_col='prefilter_segment',
+                            drop=False, **params['prefilter_limits'])
+        return flagged.drop(columns='prefilter_segment')
+
+    @staticmethod
+    def kalman_step(person_df, n_iter=5, time_segment=60, segment_mode='time', staypoint_options=None,
+                    buildings=None, building_options=None):
+        """
+        Kalman filter a person-day, separately for each time segment if time_segment is set or
+        segment_mode is 'staypoint' (trips are then split by StayPoint's max_gap without a time_segment),
+        with observation noise scaled by the buildings around each fix if a building index is given
+        """
+        if time_segment or segment_mode == 'staypoint':
+            time_cutoff = time_segment or STAYPOINT_OPTIONS['max_gap']
+            segment_df = Segment.segment_df(person_df, time_cutoff=int(time_cutoff), mode=segment_mode,
+                                            **(staypoint_options or {}))
+            segment_df = Pipeline.buildings_step(segment_df, buildings, building_options)
+            return Segment.kalman_filter_segments(segment_df, n_iter)
+        return kalman_filter(Pipeline.buildings_step(person_df, buildings, building_options), n_iter)
+
+    @staticmethod
+    def buildings_step(gps_df, buildings=None, building_options=None):
+        """Annotate gps_df with the buildings around each fix (see Buildings.annotate), if an index is given"""
+        if not buildings:
+            return gps_df
+        from .Buildings import annotate, load_building_index
+        return annotate(gps_df, load_building_index(buildings), **(building_options or {}))
+
+    @staticmethod
+    def match_step(df_to_match, colnames_to_match, match_options, matcher='meili'):
+        """Map match df_to_match with the given matcher and return one row per input point"""
+        # Tracepoints are indexed by input row, so take their times from the matched rows
+        # themselves (earlier steps may have dropped or reordered rows of the person-day)
+        trace_df = get_matcher(matcher).match(df_to_match, colnames_to_match, match_options)
+        return Pipeline.annotate_trace(trace_df, df_to_match, colnames_to_match)
+
+    @staticmethod
+    def annotate_trace(trace_df, df_to_match, colnames_to_match):
+        """Add the matched input coordinates and segments to a matcher's trace_df"""
+        # Keep the matched input coordinates, so stored results can be evaluated on their own
+        trace_df['input_lat'] = df_to_match[colnames_to_match[0]].to_numpy()
+        trace_df['input_long'] = df_to_match[colnames_to_match[1]].to_numpy()
+        # Tracepoints line up with the matched input rows, so they share its segments
+        if 'segment' in df_to_match.columns:
+            trace_df['segment'] = df_to_match['segment'].to_numpy()
+        return trace_df
+
+    @staticmethod
+    def kinematics_step(layers):
+        """Add per-point kinematic features to every layer"""
+        return {
+            layer_type: kinematic_features(layer_df, *Pipeline.LAYER_COLUMNS[layer_type])
+            for layer_type, layer_df in layers.items()
+        }
+
+    @staticmethod
+    def layer_geojson(layer_df, layer_type, **properties):
+        """
+        Convert a single layer to a GeoJSON dict, labelling each feature with its layer type
+        and any other given properties (e.g. person and date)
+        """
+        lat_col, long_col = Pipeline.LAYER_COLUMNS[layer_type]
+        layer_gdf = create_geodataframe(layer_df, lat_col, long_col)
+        layer_gdf['type'] = layer_type
+        for name, value in properties.items():
+            layer_gdf[name] = value
+        return json.loads(layer_gdf.to_json())
+
+    @staticmethod
+    def to_geojson(layers, **properties):
+        """Combine all layers into a single GeoJSON FeatureCollection dict"""
+        full_geojson = None
+        for layer_type, layer_df in layers.items():
+            layer_geojson = Pipeline.layer_geojson(layer_df, layer_type, **properties)
+            if full_geojson is None:
+                full_geojson = layer_geojson
+            else:
+                full_geojson['features'].extend(layer_geojson['features'])
+        return full_geojson
+
+    @staticmethod
+    def combine_geojson(geojsons):
+        """Combine the GeoJSON dicts of several person-days (see run_many) into one FeatureCollection"""
+        return {'type': 'FeatureCollection',
+                'features': [feature for geojson in geojsons for feature in geojson['features']]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incrementally refresh pipeline outputs for every person-day in the trace store')
+    parser.add_argument('store_dir', help='Root directory of the trace store')
+    parser.add_argument('cache_dir', help='Directory of the result cache')
+    parser.add_argument('--persons', type=int, nargs='*', default=None, help='Only refresh these persons')
+    parser.add_argument('--n-iter', type=int, default=Pipeline.DEFAULT_PARAMS['n_iter'])
+    parser.add_argument('--time-segment', type=int, default=Pipeline.DEFAULT_PARAMS['time_segment'])
+    parser.add_argument('--segment-mode', choices=['time', 'staypoint'], default='time')
+    parser.add_argument('--map-match', action='store_true')
+    parser.add_argument('--matcher', choices=['meili', 'osrm'], default='meili')
+    parser.add_argument('--kinematics', action='store_true')
+    parser.add_argument('--prefilter', action='store_true', help='Drop outliers before Kalman filtering and matching')
+    parser.add_argument('--compress', action='store_true', help='Collapse stays before Kalman filtering and matching')
+    parser.add_argument('--resample', type=float, default=None, help='Also resample to one point per this many seconds')
+    parser.add_argument('--buildings', default=None, help='Building index (see Buildings) to weigh fixes by their surroundings')
+    args = parser.parse_args()
+
+    store = TraceStore(args.store_dir)
+    cache = ResultCache(args.cache_dir)
+    pipeline = Pipeline({
+        'n_iter': args.n_iter,
+        'time_segment': args.time_segment,
+        'segment_mode': args.segment_mode,
+        'map_match': args.map_match,
+        'matcher': args.matcher,
+        'kinematics': args.kinematics,
+        'prefilter': args.prefilter,
+        'compress': args.compress or bool(args.resample),
+        'compress_options': {'resample_s': args.resample},
+        'expand': True,
+        'buildings': args.buildings,
+    })
+    for person in args.persons or store.persons():
+        person_frame = typed_plt_data(store.read_frame(person))
+        for date, person_df in person_frame.groupby('date', sort=True, observed=True):
+            pipeline.run_incremental(person_df, cache, person, date)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+
+# Google's encoded polyline algorithm, used by OSRM (precision 5) and Valhalla (precision 6).
+# Every coordinate is stored as the zigzag-encoded difference to the previous one, in
+# little-endian chunks of 5 bits, each offset by 63 and flagged with 0x20 if more chunks follow.
+MAX_CHUNKS = 7  # enough for 35 bits, i.e. any delta at precision 6
+
+
+def encode(lat, long, precision=5) -> str:
+    """
+    Encode arrays of coordinates as a polyline string, without looping over coordinates
+    @param:
+        - lat, long: array-likes of coordinates in degrees
+        - precision: number of decimals kept (5 for OSRM, 6 for Valhalla)
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    long = np.asarray(long, dtype=np.float64)
+    if len(lat) == 0:
+        return ''
+    factor = 10 ** precision
+    # Interleave (lat, long) pairs and take the difference to the previous pair
+    values = np.rint(np.column_stack([lat, long]) * factor).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=0).ravel()
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+
+    shifts = 5 * np.arange(MAX_CHUNKS)
+    chunks = (zigzag[:, None] >> shifts) & 0x1f
+    n_chunks = 1 + np.count_nonzero(zigzag[:, None] >> shifts[1:], axis=1)
+    more = np.arange(MAX_CHUNKS) < (n_chunks[:, None] - 1)
+    chars = (chunks | (more * 0x20)) + 63
+    used = np.arange(MAX_CHUNKS) < n_chunks[:, None]
+    return chars[used].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode(polyline: str, precision=5):
+    """
+    Decode a single polyline string
+    @return:
+        - lat, long: np.ndarrays of coordinates in degrees
+    """
+    values = []
+    result = shift = 0
+    for char in polyline.encode('ascii'):
+        chunk = char - 63
+        result |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            result = shift = 0
+    coords = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return coords[:, 0], coords[:, 1]
+
+
+def decode_many(polylines, precision=5):
+    """
+    Decode many polyline strings at once, e.g. every step geometry of a day's matchings
+    @param:
+        - polylines: iterable of polyline strings
+        - precision: number of decimals kept (5 for OSRM, 6 for Valhalla)
+    @return:
+        - lat, long: np.ndarrays of the coordinates of all polylines, one after the other
+        - offsets: np.ndarray of len(polylines) + 1 positions, the coordinates of polyline i
+          being lat[offsets[i]:offsets[i + 1]]
+    """
+    polylines = ['' if polyline is None else polyline for polyline in polylines]
+    chars = np.frombuffer(''.join(polylines).encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    char_offsets = np.concatenate([[0], np.cumsum([len(polyline) for polyline in polylines], dtype=np.int64)])
+
+    # Every value ends on a chunk without the 0x20 flag
+    ends = chars < 0x20
+    value_starts = np.flatnonzero(np.concatenate([[True], ends[:-1]]))[:np.count_nonzero(ends)]
+    value_of_char = np.cumsum(ends) - ends
+    shifts = 5 * (np.arange(len(chars)) - value_starts[value_of_char]) if len(chars) else chars
+    values = np.add.reduceat((chars & 0x1f) << shifts, value_starts) if len(value_starts) else np.zeros(0, np.int64)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    # Deltas restart at every polyline, so subtract the running sum at its start
+    ends_before = np.concatenate([[0], np.cumsum(ends)])[char_offsets]
+    offsets = ends_before // 2
+    deltas = values.reshape(-1, 2)
+    coords = np.cumsum(deltas, axis=0)
+    counts = np.diff(offsets)
+    starts = np.concatenate([[np.zeros(2, np.int64)], coords])[offsets[:-1]]
+    coords = (coords - np.repeat(starts, counts, axis=0)) / 10 ** precision
+    return coords[:, 0], coords[:, 1], offsets
+
+
+def linestrings(lat, long, offsets):
+    """
+    Build a LineString per polyline from flat coordinates (see decode_many), with shapely's
+    ragged array constructor instead of one LineString at a time
+    @return:
+        - np.ndarray of shapely LineStrings, None for polylines of less than 2 coordinates
+    """
+    import shapely
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    geometries = np.full(len(counts), None, dtype=object)
+    valid = counts >= 2
+    if valid.any():
+        # Only keep the coordinates of valid polylines, and their offsets into those
+        keep = np.repeat(valid, counts)
+        coords = np.column_stack([long, lat])[keep]
+        valid_offsets = np.concatenate([[0], np.cumsum(counts[valid])])
+        geometries[valid] = shapely.from_ragged_array(shapely.GeometryType.LINESTRING, coords, (valid_offsets,))
+    return geometries
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+from .Features import kinematic_features, haversine
+
+DEFAULT_LIMITS = {
+    'max_speed': 15.0,  # m/s
+    'max_acceleration': 5.0,  # m/s^2
+    'max_median_distance': 100.0,  # m from the rolling median position
+    'median_window': 7,  # points
+}
+
+
+def prefilter(gps_df: pd.DataFrame, lat_col: str = 'lat', long_col: str = 'long',
+              time_col: str = 'cst_datetime', segment_col: str = 'segment',
+              drop: bool = True, **limits) -> pd.DataFrame:
+    """
+    Flag (and optionally drop) teleport jumps and multipath spikes before Kalman filtering
+    and map matching, in one vectorized pass per segment.
+
+    A point is an outlier if:
+        - both the steps into and out of it are faster than max_speed, or
+        - the speed jumps up by more than max_acceleration on the step into it, and drops
+          by more than max_acceleration on the step after the one out of it, or
+        - it is further than max_median_distance from the rolling median position
+    Requiring both the step in and the step out to be implausible flags the spike itself,
+    but not the first point after a genuine relocation (a single fast step).
+    @param:
+        - gps_df: time-ordered pd.DataFrame with coordinate and time columns
+        - drop: return only the inliers instead of all rows
+        - limits: overrides for DEFAULT_LIMITS
+    @return:
+        - gps_df with a boolean 'outlier' column (only inliers if drop is True)
+    """
+    limits = {**DEFAULT_LIMITS, **{k: v for k, v in limits.items() if v is not None}}
+    features = kinematic_features(gps_df, lat_col, long_col, time_col, segment_col)
+    speed = features['speed'].to_numpy()
+    acceleration = features['acceleration'].to_numpy()
+
+    # Values on row i describe the step into point i, so row i+1 holds the step out of it.
+    # Acceleration on row i compares the steps into points i-1 and i: around a spike at k
+    # the speed jumps up on row k and back down on row k+2, once the step out of k is over.
+    # NaN comparisons are False, so segment ends are never flagged by these tests
+    speed_out = np.append(speed[1:], np.nan)
+    acceleration_after = np.append(acceleration[2:], [np.nan, np.nan])[:len(acceleration)]
+    with np.errstate(invalid='ignore'):
+        speed_spike = (speed > limits['max_speed']) & (speed_out > limits['max_speed'])
+        acceleration_spike = ((acceleration > limits['max_acceleration'])
+                              & (acceleration_after < -limits['max_acceleration']))
+
+    # Rolling median of each coordinate, computed within each segment
+    if segment_col in gps_df.columns:
+        groups = gps_df[segment_col].to_numpy()
+    else:
+        groups = np.zeros(len(gps_df), dtype=np.int64)
+    coords = pd.DataFrame({'lat': gps_df[lat_col].to_numpy(dtype=np.float64),
+                           'long': gps_df[long_col].to_numpy(dtype=np.float64),
+                           'group': groups})
+    medians = (coords.groupby('group', sort=False)[['lat', 'long']]
+               .rolling(int(limits['median_window']), center=True, min_periods=1)
+               .median()
+               .reset_index(level=0, drop=True)
+               .sort_index())
+    median_distance = haversine(coords['lat'], coords['long'], medians['lat'], medians['long'])
+
+    gps_df = gps_df.copy()
+    gps_df['outlier'] = speed_spike | acceleration_spike | (median_distance > limits['max_median_distance'])
+    n_outliers = int(gps_df['outlier'].sum())
+    print(f"Prefilter flagged {n_outliers} of {len(gps_df)} points")
+
+    if drop:
+        gps_df = gps_df[~gps_df['outlier'].to_numpy()]
+    return gps_df
@@ -0,0 +1,191 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from .Features import haversine
+from .ResultCache import ResultCache
+
+METRIC_COLUMNS = ['n_points', 'matched_ratio', 'avg_snap_distance', 'alternatives_ratio', 'avg_alternatives']
+
+
+def snap_distances(trace_df: pd.DataFrame, input_df: pd.DataFrame, colnames=('lat', 'long')):
+    """
+    Distance in meters from each input point to its matched tracepoint (NaN where unmatched)
+    @param:
+        - trace_df: output of MapMatch.make_tracedf, one row per input point
+        - input_df: the rows that were matched
+        - colnames: latitude and longitude columns of input_df
+    """
+    lat_col, long_col = colnames[:2]
+    return haversine(input_df[lat_col].to_numpy(dtype=np.float64),
+                     input_df[long_col].to_numpy(dtype=np.float64),
+                     trace_df['matched_lat'].to_numpy(dtype=np.float64, na_value=np.nan),
+                     trace_df['matched_long'].to_numpy(dtype=np.float64, na_value=np.nan))
+
+
+def match_metrics(trace_df: pd.DataFrame, input_df: pd.DataFrame, colnames=('lat', 'long')) -> dict:
+    """
+    Vectorized version of the RoadSnap.evaluate_snap metrics for Meili tracepoints:
+        - matched_ratio: proportion of input points which matched to the road network
+        - avg_snap_distance: mean distance in meters between input and matched points
+        - alternatives_ratio: proportion of points with alternative matches
+        - avg_alternatives: mean number of alternatives of the matched points (a missing count is 0),
+          like QualityReport's
+    """
+    n_points = len(trace_df)
+    if n_points == 0:
+        return dict.fromkeys(METRIC_COLUMNS, np.nan) | {'n_points': 0}
+    matched = trace_df['matched_lat'].notna().to_numpy()
+    alternatives = trace_df['alternatives_count'].to_numpy(dtype=np.float64, na_value=np.nan)
+    distances = snap_distances(trace_df, input_df, colnames)
+    with np.errstate(invalid='ignore'):
+        return {
+            'n_points': n_points,
+            'matched_ratio': matched.mean(),
+            'avg_snap_distance': np.nanmean(distances) if matched.any() else np.nan,
+            'alternatives_ratio': (alternatives > 0).mean(),
+            'avg_alternatives': np.nan_to_num(alternatives[matched]).mean() if matched.any() else np.nan,
+        }
+
+
+def match_breaks(trace_df: pd.DataFrame) -> int:
+    """
+    Number of places where a trace stops being continuously matched: every run of unmatched
+    points, plus every switch to a different matching between consecutive matched points
+    """
+    matched = trace_df['matched_lat'].notna().to_numpy()
+    if len(matched) == 0:
+        return 0
+    unmatched_runs = np.count_nonzero(~matched[1:] & matched[:-1]) + int(not matched[0])
+    matchings = trace_df['matchings_index'].to_numpy(dtype=np.float64, na_value=np.nan)[matched]
+    switches = np.count_nonzero(np.diff(matchings) != 0) if len(matchings) > 1 else 0
+    return int(unmatched_runs + switches)
+
+
+class QualityReport:
+    """
+    QualityReport accumulates map-matching quality metrics over any number of stored results
+    in a single streaming pass. Only running sums and a fixed snap distance histogram are kept
+    per (person, date, region), so memory doesn't grow with the number of points.
+    """
+    REGION_SIZE = 0.1  # degrees, ~10km cells
+    SNAP_BINS = np.arange(0, 201, 1.0)  # 1m histogram bins, the last bin holds everything further
+    SUM_COLUMNS = ['n_points', 'n_matched', 'snap_sum', 'snap_max', 'n_with_alternatives',
+                   'alternatives_sum', 'n_breaks']
+
+    def __init__(self):
+        self.groups = {}  # (person, date, region) -> dict of running sums
+
+    def _group(self, key):
+        if key not in self.groups:
+            group = dict.fromkeys(QualityReport.SUM_COLUMNS, 0.0)
+            group['snap_hist'] = np.zeros(len(QualityReport.SNAP_BINS), dtype=np.int64)
+            self.groups[key] = group
+        return self.groups[key]
+
+    def add(self, person, date, trace_df: pd.DataFrame):
+        """Accumulate one stored trace_df (with 'input_lat' / 'input_long' columns)"""
+        if len(trace_df) == 0:
+            return
+        input_lat = trace_df['input_lat'].to_numpy(dtype=np.float64)
+        input_long = trace_df['input_long'].to_numpy(dtype=np.float64)
+        distances = snap_distances(trace_df, trace_df, ('input_lat', 'input_long'))
+        matched = ~np.isnan(distances)
+        alternatives = np.nan_to_num(trace_df['alternatives_count'].to_numpy(dtype=np.float64, na_value=np.nan))
+
+        # Bin every point into its region, then reduce each region with bincount
+        region_lat = np.floor(input_lat / QualityReport.REGION_SIZE).astype(np.int64)
+        region_long = np.floor(input_long / QualityReport.REGION_SIZE).astype(np.int64)
+        regions, region_index = np.unique(np.stack([region_lat, region_long], axis=1), axis=0, return_inverse=True)
+        region_index = region_index.ravel()
+        n_regions = len(regions)
+        sums = {
+            'n_points': np.bincount(region_index, minlength=n_regions),
+            'n_matched': np.bincount(region_index, weights=matched, minlength=n_regions),
+            'snap_sum': np.bincount(region_index, weights=np.where(matched, distances, 0), minlength=n_regions),
+            'n_with_alternatives': np.bincount(region_index, weights=alternatives > 0, minlength=n_regions),
+            'alternatives_sum': np.bincount(region_index, weights=np.where(matched, alternatives, 0),
+                                            minlength=n_regions),
+        }
+        snap_max = np.zeros(n_regions)
+        np.maximum.at(snap_max, region_index[matched], distances[matched])
+        snap_bins = np.minimum(np.digitize(distances[matched], QualityReport.SNAP_BINS) - 1,
+                               len(QualityReport.SNAP_BINS) - 1)
+
+        # Breaks are attributed to the region of the trace's first point
+        n_breaks = match_breaks(trace_df)
+        for i, (lat_cell, long_cell) in enumerate(regions):
+            region = f"{lat_cell * QualityReport.REGION_SIZE:.1f},{long_cell * QualityReport.REGION_SIZE:.1f}"
+            group = self._group((person, str(date), region))
+            for col, values in sums.items():
+                group[col] += values[i]
+            group['snap_max'] = max(group['snap_max'], snap_max[i])
+            group['snap_hist'] += np.bincount(snap_bins[region_index[matched] == i],
+                                              minlength=len(QualityReport.SNAP_BINS))
+            if i == region_index[0]:
+                group['n_breaks'] += n_breaks
+
+    def add_cache(self, cache: ResultCache):
+        """Stream every stored matched segment of a ResultCache through the report"""
+        for person, date in cache.iter_days():
+            for segment_fingerprint in cache.load_manifest(person, date)['segments']:
+                if not cache.has_segment(person, date, segment_fingerprint):
+                    continue
+                segment_layers = cache.load_segment(person, date, segment_fingerprint)
+                if 'matched' in segment_layers:
+                    self.add(person, date, segment_layers['matched'])
+
+    @staticmethod
+    def _percentile(hist, q):
+        total = hist.sum()
+        if total == 0:
+            return np.nan
+        # Upper edge of the bin holding the q-th quantile
+        bin_index = np.searchsorted(np.cumsum(hist), q * total)
+        return float(QualityReport.SNAP_BINS[bin_index] + 1)
+
+    def summary(self) -> pd.DataFrame:
+        """
+        One row per (person, date, region) with the aggregated metrics, defined like those of
+        match_metrics: avg_snap_distance and avg_alternatives are means over the matched points
+        """
+        rows = []
+        for (person, date, region), group in sorted(self.groups.items()):
+            n_points, n_matched = group['n_points'], group['n_matched']
+            rows.append({
+                'person': person,
+                'date': date,
+                'region': region,
+                'n_points': int(n_points),
+                'matched_ratio': n_matched / n_points,
+                'avg_snap_distance': group['snap_sum'] / n_matched if n_matched else np.nan,
+                'p50_snap_distance': QualityReport._percentile(group['snap_hist'], 0.5),
+                'p95_snap_distance': QualityReport._percentile(group['snap_hist'], 0.95),
+                'max_snap_distance': group['snap_max'] if n_matched else np.nan,
+                'alternatives_ratio': group['n_with_alternatives'] / n_points,
+                'avg_alternatives': group['alternatives_sum'] / n_matched if n_matched else np.nan,
+                'n_breaks': int(group['n_breaks']),
+            })
+        return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize map-matching quality over all stored results')
+    parser.add_argument('cache_dir', help='Directory of the result cache')
+    parser.add_argument('--out', default='match_quality.csv', help='Summary table output')
+    args = parser.parse_args()
+
+    report = QualityReport()
+    report.add_cache(ResultCache(args.cache_dir))
+    summary = report.summary()
+    summary.to_csv(args.out, index=False)
+    print(f"Wrote {len(summary)} rows to {args.out}")
+
+    summary['n_matched'] = summary['n_points'] * summary['matched_ratio']
+    by_person = summary.groupby('person')[['n_points', 'n_matched', 'n_breaks']].sum()
+    by_person['matched_ratio'] = by_person['n_matched'] / by_person['n_points']
+    print(by_person.to_string())
+
+
+if __name__ == '__main__':
+    main()
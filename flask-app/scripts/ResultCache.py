@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from .utils import timestamps_s
+
+
+def fingerprint(gps_df: pd.DataFrame, params: dict, lat_col='lat', long_col='long', time_col='cst_datetime'):
+    """
+    Fingerprint the input rows of a person-day or segment together with the parameters
+    used to process them. Any change in coordinates, timestamps or parameters gives a
+    different fingerprint.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    digest.update(np.ascontiguousarray(gps_df[lat_col].to_numpy(dtype=np.float64)).tobytes())
+    digest.update(np.ascontiguousarray(gps_df[long_col].to_numpy(dtype=np.float64)).tobytes())
+    digest.update(np.ascontiguousarray(timestamps_s(gps_df, time_col)).tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    ResultCache stores pipeline outputs per person-day and per segment, keyed by the
+    fingerprint of their inputs, so reruns only recompute what changed.
+
+    Layout:
+        <root>/<person>/<date>/manifest.json   day fingerprint and ordered segment fingerprints
+        <root>/<person>/<date>/<fingerprint>.pkl   dict of {layer name: pd.DataFrame} for one segment
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def day_dir(self, person, date):
+        return os.path.join(self.root, str(person), str(date))
+
+    def load_manifest(self, person, date):
+        path = os.path.join(self.day_dir(person, date), 'manifest.json')
+        if not os.path.exists(path):
+            return {'day_fingerprint': None, 'segments': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_manifest(self, person, date, day_fingerprint, segment_fingerprints):
+        """Save the day manifest and delete segment outputs it no longer references"""
+        day_dir = self.day_dir(person, date)
+        os.makedirs(day_dir, exist_ok=True)
+        path = os.path.join(day_dir, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'day_fingerprint': day_fingerprint, 'segments': segment_fingerprints}, f)
+        os.replace(path + '.tmp', path)
+
+        referenced = {f'{fp}.pkl' for fp in segment_fingerprints}
+        for filename in os.listdir(day_dir):
+            if filename.endswith('.pkl') and filename not in referenced:
+                os.remove(os.path.join(day_dir, filename))
+
+    def has_segment(self, person, date, segment_fingerprint):
+        return os.path.exists(os.path.join(self.day_dir(person, date), f'{segment_fingerprint}.pkl'))
+
+    def load_segment(self, person, date, segment_fingerprint):
+        return pd.read_pickle(os.path.join(self.day_dir(person, date), f'{segment_fingerprint}.pkl'))
+
+    def save_segment(self, person, date, segment_fingerprint, segment_layers):
+        day_dir = self.day_dir(person, date)
+        os.makedirs(day_dir, exist_ok=True)
+        pd.to_pickle(segment_layers, os.path.join(day_dir, f'{segment_fingerprint}.pkl'))
+
+    def iter_days(self):
+        """Yield (person, date) for every person-day with a stored manifest"""
+        for person in sorted(os.listdir(self.root)):
+            person_dir = os.path.join(self.root, person)
+            if not os.path.isdir(person_dir):
+                continue
+            for date in sorted(os.listdir(person_dir)):
+                if os.path.exists(os.path.join(person_dir, date, 'manifest.json')):
+                    yield int(person), date
@@ -1,33 +1,40 @@
+import numpy as np
 import pandas as pd
 from .KalmanFilter import kalman_filter
+from .StayPoint import segment_trips
+from .utils import timestamps_s
 
 class Segment:
     def __init__(self):
         pass
 
     @staticmethod
-    def segment_df(gps_df: pd.DataFrame, time_cutoff: int=60) -> pd.DataFrame:
+    def segment_df(gps_df: pd.DataFrame, time_cutoff: int=60, mode: str='time', **staypoint_options) -> pd.DataFrame:
         """
         Splits a dataframe of time-ordered GPS traces into a list of separate dataframes 
         based on the time difference between consecutive rows.
         @param:
-            data: pd.DataFrame with 'cst_datetime' column
+            data: pd.DataFrame with 'cst_datetime' (or typed 'cst_epoch') column
             time_cutoff: int representing the maximum time difference in seconds before splitting
+            mode: 'time' to only split on time gaps, or 'staypoint' to also split
+                  stay points from trips (see Segment.staypoint_segment_df)
         @return:
             segment_df: pd.DataFrame with new column 'segment' indicating the segment number
         """
-        gps_df = gps_df.copy() # To avoid modifying the original DataFrame
+        if mode == 'staypoint':
+            return Segment.staypoint_segment_df(gps_df, time_cutoff, **staypoint_options)
 
-        # Sort the DataFrame by ascending 'cst_datetime'
-        gps_df['cst_datetime'] = pd.to_datetime(gps_df['cst_datetime']) # convert if not already
-        gps_df = gps_df.sort_values(by='cst_datetime').reset_index(drop=True)
+        gps_df = gps_df.copy() # To avoid modifying the original DataFrame
 
-        # Calculate the time difference between consecutive GPS readings
-        time_differences = gps_df['cst_datetime'].diff()
+        # Sort the DataFrame by ascending time (typed data is already parsed to 'cst_epoch')
+        if 'cst_datetime' in gps_df.columns:
+            gps_df['cst_datetime'] = pd.to_datetime(gps_df['cst_datetime']) # convert if not already
+        seconds = timestamps_s(gps_df)
+        order = np.argsort(seconds, kind='stable')
+        gps_df = gps_df.iloc[order].reset_index(drop=True)
 
-        # Convert time differences to total seconds
-        time_differences_in_seconds = time_differences.dt.total_seconds()
-        gps_df['time_diff'] = time_differences_in_seconds
+        # Time difference in seconds between consecutive GPS readings
+        gps_df['time_diff'] = np.diff(seconds[order].astype(np.float64), prepend=np.nan)
 
         # Identify indices of rows where the time difference between it and the preceeding row
         # exceeds [time_cutoff] seconds
@@ -35,7 +42,7 @@ class Segment:
         split_indices = gps_df[rows_exceeding_cutoff].index.tolist()
 
         # Ensures gps_df doesn't truncate the beginning and end
-        split_indices = [0] + split_indices + [len(gps_df)-1]
+        split_indices = [0] + split_indices + [len(gps_df)]
         print("Split indices:", split_indices)  # Debugging
 
         # Use split_indices as the start and end indices to slice gps_df into segments
@@ -54,6 +61,38 @@ class Segment:
 
         return segment_df
     
+    @staticmethod
+    def staypoint_segment_df(gps_df: pd.DataFrame, time_cutoff: int=60, **staypoint_options) -> pd.DataFrame:
+        """
+        Alternative to segment_df which separates stationary periods from walking trips,
+        even when the GPS kept logging while stationary.
+        Every trip and every stay point becomes its own segment, numbered in time order.
+        @param:
+            gps_df: pd.DataFrame with 'lat', 'long' and 'cst_datetime' columns
+            time_cutoff: trips are also split by time gaps longer than this many seconds
+            staypoint_options: overrides for StayPoint.DEFAULT_OPTIONS
+        @return:
+            segment_df: pd.DataFrame with 'segment', 'stay_id' and 'trip_id' columns
+        """
+        gps_df = gps_df.copy()
+        if 'cst_datetime' in gps_df.columns:
+            gps_df['cst_datetime'] = pd.to_datetime(gps_df['cst_datetime'])
+        gps_df = gps_df.iloc[np.argsort(timestamps_s(gps_df), kind='stable')].reset_index(drop=True)
+
+        staypoint_options = {'max_gap': time_cutoff, **staypoint_options}
+        segment_df, stays_df = segment_trips(gps_df, **staypoint_options)
+
+        # Segments start wherever the (stay, trip) pair changes
+        stay_id = segment_df['stay_id'].to_numpy()
+        trip_id = segment_df['trip_id'].to_numpy()
+        new_segment = np.ones(len(segment_df), dtype=bool)
+        new_segment[1:] = (stay_id[1:] != stay_id[:-1]) | (trip_id[1:] != trip_id[:-1])
+        segment_df['segment'] = np.cumsum(new_segment) - 1
+        print(f"Found {len(stays_df)} stay points and {trip_id.max() + 1 if len(trip_id) else 0} trips")
+
+        cols = ['segment'] + [col for col in segment_df.columns if col != 'segment']
+        return segment_df[cols]
+
     # @staticmethod
     # def combine_segments(gps_df_segments):
     #     """
@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .Catalog import Catalog, FILENAME as CATALOG_FILENAME
+from .TraceStore import TraceStore
+from .utils import timestamps_s, typed_plt_data, load_all_plt_data
+
+
+class SharedTraces:
+    """
+    SharedTraces is a read-only, memory-mapped copy of all_plt_data shared by every
+    worker process.
+
+    The trace columns are written once (see SharedTraces.build) as flat .npy files sorted
+    by person and time, together with a person/date index of row ranges. Workers attach
+    with np.load(mmap_mode='r'), so every process maps the same pages of the OS page
+    cache instead of holding its own DataFrame, and nothing is copied until a
+    person-day is sliced out.
+    """
+    COLUMNS = TraceStore.COLUMNS
+    INDEX_COLUMNS = {
+        'person': np.int16,
+        'day': np.int32,  # UTC day number since the unix epoch, like the 'date' column
+        'start': np.int64,
+        'stop': np.int64,
+    }
+
+    def __init__(self, shared_dir):
+        self.shared_dir = shared_dir
+        with open(os.path.join(shared_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.columns = {col: np.load(os.path.join(shared_dir, f'{col}.npy'), mmap_mode='r')
+                        for col in SharedTraces.COLUMNS}
+        self.index = {col: np.load(os.path.join(shared_dir, f'index_{col}.npy'), mmap_mode='r')
+                      for col in SharedTraces.INDEX_COLUMNS}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    @property
+    def version(self):
+        return self.meta['version']
+
+    def persons(self):
+        return np.unique(self.index['person']).tolist()
+
+    def dates(self, person):
+        """Sorted 'YYYY-MM-DD' dates on which the person has data"""
+        days = self.index['day'][self.index['person'] == person]
+        return np.datetime_as_string(np.sort(days).astype('datetime64[D]')).tolist()
+
+    def row_range(self, person, date):
+        """(start, stop) rows of a person-day, or (0, 0) if there is no data"""
+        day = np.datetime64(pd.to_datetime(date).date(), 'D').astype(np.int64)
+        match = np.flatnonzero((self.index['person'] == person) & (self.index['day'] == day))
+        if len(match) == 0:
+            return 0, 0
+        return int(self.index['start'][match[0]]), int(self.index['stop'][match[0]])
+
+    def person_day(self, person, date, legacy=True):
+        """
+        Slice one person-day out of the shared columns
+        @param:
+            - legacy: derive the all_plt_data.csv columns, instead of the typed representation
+              (see utils.typed_plt_data)
+        @return:
+            - pd.DataFrame owning a private copy of the rows
+        """
+        start, stop = self.row_range(person, date)
+        frame = pd.DataFrame({col: np.array(values[start:stop]) for col, values in self.columns.items()})
+        return TraceStore.to_legacy(frame) if legacy else typed_plt_data(frame)
+
+    @staticmethod
+    def build(source, shared_dir, version=None):
+        """
+        Write the shared columns and person/date index, and the catalog of person-days (see Catalog)
+        @param:
+            - source: all_plt_data.csv path, TraceStore directory, or a DataFrame with
+              'person', 'lat', 'long', 'altitude' and 'cst_datetime' (or 'cst_epoch') columns
+            - shared_dir: output directory
+            - version: data version to record (defaults to the store version, or 0)
+        """
+        if isinstance(source, pd.DataFrame):
+            frame = source
+        elif os.path.isdir(source):
+            store = TraceStore(source)
+            frame = store.read_frame()
+            version = store.version if version is None else version
+        else:
+            frame = load_all_plt_data(source)
+        if 'cst_epoch' not in frame.columns:
+            frame = frame.assign(cst_epoch=timestamps_s(frame, 'cst_datetime'))
+
+        frame = frame.sort_values(['person', 'cst_epoch'], kind='stable')
+        os.makedirs(shared_dir, exist_ok=True)
+        columns = {col: frame[col].to_numpy(dtype=dtype) for col, dtype in SharedTraces.COLUMNS.items()}
+        for col, values in columns.items():
+            np.save(os.path.join(shared_dir, f'{col}.npy'), values)
+
+        # One index row per person-day, found where either the person or the UTC day changes
+        day = (columns['cst_epoch'] // 86400).astype(np.int32)
+        boundaries = np.flatnonzero((np.diff(columns['person']) != 0) | (np.diff(day) != 0)) + 1
+        starts = np.concatenate([[0], boundaries]) if len(day) else np.empty(0, np.int64)
+        stops = np.concatenate([boundaries, [len(day)]]) if len(day) else np.empty(0, np.int64)
+        index = {
+            'person': columns['person'][starts],
+            'day': day[starts],
+            'start': starts,
+            'stop': stops,
+        }
+        for col, dtype in SharedTraces.INDEX_COLUMNS.items():
+            np.save(os.path.join(shared_dir, f'index_{col}.npy'), np.asarray(index[col], dtype=dtype))
+
+        with open(os.path.join(shared_dir, 'meta.json'), 'w') as f:
+            json.dump({'rows': len(frame), 'version': version or 0}, f)
+        shared = SharedTraces(shared_dir)
+
+        # A store's catalog keeps its valid walking flags and person-day versions
+        catalog = Catalog.find(source) if isinstance(source, str) else None
+        if catalog is None:
+            catalog = Catalog.build(shared)
+        elif catalog.version != version:
+            catalog.update_persons(store, store.persons())
+        catalog.save(os.path.join(shared_dir, CATALOG_FILENAME))
+        return shared
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the memory-mapped dataset shared by all app workers')
+    parser.add_argument('source', help='all_plt_data.csv or a trace store directory')
+    parser.add_argument('shared_dir', help='Output directory')
+    args = parser.parse_args()
+
+    shared = SharedTraces.build(args.source, args.shared_dir)
+    print(f"Wrote {len(shared)} rows for {len(shared.index['start'])} person-days to {args.shared_dir}")
+
+
+if __name__ == '__main__':
+    main()
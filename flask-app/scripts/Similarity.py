@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from .Features import EARTH_RADIUS_M
+
+DEFAULT_OPTIONS = {
+    'cell_size': 100.0,  # m, size of the grid cells a trajectory is reduced to
+    'num_perm': 64,  # MinHash signature length
+    'bands': 32,  # LSH bands of num_perm / bands rows each, the more bands the lower the similarity found
+    'min_points': 10,  # shorter segments are not indexed
+}
+# Columns of each trajectory layer, as in Pipeline.LAYER_COLUMNS
+LAYER_COLUMNS = {
+    'original': ('lat', 'long'),
+    'kalman': ('kalman_lat', 'kalman_long'),
+    'matched': ('matched_lat', 'matched_long'),
+}
+META_COLUMNS = {
+    'person': np.int32,
+    'date': 'U10',
+    'segment': np.int32,
+    'n_points': np.int32,
+}
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def _mix(x):
+    """splitmix64 finalizer: a fast, well distributed hash of uint64 arrays (wrapping on overflow)"""
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def shingles(lat, long, cell_size=100.0):
+    """
+    Reduce a trajectory to its set of grid cell bigrams: the sequence of cell_size grid cells
+    it passes through (without repeats), as hashed pairs of consecutive cells, so two
+    trajectories share shingles where they follow the same route in the same direction
+    @return:
+        - np.ndarray of unique uint64 shingles
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    long = np.asarray(long, dtype=np.float64)
+    valid = ~(np.isnan(lat) | np.isnan(long))
+    lat, long = lat[valid], long[valid]
+    # Sinusoidal projection, so cells have about the same size everywhere
+    y = np.radians(lat) * EARTH_RADIUS_M
+    x = np.radians(long) * EARTH_RADIUS_M * np.cos(np.radians(lat))
+    cell_x = np.floor(x / cell_size).astype(np.int64).view(np.uint64)
+    cell_y = np.floor(y / cell_size).astype(np.int64).view(np.uint64)
+    with np.errstate(over='ignore'):
+        cells = _mix(_mix(cell_x) ^ cell_y)
+    if len(cells) == 0:
+        return cells
+    cells = cells[np.append(True, cells[1:] != cells[:-1])]
+    if len(cells) == 1:
+        return cells
+    with np.errstate(over='ignore'):
+        return np.unique(_mix(cells[:-1] * np.uint64(3) ^ cells[1:]))
+
+
+class TrajectoryIndex:
+    """
+    TrajectoryIndex finds trajectories following the same route as a given one, without
+    comparing it to every other trajectory.
+
+    Every trajectory (a time segment of a person-day) is reduced to its set of grid cell
+    shingles (see shingles), summarized by a MinHash signature whose matching positions
+    estimate the Jaccard similarity of two sets. Signatures are split into bands for
+    locality sensitive hashing: trajectories sharing any whole band are candidates,
+    and only the candidates are ranked by their estimated similarity.
+    """
+    def __init__(self, signatures, meta, options=None):
+        """
+        @param:
+            - signatures: (n, num_perm) np.ndarray of uint32 MinHash values
+            - meta: dict of META_COLUMNS arrays, one value per trajectory
+        """
+        self.options = {**DEFAULT_OPTIONS, **(options or {})}
+        self.signatures = signatures
+        self.meta = meta
+        bands = self.options['bands']
+        rows = self.options['num_perm'] // bands
+        # One sorted array of band keys per band, searched with np.searchsorted
+        self.band_keys = np.empty((bands, len(signatures)), dtype=np.uint64)
+        self.band_order = np.empty((bands, len(signatures)), dtype=np.int64)
+        for band in range(bands):
+            keys = TrajectoryIndex._band_keys(signatures[:, band * rows:(band + 1) * rows])
+            self.band_order[band] = np.argsort(keys, kind='stable')
+            self.band_keys[band] = keys[self.band_order[band]]
+
+    def __len__(self):
+        return len(self.signatures)
+
+    @staticmethod
+    def _band_keys(band_rows):
+        keys = np.zeros(len(band_rows), dtype=np.uint64)
+        for row in band_rows.T:
+            with np.errstate(over='ignore'):
+                keys = _mix(keys * np.uint64(31) + row.astype(np.uint64))
+        return keys
+
+    @staticmethod
+    def seeds(num_perm):
+        """Seeds of the MinHash permutations, the same for every index"""
+        return _mix(np.arange(1, num_perm + 1, dtype=np.uint64))
+
+    @staticmethod
+    def minhash(shingle_sets, num_perm=64, chunk_size=100_000):
+        """
+        MinHash signatures of many shingle sets at once
+        @param:
+            - shingle_sets: list of np.ndarrays of uint64 shingles, all non empty
+        @return:
+            - (len(shingle_sets), num_perm) np.ndarray of uint32
+        """
+        seeds = TrajectoryIndex.seeds(num_perm)
+        signatures = np.empty((len(shingle_sets), num_perm), dtype=np.uint32)
+        # Hash the concatenated sets chunk by chunk, and take the minimum over each set
+        start = 0
+        while start < len(shingle_sets):
+            stop = start + 1
+            size = len(shingle_sets[start])
+            while stop < len(shingle_sets) and size + len(shingle_sets[stop]) <= chunk_size:
+                size += len(shingle_sets[stop])
+                stop += 1
+            tokens = np.concatenate(shingle_sets[start:stop])
+            offsets = np.cumsum([0] + [len(s) for s in shingle_sets[start:stop - 1]])
+            hashes = (_mix(tokens[None, :] ^ seeds[:, None]) & _MASK32).astype(np.uint32)
+            signatures[start:stop] = np.minimum.reduceat(hashes, offsets, axis=1).T
+            start = stop
+        return signatures
+
+    @staticmethod
+    def build(trajectories, **options):
+        """
+        Index trajectories
+        @param:
+            - trajectories: iterable of (person, date, segment, lat, long)
+            - options: overrides for DEFAULT_OPTIONS
+        """
+        options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+        if options['num_perm'] % options['bands']:
+            raise ValueError(f"num_perm ({options['num_perm']}) must be a multiple of bands ({options['bands']})")
+        meta = {col: [] for col in META_COLUMNS}
+        shingle_sets = []
+        for person, date, segment, lat, long in trajectories:
+            if len(lat) < options['min_points']:
+                continue
+            trajectory_shingles = shingles(lat, long, options['cell_size'])
+            if len(trajectory_shingles) == 0:
+                continue
+            shingle_sets.append(trajectory_shingles)
+            for col, value in zip(META_COLUMNS, (person, date, segment, len(lat))):
+                meta[col].append(value)
+        signatures = TrajectoryIndex.minhash(shingle_sets, options['num_perm'])
+        meta = {col: np.asarray(values, dtype=META_COLUMNS[col]) for col, values in meta.items()}
+        return TrajectoryIndex(signatures, meta, options)
+
+    def save(self, path):
+        """Save the signatures and metadata (band keys are rebuilt on load)"""
+        np.savez(path, signatures=self.signatures, options=json.dumps(self.options),
+                 **{f'meta_{col}': values for col, values in self.meta.items()})
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as saved:
+            meta = {col: saved[f'meta_{col}'] for col in META_COLUMNS}
+            return TrajectoryIndex(saved['signatures'], meta, json.loads(str(saved['options'])))
+
+    def signature(self, lat, long):
+        """MinHash signature of a trajectory which isn't necessarily indexed, or None if it is too short"""
+        trajectory_shingles = shingles(lat, long, self.options['cell_size'])
+        if len(trajectory_shingles) == 0:
+            return None
+        return TrajectoryIndex.minhash([trajectory_shingles], self.options['num_perm'])[0]
+
+    def find(self, person, date, segment=None):
+        """Positions of the indexed trajectories of a person-day (and segment)"""
+        match = (self.meta['person'] == person) & (self.meta['date'] == date)
+        if segment is not None:
+            match &= self.meta['segment'] == segment
+        return np.flatnonzero(match)
+
+    def query_signature(self, signature, k=10, exclude=()):
+        """
+        Top-k most similar indexed trajectories of a MinHash signature
+        @param:
+            - exclude: positions to leave out (e.g. the trajectory itself)
+        @return:
+            - positions, similarities: np.ndarrays, most similar first
+        """
+        bands = self.options['bands']
+        rows = self.options['num_perm'] // bands
+        query_keys = TrajectoryIndex._band_keys(signature.reshape(bands, rows))
+        candidates = []
+        for band in range(bands):
+            lo, hi = np.searchsorted(self.band_keys[band], query_keys[band], side='left'), \
+                np.searchsorted(self.band_keys[band], query_keys[band], side='right')
+            candidates.append(self.band_order[band, lo:hi])
+        candidates = np.setdiff1d(np.unique(np.concatenate(candidates)), np.asarray(exclude, dtype=np.int64))
+        if len(candidates) == 0:
+            return candidates, np.empty(0)
+        similarities = (self.signatures[candidates] == signature).mean(axis=1)
+        top = np.argsort(-similarities, kind='stable')[:k]
+        return candidates[top], similarities[top]
+
+    def query(self, person, date, segment=None, k=10):
+        """
+        Top-k trajectories most similar to each indexed segment of a person-day (or to one segment)
+        @return:
+            - pd.DataFrame with the query segment, the similar trajectories' metadata and their
+              estimated Jaccard 'similarity', most similar first for each query segment
+        """
+        positions = self.find(person, date, segment)
+        # Other segments of the same person-day aren't interesting
+        same_day = self.find(person, date)
+        results = []
+        for position in positions:
+            similar, similarities = self.query_signature(self.signatures[position], k, exclude=same_day)
+            result = pd.DataFrame({col: values[similar] for col, values in self.meta.items()})
+            result.insert(0, 'query_segment', int(self.meta['segment'][position]))
+            result['similarity'] = similarities
+            results.append(result)
+        if not results:
+            return pd.DataFrame(columns=['query_segment', *META_COLUMNS, 'similarity'])
+        return pd.concat(results, ignore_index=True)
+
+
+def _split_time_gaps(seconds, time_gap):
+    """Row positions [start, stop) of the runs of fixes without a time gap longer than time_gap"""
+    breaks = np.flatnonzero(np.diff(seconds) > time_gap) + 1
+    bounds = np.concatenate([[0], breaks, [len(seconds)]])
+    return zip(bounds[:-1], bounds[1:])
+
+
+def trajectories_from_data(data, time_gap=60):
+    """
+    Yield the time segments of the original GPS data of every person-day
+    @param:
+        - data: all_plt_data df (see utils.load_all_plt_data), or SharedTraces
+    """
+    from .utils import timestamps_s, typed_plt_data
+
+    if hasattr(data, 'person_day'):
+        person_days = ((person, date, data.person_day(person, date, legacy=False))
+                       for person in data.persons() for date in data.dates(person))
+    else:
+        data = typed_plt_data(data) if 'cst_epoch' not in data.columns else data
+        person_days = ((person, date, person_df) for (person, date), person_df
+                       in data.groupby(['person', 'date'], sort=True, observed=True))
+    for person, date, person_df in person_days:
+        person_df = person_df.sort_values('cst_epoch', kind='stable')
+        lat, long = person_df['lat'].to_numpy(), person_df['long'].to_numpy()
+        for segment, (start, stop) in enumerate(_split_time_gaps(timestamps_s(person_df), time_gap)):
+            yield int(person), str(date), segment, lat[start:stop], long[start:stop]
+
+
+def trajectories_from_cache(cache, layer_type='kalman'):
+    """
+    Yield the stored segments of a layer for every person-day of a ResultCache
+    (see Pipeline.run_incremental), e.g. Kalman filtered or map matched segments
+    """
+    lat_col, long_col = LAYER_COLUMNS[layer_type]
+    for person, date in cache.iter_days():
+        manifest = cache.load_manifest(person, date)
+        for segment, segment_fingerprint in enumerate(manifest['segments']):
+            if not cache.has_segment(person, date, segment_fingerprint):
+                continue
+            segment_layers = cache.load_segment(person, date, segment_fingerprint)
+            if layer_type in segment_layers:
+                layer_df = segment_layers[layer_type]
+                yield person, date, segment, layer_df[lat_col].to_numpy(), layer_df[long_col].to_numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the trajectory similarity index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Index every segment of a dataset or result cache')
+    build_parser.add_argument('source', help='all_plt_data.csv or shared dataset directory (original layer), '
+                                             'or a ResultCache directory (with --layer)')
+    build_parser.add_argument('index', help='Output .npz file')
+    build_parser.add_argument('--layer', choices=list(LAYER_COLUMNS), default='original')
+    build_parser.add_argument('--cell-size', type=float, default=DEFAULT_OPTIONS['cell_size'])
+    build_parser.add_argument('--bands', type=int, default=DEFAULT_OPTIONS['bands'])
+    query_parser = subparsers.add_parser('query', help='Find the trajectories most similar to a person-day')
+    query_parser.add_argument('index', help='.npz file written by build')
+    query_parser.add_argument('person', type=int)
+    query_parser.add_argument('date', help='YYYY-MM-DD')
+    query_parser.add_argument('--segment', type=int, default=None)
+    query_parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        if args.layer != 'original':
+            from .ResultCache import ResultCache
+            trajectories = trajectories_from_cache(ResultCache(args.source), args.layer)
+        elif os.path.isdir(args.source):
+            from .SharedData import SharedTraces
+            trajectories = trajectories_from_data(SharedTraces(args.source))
+        else:
+            from .utils import load_all_plt_data
+            trajectories = trajectories_from_data(load_all_plt_data(args.source))
+        index = TrajectoryIndex.build(trajectories, cell_size=args.cell_size, bands=args.bands)
+        index.save(args.index)
+        print(f"Indexed {len(index)} trajectories in {time.perf_counter() - start:.1f}s")
+        return
+
+    index = TrajectoryIndex.load(args.index)
+    loaded = time.perf_counter()
+    results = index.query(args.person, args.date, args.segment, args.k)
+    print(results.to_string(index=False))
+    print(f"Loaded {len(index)} trajectories in {loaded - start:.2f}s, queried in {time.perf_counter() - loaded:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+from .Features import local_xy
+from .utils import timestamps_s
+
+DEFAULT_OPTIONS = {
+    'dist_threshold': 50.0,  # m, max distance from the stay's centroid
+    'time_threshold': 300.0,  # s, min duration of a stay
+    'max_gap': 60.0,  # s, trips are also split by logging gaps longer than this
+}
+SCALAR_POINTS = 256  # points of each window compared one at a time, before comparing whole blocks
+
+
+def _window_stop(x, y, start, max_dist_sq, size):
+    """
+    End of the window growing from start, comparing blocks of points at once: the running
+    centroids of a block come from np.cumsum, which sums in the same order as growing the
+    window point by point, and blocks grow fourfold while no point falls outside
+    """
+    n = len(x)
+    while True:
+        stop = min(start + size, n)
+        # Centroid of the window [start, j) compared with point j, for every j of the block
+        count = np.arange(1, stop - start)
+        dx = x[start + 1:stop] - np.cumsum(x[start:stop - 1]) / count
+        dy = y[start + 1:stop] - np.cumsum(y[start:stop - 1]) / count
+        outside = np.flatnonzero(dx * dx + dy * dy > max_dist_sq)
+        if len(outside):
+            return start + 1 + int(outside[0])
+        if stop == n:
+            return n
+        size *= 4
+
+
+def detect_staypoints(x, y, seconds, dist_threshold=50.0, time_threshold=300.0):
+    """
+    Linear-time, windowed stay-point detection.
+
+    A window grows from an anchor point while each new point stays within dist_threshold
+    of the window's running centroid. When a point falls outside, the window is a stay if
+    it lasted at least time_threshold, and the next window starts at that point either way.
+    Every point is visited once, unlike the classic detection which restarts the inner
+    scan from every anchor and is O(n^2) on long stationary periods.
+
+    The first SCALAR_POINTS of a window are compared one at a time, which is cheapest for the
+    short windows of moving points. Longer windows (stays, slow walks) are compared in blocks
+    of NumPy operations (see _window_stop), so a long stay costs a few array operations
+    rather than a Python step per point.
+    @param:
+        - x, y: np.ndarrays of local coordinates in meters (see Features.local_xy)
+        - seconds: np.ndarray of timestamps in seconds, sorted
+    @return:
+        - stays: list of (start, stop) row ranges, stop exclusive
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    t = np.asarray(seconds, dtype=np.float64)
+    x_list, y_list, t_list = x.tolist(), y.tolist(), t.tolist()
+    n = len(t)
+    max_dist_sq = dist_threshold ** 2
+
+    stays = []
+    i = 0
+    while i < n:
+        sum_x, sum_y, count = x_list[i], y_list[i], 1
+        j = i + 1
+        while j < n:
+            dx = x_list[j] - sum_x / count
+            dy = y_list[j] - sum_y / count
+            if dx * dx + dy * dy > max_dist_sq:
+                break
+            sum_x += x_list[j]
+            sum_y += y_list[j]
+            count += 1
+            j += 1
+            if count == SCALAR_POINTS:
+                j = _window_stop(x, y, i, max_dist_sq, 4 * SCALAR_POINTS)
+                break
+        if t_list[j - 1] - t_list[i] >= time_threshold:
+            stays.append((i, j))
+        i = j
+    return stays
+
+
+def segment_trips(gps_df: pd.DataFrame, lat_col: str = 'lat', long_col: str = 'long',
+                  time_col: str = 'cst_datetime', **options):
+    """
+    Split a time-ordered person-day into stay points and the walking trips between them
+    @param:
+        - gps_df: time-ordered pd.DataFrame with coordinate and time columns
+        - options: overrides for DEFAULT_OPTIONS
+    @return:
+        - labelled_df: copy of gps_df with 'stay_id' and 'trip_id' columns
+          (-1 where the row is not part of a stay / trip respectively)
+        - stays_df: one row per stay point with its centroid, arrival, departure and duration
+    """
+    options = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+    n = len(gps_df)
+    seconds = timestamps_s(gps_df, time_col)
+    x, y = local_xy(gps_df[lat_col], gps_df[long_col])
+    stays = detect_staypoints(x, y, seconds, options['dist_threshold'], options['time_threshold'])
+
+    # Mark stay rows with a +1/-1 difference array instead of looping over rows
+    stay_id = np.full(n, -1, dtype=np.int64)
+    if stays:
+        starts, stops = np.array(stays).T
+        marks = np.zeros(n + 1, dtype=np.int64)
+        np.add.at(marks, starts, 1)
+        np.add.at(marks, stops, -1)
+        in_stay = np.cumsum(marks[:-1]) > 0
+        stay_id[in_stay] = np.repeat(np.arange(len(stays)), stops - starts)
+    else:
+        starts = stops = np.empty(0, dtype=np.int64)
+        in_stay = np.zeros(n, dtype=bool)
+
+    # A new trip starts after every stay and at every logging gap longer than max_gap
+    new_trip = np.zeros(n, dtype=bool)
+    if n:
+        new_trip[0] = True
+        new_trip[1:] = (in_stay[:-1] & ~in_stay[1:]) | (np.diff(seconds) > options['max_gap'])
+    new_trip &= ~in_stay
+    trip_id = np.cumsum(new_trip) - 1
+    trip_id[in_stay] = -1
+
+    labelled_df = gps_df.copy()
+    labelled_df['stay_id'] = stay_id
+    labelled_df['trip_id'] = trip_id
+
+    # Centroids from cumulative sums, since stays don't cover every row
+    counts = stops - starts
+    centroids = {}
+    for col in (lat_col, long_col):
+        cumulative = np.concatenate([[0.0], np.cumsum(gps_df[col].to_numpy(dtype=np.float64))])
+        centroids[col] = (cumulative[stops] - cumulative[starts]) / np.maximum(counts, 1)
+    stays_df = pd.DataFrame({
+        'stay_id': np.arange(len(stays)),
+        'start': starts,
+        'stop': stops,
+        'lat': centroids[lat_col],
+        'long': centroids[long_col],
+        'arrival': seconds[starts],
+        'departure': seconds[stops - 1],
+    })
+    stays_df['duration'] = stays_df['departure'] - stays_df['arrival']
+    return labelled_df, stays_df
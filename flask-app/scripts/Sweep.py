@@ -0,0 +1,136 @@
+import argparse
+import itertools
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .utils import filter_person_and_date, load_all_plt_data
+from .Pipeline import Pipeline
+from .Quality import match_metrics, METRIC_COLUMNS
+
+# Parameters of the Kalman stage, which are shared by every Meili variant
+KALMAN_PARAMS = ['n_iter', 'time_segment']
+MATCH_PARAMS = ['search_radius', 'gps_accuracy', 'breakage_distance', 'interpolation_distance']
+
+DEFAULT_GRID = {
+    'n_iter': [5],
+    'time_segment': [60],
+    'search_radius': [25, 50],
+    'gps_accuracy': [5, 10],
+    'breakage_distance': [2000],
+    'interpolation_distance': [10],
+}
+
+
+def _combinations(grid, keys):
+    """All combinations of the grid values of the given keys, as dicts"""
+    values = [grid.get(key, [None]) for key in keys]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def _run_task(task):
+    """
+    Worker: Kalman filter one person-day once for one Kalman combination, then map match
+    the (shared) Kalman output with every Meili combination
+    """
+    person, date, person_df, kalman_params, match_combinations = task
+    rows = []
+    start = time.perf_counter()
+    kalman_df = Pipeline.kalman_step(person_df, kalman_params['n_iter'], kalman_params['time_segment'])
+    kalman_seconds = time.perf_counter() - start
+
+    colnames = ['kalman_lat', 'kalman_long', 'cst_datetime']
+    for match_params in match_combinations:
+        row = {'person': person, 'date': date, **kalman_params, **match_params, 'kalman_seconds': kalman_seconds}
+        start = time.perf_counter()
+        try:
+            match_options = {k: v for k, v in match_params.items() if v is not None}
+            trace_df = Pipeline.match_step(kalman_df, colnames, match_options)
+            row.update(match_metrics(trace_df, kalman_df, colnames))
+        except Exception as e:
+            print(f"Person {person}, {date}, {match_params}: {e}")
+            row['error'] = str(e)
+        row['match_seconds'] = time.perf_counter() - start
+        rows.append(row)
+    return rows
+
+
+def run_sweep(data: pd.DataFrame, person_days, grid=None, workers=None) -> pd.DataFrame:
+    """
+    Run every combination of the parameter grid on a sample of person-days, across a process pool.
+    Segmentation and Kalman output are computed once per (person-day, Kalman combination)
+    and reused by all Meili combinations.
+    @param:
+        - data: all_plt_data df
+        - person_days: list of (person, 'YYYY-MM-DD') tuples
+        - grid: dict of {parameter: list of values}, see DEFAULT_GRID
+        - workers: number of worker processes
+    @return:
+        - results_df: one row per (person-day, parameter combination) with its metrics
+    """
+    grid = {**DEFAULT_GRID, **(grid or {})}
+    match_combinations = _combinations(grid, MATCH_PARAMS)
+    tasks = []
+    for person, date in person_days:
+        person_df = filter_person_and_date(data, person, date)
+        for kalman_params in _combinations(grid, KALMAN_PARAMS):
+            tasks.append((person, date, person_df, kalman_params, match_combinations))
+
+    print(f"Sweeping {len(tasks) * len(match_combinations)} runs over {len(person_days)} person-days")
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for task_rows in executor.map(_run_task, tasks):
+            rows.extend(task_rows)
+    return pd.DataFrame(rows)
+
+
+def compare(results_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Average the metrics of each parameter combination over all person-days, best first,
+    with the number of failed runs of each combination in 'n_errors'
+    """
+    param_cols = [col for col in KALMAN_PARAMS + MATCH_PARAMS if col in results_df.columns]
+    metric_cols = [col for col in METRIC_COLUMNS + ['kalman_seconds', 'match_seconds'] if col in results_df.columns]
+    groups = results_df.groupby(param_cols, dropna=False)
+    table = groups[metric_cols].mean()
+    table['n_errors'] = groups['error'].count() if 'error' in results_df.columns else 0
+    table = table.reset_index()
+    # Runs which failed have no metrics, and if they all failed (e.g. Valhalla is down) there's nothing to rank
+    sort_cols = [col for col in ['matched_ratio', 'avg_snap_distance'] if col in table.columns]
+    if not sort_cols:
+        print("Every run failed, see the 'error' column of the results")
+        return table
+    return table.sort_values(sort_cols, ascending=[col == 'avg_snap_distance' for col in sort_cols], ignore_index=True)
+
+
+def sample_person_days(data: pd.DataFrame, n: int, seed: int = 0):
+    """Randomly sample n distinct (person, 'YYYY-MM-DD') pairs from data"""
+    person_days = data[['person', 'date']].drop_duplicates()
+    person_days = person_days.sample(n=min(n, len(person_days)), random_state=seed)
+    return [(int(person), pd.to_datetime(date).strftime('%Y-%m-%d')) for person, date in person_days.itertuples(index=False)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep Kalman and Meili parameters over a sample of person-days')
+    parser.add_argument('data', help='all_plt_data.csv')
+    parser.add_argument('--grid', default=None, help='JSON file of {parameter: [values]}')
+    parser.add_argument('--sample', type=int, default=10, help='Number of person-days to sample')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default='sweep_results.csv', help='Per-run results output')
+    args = parser.parse_args()
+
+    grid = None
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+    data = load_all_plt_data(args.data)
+    results_df = run_sweep(data, sample_person_days(data, args.sample, args.seed), grid, args.workers)
+    results_df.to_csv(args.out, index=False)
+    print(compare(results_df).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import json
+import os
+from datetime import timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+# Geolife timestamps are UTC; the rest of the project displays them in China Standard Time
+CST = timezone(timedelta(hours=8))
+# 'date_numb_days' counts days since 1899-12-30, which is 25569 days before the unix epoch
+EXCEL_EPOCH_OFFSET_DAYS = 25569
+
+
+class TraceStore:
+    """
+    TraceStore is a person-partitioned columnar store for GPS traces.
+
+    Every partition ('person=<id>') holds one or more append-only parts, and every part
+    holds one .npy file per column, so partitions can be read (or memory-mapped) one
+    column at a time. A manifest keeps track of all parts, the content hashes of all
+    ingested source files and a data version which is bumped on every append.
+    """
+    COLUMNS = {
+        'person': np.int16,
+        'lat': np.float64,
+        'long': np.float64,
+        'altitude': np.float32,
+        'cst_epoch': np.int64,  # seconds since the unix epoch
+    }
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    def _load_manifest(self):
+        path = os.path.join(self.root, self.MANIFEST)
+        if not os.path.exists(path):
+            return {'version': 0, 'parts': {}, 'sources': {}}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_manifest(self):
+        # Write to a temporary file first so a crashed ingest never leaves a corrupt manifest
+        path = os.path.join(self.root, self.MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(path + '.tmp', path)
+
+    def has_source(self, digest):
+        """Whether a source file with the given content hash was already ingested"""
+        return digest in self.manifest['sources']
+
+    def source_digests(self):
+        return set(self.manifest['sources'])
+
+    def persons(self):
+        return sorted(int(person) for person in self.manifest['parts'])
+
+    def append(self, person, columns, sources=None):
+        """
+        Append a new part to a person's partition
+        @param:
+            - person: int id of the person
+            - columns: dict (or pd.DataFrame) with at least the 'lat', 'long', 'altitude'
+              and 'cst_epoch' columns
+            - sources: optional dict of {content hash: source path} ingested into this part
+        @return:
+            - name of the new part
+        """
+        n_rows = len(columns['cst_epoch'])
+        order = np.argsort(np.asarray(columns['cst_epoch']), kind='stable')
+
+        parts = self.manifest['parts'].setdefault(str(person), [])
+        part_name = f'part-{len(parts):05d}'
+        part_dir = os.path.join(self.root, f'person={person}', part_name)
+        os.makedirs(part_dir, exist_ok=True)
+
+        for col, dtype in self.COLUMNS.items():
+            if col == 'person':
+                values = np.full(n_rows, person, dtype=dtype)
+            else:
+                values = np.asarray(columns[col], dtype=dtype)[order]
+            np.save(os.path.join(part_dir, f'{col}.npy'), values)
+
+        parts.append(part_name)
+        for digest, path in (sources or {}).items():
+            self.manifest['sources'][digest] = {'path': path, 'person': person, 'part': part_name}
+        self.manifest['version'] += 1
+        self._save_manifest()
+        return part_name
+
+    def part_dirs(self, person):
+        return [os.path.join(self.root, f'person={person}', part)
+                for part in self.manifest['parts'].get(str(person), [])]
+
+    def read(self, person, columns=None, mmap=False):
+        """
+        Read the columns of one person's partition as numpy arrays, sorted by time
+        @param:
+            - person: int id of the person
+            - columns: list of column names to read (default: all)
+            - mmap: memory-map the column files instead of loading them (single part only)
+        @return:
+            - dict of {column name: np.ndarray}
+        """
+        columns = columns or list(self.COLUMNS)
+        part_dirs = self.part_dirs(person)
+        mmap_mode = 'r' if mmap and len(part_dirs) == 1 else None
+        arrays = {col: [np.load(os.path.join(d, f'{col}.npy'), mmap_mode=mmap_mode) for d in part_dirs]
+                  for col in set(columns) | {'cst_epoch'}}
+
+        if len(part_dirs) == 1:
+            return {col: arrays[col][0] for col in columns}
+
+        # Parts are each sorted, but appended data may interleave with older parts
+        epoch = np.concatenate(arrays['cst_epoch']) if part_dirs else np.empty(0, np.int64)
+        order = np.argsort(epoch, kind='stable')
+        result = {}
+        for col in columns:
+            values = np.concatenate(arrays[col]) if part_dirs else np.empty(0, self.COLUMNS[col])
+            result[col] = values[order]
+        return result
+
+    def read_days(self, person, columns=None):
+        """
+        Read one person's partition one UTC day at a time (like the 'date' column), without
+        ever holding more than a day of rows: every part is memory-mapped and each day is found
+        by binary search on its sorted 'cst_epoch' column
+        @param:
+            - person: int id of the person
+            - columns: list of column names to read (default: all)
+        @return:
+            - generator of ('YYYY-MM-DD', dict of {column name: np.ndarray}) in date order
+        """
+        columns = columns or list(self.COLUMNS)
+        parts = [{col: np.load(os.path.join(d, f'{col}.npy'), mmap_mode='r') for col in set(columns) | {'cst_epoch'}}
+                 for d in self.part_dirs(person)]
+        positions = [0] * len(parts)
+        while True:
+            remaining = [p for p, part in enumerate(parts) if positions[p] < len(part['cst_epoch'])]
+            if not remaining:
+                return
+            day = min(int(parts[p]['cst_epoch'][positions[p]]) // 86400 for p in remaining)
+            stops = [int(np.searchsorted(part['cst_epoch'], (day + 1) * 86400)) for part in parts]
+            arrays = {col: np.concatenate([np.asarray(part[col][start:stop]) for part, start, stop
+                                           in zip(parts, positions, stops)])
+                      for col in set(columns) | {'cst_epoch'}}
+            if len(parts) > 1:
+                # Parts are each sorted, but appended data may interleave with older parts
+                order = np.argsort(arrays['cst_epoch'], kind='stable')
+                arrays = {col: values[order] for col, values in arrays.items()}
+            positions = stops
+            yield str(np.datetime64(day, 'D')), {col: arrays[col] for col in columns}
+
+    def read_frame(self, person=None, legacy=False):
+        """
+        Read one person (or every person) as a DataFrame
+        @param:
+            - person: int id of the person, or None for the whole store
+            - legacy: also derive the all_plt_data.csv columns ('zero', 'date_numb_days',
+              'date', 'time', 'cst_datetime', 'cst_weekday')
+        """
+        persons = self.persons() if person is None else [person]
+        frames = [pd.DataFrame(self.read(p)) for p in persons]
+        if not frames:
+            frame = pd.DataFrame({col: np.empty(0, dtype) for col, dtype in self.COLUMNS.items()})
+        else:
+            frame = pd.concat(frames, ignore_index=True)
+        if legacy:
+            frame = TraceStore.to_legacy(frame)
+        return frame
+
+    @staticmethod
+    def to_legacy(frame):
+        """
+        Derive the all_plt_data.csv columns from the 'cst_epoch' column
+        """
+        utc = pd.to_datetime(frame['cst_epoch'], unit='s', utc=True)
+        cst = utc.dt.tz_convert(CST)
+        legacy = pd.DataFrame({
+            'person': frame['person'].astype('int64'),
+            'lat': frame['lat'],
+            'long': frame['long'],
+            'zero': 0,
+            'altitude': frame['altitude'].astype('float64'),
+            'date_numb_days': frame['cst_epoch'] / 86400 + EXCEL_EPOCH_OFFSET_DAYS,
+            'date': utc.dt.strftime('%Y-%m-%d'),
+            'time': utc.dt.strftime('%H:%M:%S'),
+            'cst_datetime': cst.astype(str),
+            'cst_weekday': cst.dt.weekday,
+        })
+        return legacy
@@ -1,24 +1,101 @@
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
 
 # This file contains utility functions for preparing GPS data 
 # for kalman filtering and visualization
 
+# Compact dtypes of the typed all_plt_data representation (see load_all_plt_data)
+TYPED_DTYPES = {
+    'person': np.int16,
+    'lat': np.float64,
+    'long': np.float64,
+    'altitude': np.float32,
+    'cst_epoch': np.int64,  # seconds since the unix epoch
+}
+
+
+def typed_plt_data(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert all_plt_data (or TraceStore / SharedTraces columns) to the typed representation:
+    compact dtypes, timestamps parsed once to int64 'cst_epoch', and the UTC 'date' as a
+    categorical of 'YYYY-MM-DD' strings. The redundant 'zero', 'date_numb_days', 'time',
+    'cst_datetime' and 'cst_weekday' columns are dropped; create_geodataframe derives the
+    displayed times again.
+    """
+    from .TraceStore import EXCEL_EPOCH_OFFSET_DAYS
+
+    if 'cst_epoch' in frame.columns:
+        cst_epoch = frame['cst_epoch'].to_numpy(dtype=np.int64)
+    elif 'date_numb_days' in frame.columns:
+        days = frame['date_numb_days'].to_numpy(dtype=np.float64) - EXCEL_EPOCH_OFFSET_DAYS
+        cst_epoch = np.rint(days * 86400).astype(np.int64)
+    else:
+        cst_epoch = timestamps_s(frame, 'cst_datetime')
+
+    typed = pd.DataFrame({col: frame[col].to_numpy(dtype=dtype)
+                          for col, dtype in TYPED_DTYPES.items() if col != 'cst_epoch'})
+    typed['cst_epoch'] = cst_epoch
+    # Format each distinct day once, instead of every row
+    days, codes = np.unique(cst_epoch // 86400, return_inverse=True)
+    categories = np.datetime_as_string(days.astype('datetime64[D]'))
+    typed['date'] = pd.Categorical.from_codes(codes.ravel(), categories=categories)
+    return typed
+
+
+def load_all_plt_data(path) -> pd.DataFrame:
+    """
+    Load all_plt_data.csv into the typed representation (see typed_plt_data), only
+    reading the columns it needs, with their final dtypes
+    """
+    frame = pd.read_csv(path, usecols=['person', 'lat', 'long', 'altitude', 'date_numb_days'],
+                        dtype={'person': np.int16, 'altitude': np.float32, 'date_numb_days': np.float64})
+    return typed_plt_data(frame)
+
+
 def filter_person_and_date(data: pd.DataFrame, person: int, date: str):
     """
     Filter all_plt_data for a specific person and date.
     @param:
-        - data: all_plt_data df (or any df with c('person', 'lat', 'long', 'date', 'time') columns)
+        - data: all_plt_data df (or any df with c('person', 'lat', 'long', 'date', 'time') columns),
+          or its typed representation (see typed_plt_data)
         - person: int corresponding to the person (e.g. 161)
         - date: str in the format 'YYYY-MM-DD'
     """
     person_data = data[data['person'] == person]
+    if isinstance(person_data['date'].dtype, pd.CategoricalDtype):
+        # Typed dates are already 'YYYY-MM-DD' strings, compared by category code
+        return person_data[person_data['date'] == pd.to_datetime(date).strftime('%Y-%m-%d')]
     person_data.loc[:, 'date'] = pd.to_datetime(person_data['date']).dt.date
     person_data = person_data[person_data['date'] == pd.to_datetime(date).date()]
     return person_data
 
 
+def person_days_in_range(data, persons, start_date=None, end_date=None):
+    """
+    List the person-days with data for several persons over a date range
+    @param:
+        - data: all_plt_data df (raw or typed, see typed_plt_data), or SharedTraces
+        - persons: list of ints
+        - start_date, end_date: inclusive 'YYYY-MM-DD' bounds, None for no bound
+    @return:
+        - person_days: sorted list of (person, 'YYYY-MM-DD') tuples
+    """
+    start = pd.to_datetime(start_date).strftime('%Y-%m-%d') if start_date else None
+    end = pd.to_datetime(end_date).strftime('%Y-%m-%d') if end_date else None
+    person_days = []
+    for person in sorted(set(persons)):
+        if hasattr(data, 'dates'):
+            dates = data.dates(person)
+        else:
+            person_dates = data.loc[data['person'] == person, 'date']
+            if not isinstance(person_dates.dtype, pd.CategoricalDtype):
+                person_dates = pd.to_datetime(person_dates).dt.strftime('%Y-%m-%d')
+            dates = sorted(set(person_dates.astype(str)))
+        person_days.extend((person, date) for date in dates
+                           if (start is None or date >= start) and (end is None or date <= end))
+    return person_days
+
+
 def create_geodataframe(gps_df, lat_col: str, long_col: str):
     """
     Converts DataFrame to GeoDataFrame with specified latitude and longitude columns
@@ -29,13 +106,40 @@ def create_geodataframe(gps_df, lat_col: str, long_col: str):
     @return:
         - gdf: gpd.GeoDataFrame
     """
+    # geopandas and shapely are imported lazily, as most callers never build GeoDataFrames
+    import geopandas as gpd
+    from shapely.geometry import Point
+
     gps_gdf = gpd.GeoDataFrame(
         gps_df, 
         geometry=[Point(xy) for xy in zip(gps_df[long_col], gps_df[lat_col])]
     )
     gps_gdf.crs = {'init': 'epsg:4326'}  # Define coordinate reference system
+    if 'cst_datetime' not in gps_gdf.columns and 'cst_epoch' in gps_gdf.columns:
+        # Typed data only keeps the epoch, so derive the displayed times
+        from .TraceStore import CST
+        utc = pd.to_datetime(gps_gdf['cst_epoch'], unit='s', utc=True)
+        gps_gdf['cst_datetime'] = utc.dt.tz_convert(CST)
+        gps_gdf['time'] = utc.dt.strftime('%H:%M:%S')
     gps_gdf['cst_datetime'] = gps_gdf['cst_datetime'].astype(str)
     gps_gdf['date'] = pd.to_datetime(gps_gdf['date']).dt.date.astype(str)
     gps_gdf['time'] = gps_gdf['time'].astype(str)
 
-    return gps_gdf
\ No newline at end of file
+    return gps_gdf
+
+
+def timestamps_s(gps_df, time_col: str = 'cst_datetime'):
+    """
+    Get the timestamps of a DataFrame as int64 seconds since the unix epoch
+    @param:
+        - gps_df: pd.DataFrame with a datetime (or datetime string) column
+        - time_col: name of the time column
+    @return:
+        - np.ndarray of int64 seconds
+    """
+    if time_col == 'cst_datetime' and 'cst_epoch' in gps_df.columns:
+        # Already parsed (see typed_plt_data)
+        return gps_df['cst_epoch'].to_numpy(dtype=np.int64)
+    datetimes = pd.to_datetime(gps_df[time_col], utc=True)
+    seconds = (datetimes - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    return seconds.to_numpy(dtype=np.int64)
@@ -2,6 +2,9 @@
 var map = L.map('map').setView([39.926117, 116.315750], 13);
 var layerControl;
 var currentLayers = [];
+var streamSource = null; // EventSource of the running /preprocess_stream request
+var heatLayer = null; // density of the whole corpus, see updateHeatmap
+var heatmapRequest = null;
 
 L.tileLayer('https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png', {
     maxZoom: 20,
@@ -82,7 +85,15 @@ function circles(parsedData, coordType)
             // Attach a tooltip to each feature
             // Uppercase the first letter of the type
             var tooltipTitle = feature.properties.type.charAt(0).toUpperCase() + feature.properties.type.slice(1);
-            layer.bindTooltip(`<strong>${tooltipTitle}</strong><br>Coordinates: ${feature.geometry.coordinates[1]}, ${feature.geometry.coordinates[0]}<br>Time: ${feature.properties.time}`, {
+            var tooltipText = `<strong>${tooltipTitle}</strong><br>Coordinates: ${feature.geometry.coordinates[1]}, ${feature.geometry.coordinates[0]}<br>Time: ${feature.properties.time}`;
+            // Kinematic features are only present if requested in the preprocess form
+            if (feature.properties.speed !== undefined && feature.properties.speed !== null) {
+                tooltipText += `<br>Speed: ${feature.properties.speed.toFixed(2)} m/s`;
+            }
+            if (feature.properties.outlier) {
+                tooltipText += '<br><em>Outlier (dropped by pre-filter)</em>';
+            }
+            layer.bindTooltip(tooltipText, {
                 permanent: false,  // true if you want it always displayed
                 direction: 'auto'  // it will position the tooltip where there is space
             });
@@ -105,14 +116,41 @@ function circles(parsedData, coordType)
 }
 
 function initMap(person, date) {
-    $.post('/init_map', { person: person, date: date }, function(gdfJson) {
+    if (streamSource) {
+        streamSource.close();
+        streamSource = null;
+    }
+    // GET, so the browser can revalidate its cached copy (see HttpCache)
+    $.get('/init_map', { person: person, date: date }, function(gdfJson) {
         updateMapWithGeoJson(JSON.parse(gdfJson));
     }).fail(function(error) {
         console.error("Error loading initial map data:", error);
     });
 }
 
-function updateMapWithGeoJson(parsedGPSData) {
+function dateLabel(row) {
+    // Catalog rows (see scripts.Catalog) tell how large each day is before loading it
+    if (row.n_points === undefined) {
+        return row.date;
+    }
+    var km = (row.distance_m / 1000).toFixed(1);
+    var hours = (row.duration_s / 3600).toFixed(1);
+    return `${row.date} (${row.n_points} pts, ${km} km, ${hours} h)`;
+}
+
+function validFeatures(features) {
+    // Filter potential null geometry and coordinates
+    return features.filter(f => 
+        f.geometry && 
+        f.geometry.coordinates && 
+        Array.isArray(f.geometry.coordinates) && 
+        f.geometry.coordinates.length === 2 && 
+        f.geometry.coordinates[0] !== null && 
+        f.geometry.coordinates[1] !== null
+    );
+}
+
+function updateMapWithGeoJson(parsedGPSData, byPersonDay = false) {
     if (!parsedGPSData || !Array.isArray(parsedGPSData.features)) {
         console.error('Invalid GPS data or features array');
         return;
@@ -120,30 +158,27 @@ function updateMapWithGeoJson(parsedGPSData) {
 
     var allCoords = [];
     var overlays = {};
-    var coordTypes = [...new Set(parsedGPSData.features.map(f => f.properties.type))];
+    // Responses of several person-days have separate layers for each person and date
+    var layerName = f => byPersonDay
+        ? `${f.properties.type} (${f.properties.person}, ${f.properties.date})`
+        : f.properties.type;
+    var layerNames = [...new Set(parsedGPSData.features.map(layerName))];
 
     clearLayers(); // Clears existing layers and control
 
-    coordTypes.forEach(coordType => {
-        var features = parsedGPSData.features.filter(f => f.properties.type === coordType);
-
-        // Filter potential null geometry and coordinates
-        var filteredFeatures = features.filter(f => 
-            f.geometry && 
-            f.geometry.coordinates && 
-            Array.isArray(f.geometry.coordinates) && 
-            f.geometry.coordinates.length === 2 && 
-            f.geometry.coordinates[0] !== null && 
-            f.geometry.coordinates[1] !== null
-        );
+    layerNames.forEach(name => {
+        var features = parsedGPSData.features.filter(f => layerName(f) === name);
+        var coordType = features[0].properties.type;
+
+        var filteredFeatures = validFeatures(features);
         var polylineLayer = polyline(filteredFeatures.map(f => f.geometry.coordinates), coordType);
         var circleLayer = circles({ type: 'FeatureCollection', features: filteredFeatures }, coordType);
 
         currentLayers.push(polylineLayer);
         currentLayers.push(circleLayer);
 
-        overlays[`Polyline: ${coordType}`] = polylineLayer;
-        overlays[`Points: ${coordType}`] = circleLayer;
+        overlays[`Polyline: ${name}`] = polylineLayer;
+        overlays[`Points: ${name}`] = circleLayer;
 
         filteredFeatures.forEach(feature => {
             allCoords.push([feature.geometry.coordinates[1], feature.geometry.coordinates[0]]);
@@ -174,6 +209,118 @@ function addLayersToMap(overlays, allCoords) {
     }
 }
 
+function updateHeatmap() {
+    // Only the cells of the current viewport and zoom level are fetched (see scripts.Heatmap)
+    if (!$('#heatmap').is(':checked')) {
+        return;
+    }
+    if (heatmapRequest) {
+        heatmapRequest.abort();
+    }
+    var bounds = map.getBounds();
+    var params = {
+        zoom: map.getZoom(),
+        bbox: [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()].join(','),
+        bucket: $('#heatmapBucket').val()
+    };
+    heatmapRequest = $.get('/heatmap', params, function(response) {
+        heatmapRequest = null;
+        if (response.time_bucket && $('#heatmapBucket option').length === 1) {
+            var names = {
+                'hour': Array.from({ length: 24 }, (_, h) => `${h}:00`),
+                'weekday': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+                'month': ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August',
+                          'September', 'October', 'November', 'December']
+            }[response.time_bucket];
+            names.forEach((name, bucket) => $('#heatmapBucket').append($('<option>', { value: bucket, text: name })));
+            $('#heatmapBucket').show();
+        }
+        if (!heatLayer) {
+            heatLayer = L.heatLayer([], { radius: 12, blur: 15, minOpacity: 0.2 }).addTo(map);
+        }
+        heatLayer.setOptions({ max: response.max });
+        heatLayer.setLatLngs(response.points);
+    }).fail(function(error) {
+        heatmapRequest = null;
+        if (error.statusText !== 'abort') {
+            console.error('Error loading the heatmap', error);
+            $('#heatmap').prop('checked', false);
+        }
+    });
+}
+
+function preprocessMany(formData) {
+    // Several person-days are preprocessed at once on the server, and returned as one response
+    if (streamSource) {
+        streamSource.close();
+        streamSource = null;
+    }
+    $.post('/preprocess', formData, function(response) {
+        response.errors.forEach(error => console.error(`Error processing person ${error.person}, ${error.date}:`, error.error));
+        updateMapWithGeoJson(response, true);
+    }).fail(function(error) {
+        console.error('Error processing the request', error);
+    });
+}
+
+function streamPreprocess(formData) {
+    // Layers are drawn as they arrive: original first, then kalman, then matched chunks
+    if (streamSource) {
+        streamSource.close();
+    }
+    clearLayers();
+    var overlays = {};
+    var fitted = false;
+
+    streamSource = new EventSource('/preprocess_stream?' + $.param(formData));
+    streamSource.addEventListener('layer', function(event) {
+        var layerData = JSON.parse(event.data);
+        var features = validFeatures(layerData.features);
+        var coordTypes = [...new Set(features.map(f => f.properties.type))];
+
+        // Chunks of the same layer are added to the same overlays
+        coordTypes.forEach(coordType => {
+            var typeFeatures = features.filter(f => f.properties.type === coordType);
+            if (!overlays[`Polyline: ${coordType}`]) {
+                overlays[`Polyline: ${coordType}`] = L.layerGroup();
+                overlays[`Points: ${coordType}`] = L.layerGroup();
+                currentLayers.push(overlays[`Polyline: ${coordType}`], overlays[`Points: ${coordType}`]);
+                map.addLayer(overlays[`Polyline: ${coordType}`]);
+                map.addLayer(overlays[`Points: ${coordType}`]);
+            }
+            overlays[`Polyline: ${coordType}`].addLayer(polyline(typeFeatures.map(f => f.geometry.coordinates), coordType));
+            overlays[`Points: ${coordType}`].addLayer(circles({ type: 'FeatureCollection', features: typeFeatures }, coordType));
+        });
+        if (coordTypes.length === 0) {
+            return;
+        }
+
+        if (layerControl) {
+            layerControl.remove();
+        }
+        layerControl = L.control.layers(null, overlays, { collapsed: true });
+        layerControl.addTo(map);
+
+        // Only zoom to the first layer, so the map doesn't jump around as chunks arrive
+        if (!fitted) {
+            map.fitBounds(features.map(f => [f.geometry.coordinates[1], f.geometry.coordinates[0]]));
+            fitted = true;
+        }
+    });
+    streamSource.addEventListener('pipeline_error', function(event) {
+        console.error('Error processing the request', JSON.parse(event.data));
+    });
+    streamSource.addEventListener('done', function() {
+        streamSource.close();
+        streamSource = null;
+    });
+    streamSource.onerror = function(error) {
+        console.error('Lost connection to the preprocessing stream', error);
+        streamSource.close();
+        streamSource = null;
+    };
+}
+
 $(document).ready(function() {
     
     // Handle form submissions
@@ -184,51 +331,66 @@ $(document).ready(function() {
         initMap(person, date);
     });
 
-    $('#preprocessForm').submit(async function(event) {
+    $('#preprocessForm').submit(function(event) {
         event.preventDefault();
         var formData = {
             person: $('#person').val(),
             date: $('#date').val(),
+            prefilter: $('#prefilter').is(':checked'),
+            maxSpeed: $('#maxSpeed').val(),
+            maxAcceleration: $('#maxAcceleration').val(),
+            maxMedianDistance: $('#maxMedianDistance').val(),
+            compress: $('#compress').is(':checked'),
+            stayRadius: $('#stayRadius').val(),
+            stayMinDuration: $('#stayMinDuration').val(),
+            resampleInterval: $('#resampleInterval').val(),
             kalmanFilter: $('#kalmanFilter').is(':checked'),
             n_iter: $('#n_iter').val(),
             timeSegment: $('#timeSegment').val(),
+            segmentMode: $('#segmentMode').val(),
             mapMatch: $('#mapMatch').is(':checked'),
+            matcher: $('#matcher').val(),
             searchRadius: $('#searchRadius').val(),
             gpsAccuracy: $('#gpsAccuracy').val(),
             breakageDistance: $('#breakageDistance').val(),
-            interpolationDistance: $('#interpolationDistance').val()
+            interpolationDistance: $('#interpolationDistance').val(),
+            kinematics: $('#kinematics').is(':checked')
         };
+        var otherPersons = $('#otherPersons').val().split(',').map(p => p.trim()).filter(p => p);
+        var endDate = $('#endDate').val().trim();
         console.log('Form data:', formData);
-    
-        try {
-            var response = await $.ajax({
-                url: '/preprocess',
-                type: 'POST',
-                data: formData,
-                dataType: 'json', // Expecting JSON response
-                contentType: 'application/x-www-form-urlencoded; charset=UTF-8'
-            });
-            console.log(response);
-            if (typeof response === 'string') {
-                response = JSON.parse(response); // Parse the string to an object
-            }
-            updateMapWithGeoJson(response); // response is already a JavaScript object
-        } catch (error) {
-            console.error('Error processing the request', error);
+        if (otherPersons.length > 0 || endDate) {
+            formData.person = [formData.person, ...otherPersons].join(',');
+            formData.startDate = formData.date;
+            formData.endDate = endDate || formData.date;
+            preprocessMany(formData);
+        } else {
+            streamPreprocess(formData);
+        }
+    });
+
+    $('#heatmap').change(function() {
+        if (this.checked) {
+            updateHeatmap();
+        } else if (heatLayer) {
+            map.removeLayer(heatLayer);
+            heatLayer = null;
         }
     });
+    $('#heatmapBucket').change(updateHeatmap);
+    map.on('moveend', updateHeatmap);
 
     // Load initial person and date information
     $('#person').change(function() {
         var personId = $(this).val();
         $.ajax({
-            url: '/dates/' + personId,
+            url: '/dates/' + personId + '?details=1',
             type: 'GET',
             success: function(response) {
                 var dateSelect = $('#date');
                 dateSelect.empty();
-                response.forEach(function(date) {
-                    dateSelect.append($('<option>', { value: date, text: date }));
+                response.forEach(function(row) {
+                    dateSelect.append($('<option>', { value: row.date, text: dateLabel(row) }));
                 });
                 // Trigger initial map load
                 var initialPerson = $('#person').val();
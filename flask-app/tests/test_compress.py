@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from scripts.Compress import compress
+
+# 1 Hz fixes near Beijing
+LAT0, LONG0 = 39.9, 116.3
+M_PER_DEG_LAT = 111_195.0
+M_PER_DEG_LONG = M_PER_DEG_LAT * np.cos(np.radians(LAT0))
+
+
+def trace(east_m, north_m):
+    return pd.DataFrame({
+        'lat': LAT0 + np.asarray(north_m) / M_PER_DEG_LAT,
+        'long': LONG0 + np.asarray(east_m) / M_PER_DEG_LONG,
+        'cst_datetime': pd.Timestamp('2008-06-13 08:00') + pd.to_timedelta(np.arange(len(east_m)), unit='s'),
+    })
+
+
+def test_jittered_stay_collapses():
+    # 600 s standing still with 2-4 m of GPS jitter, around a grid cell corner
+    rng = np.random.default_rng(0)
+    radius = rng.uniform(2, 4, 600)
+    angle = rng.uniform(0, 2 * np.pi, 600)
+    compressed = compress(trace(radius * np.cos(angle), radius * np.sin(angle)))
+    assert len(compressed) == 1
+    assert compressed['duration'].iloc[0] == 599
+
+
+def test_walk_is_kept():
+    # Walking east at 1.4 m/s, then standing still for 60 s
+    east_m = np.append(1.4 * np.arange(100), np.full(60, 140.0))
+    compressed = compress(trace(east_m, np.zeros(160)))
+    assert (compressed['orig_stop'] - compressed['orig_start']).iloc[:-1].eq(1).all()
+    assert compressed['orig_start'].iloc[-1] < 100 and compressed['orig_stop'].iloc[-1] == 160
@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from scripts.TraceStore import TraceStore
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# No map matching, so the test doesn't need a Valhalla server, and no Kalman filter to keep it fast
+PARAMS = {'kalman_filter': False, 'time_segment': 60, 'map_match': False}
+MEMORY_BUDGET_MB = 16
+MAX_RSS_MB = 400  # imported modules included
+ROWS_PER_DAY = 1_000
+
+RUN = """
+import json, sys
+from scripts.OutOfCore import peak_rss_mb, run
+from scripts.TraceStore import TraceStore
+run(TraceStore(sys.argv[1]), sys.argv[2], json.loads(sys.argv[3]), float(sys.argv[4]))
+print(json.dumps(peak_rss_mb()))
+"""
+
+
+def make_store(root, n_persons, n_days):
+    """A store of 1 Hz walks, of ROWS_PER_DAY points per person-day"""
+    store = TraceStore(root)
+    rng = np.random.default_rng(0)
+    for person in range(n_persons):
+        epoch = (1_213_340_000 + np.arange(n_days)[:, None] * 86400 + np.arange(ROWS_PER_DAY)).ravel()
+        steps = rng.normal(0, 1e-5, (len(epoch), 2)).cumsum(axis=0)
+        store.append(person, {'lat': 39.9 + steps[:, 0], 'long': 116.3 + steps[:, 1],
+                              'altitude': np.zeros(len(epoch)), 'cst_epoch': epoch})
+    return store
+
+
+def peak_rss(store_root, out_dir):
+    """Peak RSS in MB of OutOfCore.run over a store, in a fresh process"""
+    result = subprocess.run([sys.executable, '-c', RUN, store_root, out_dir, json.dumps(PARAMS),
+                             str(MEMORY_BUDGET_MB)],
+                            cwd=APP_DIR, capture_output=True, text=True, check=True)
+    own, _ = json.loads(result.stdout.strip().splitlines()[-1])
+    return own
+
+
+def test_peak_rss_is_bounded_and_independent_of_corpus_size(tmp_path):
+    small = make_store(str(tmp_path / 'small'), n_persons=1, n_days=5)
+    large = make_store(str(tmp_path / 'large'), n_persons=3, n_days=10)
+
+    small_rss = peak_rss(small.root, str(tmp_path / 'small_out'))
+    large_rss = peak_rss(large.root, str(tmp_path / 'large_out'))
+
+    assert small_rss < MAX_RSS_MB
+    assert large_rss < MAX_RSS_MB
+    # Six times the rows, with about the same memory
+    assert large_rss < small_rss * 1.2
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from scripts.Prefilter import prefilter
+
+# 1 Hz walk heading east at 1.4 m/s, near Beijing
+N_POINTS = 30
+SPEED = 1.4
+LAT0, LONG0 = 39.9, 116.3
+M_PER_DEG_LAT = 111_195.0
+M_PER_DEG_LONG = M_PER_DEG_LAT * np.cos(np.radians(LAT0))
+
+
+def walk(east_m, north_m):
+    return pd.DataFrame({
+        'lat': LAT0 + np.asarray(north_m) / M_PER_DEG_LAT,
+        'long': LONG0 + np.asarray(east_m) / M_PER_DEG_LONG,
+        'cst_epoch': 1_213_340_000 + np.arange(N_POINTS),
+    })
+
+
+def test_relocation_is_not_flagged():
+    # A single 12 m step into point 10, and walking on from there
+    east_m = SPEED * np.arange(N_POINTS)
+    east_m[10:] += 12
+    flagged = prefilter(walk(east_m, np.zeros(N_POINTS)), drop=False)['outlier']
+    assert not flagged.any()
+
+
+def test_single_fix_spike_is_flagged():
+    # Point 10 alone is 12 m off the path
+    north_m = np.zeros(N_POINTS)
+    north_m[10] = 12
+    flagged = prefilter(walk(SPEED * np.arange(N_POINTS), north_m), drop=False)['outlier']
+    assert np.flatnonzero(flagged).tolist() == [10]
@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 import requests
+import shapely
 from shapely.geometry import shape, LineString
 import geopandas as gpd
 import json
@@ -33,6 +35,28 @@ class RoadSnap:
                 raise Exception(f"Request failed with status {response.status_code}: {response.text}")
         return responses
 
+    @staticmethod
+    def _flat_matchings(snapped_jsons: list):
+        """
+        Flatten the matchings of all batches into one DataFrame of their attributes, and the
+        coordinates of all their geometries into one array
+        @return:
+            - matchings_df: pd.DataFrame with one row per matching, 'batch_index' first
+            - coords: np.ndarray of (long, lat) rows of all geometries, one after the other
+            - counts: np.ndarray of the number of coordinates of each matching
+        """
+        batches = []
+        for batch_index, snapped_json in enumerate(snapped_jsons):
+            batch_df = pd.json_normalize(snapped_json['matchings'])
+            batch_df.insert(0, 'batch_index', batch_index)
+            batches.append(batch_df)
+        matchings_df = pd.concat(batches)
+        coords = [np.asarray(c, dtype=np.float64).reshape(-1, 2) for c in matchings_df['geometry.coordinates']]
+        counts = np.array([len(c) for c in coords], dtype=np.int64)
+        coords = np.concatenate(coords) if coords else np.empty((0, 2))
+        matchings_df = matchings_df.drop(columns=['geometry.coordinates', 'geometry.type'])
+        return matchings_df, coords, counts
+
     @staticmethod
     def make_snapdf(snapped_jsons: list) -> pd.DataFrame:
         """
@@ -42,35 +66,18 @@ class RoadSnap:
         @return:
             - snapped_df: pd.DataFrame with 'roadsnap_long' and 'roadsnap_lat' for all snapped coordinates in all batches
         """
-
-        # Initialize list to store flattened rows
-        all_batches_rows = []
-        for batch_index, snapped_json in enumerate(snapped_jsons):
-            snapped_df = pd.json_normalize(snapped_json['matchings'])
-
-            # Flattening the DataFrame
-            batch_rows = []
-            for idx, row in snapped_df.iterrows():
-                for coord in row['geometry.coordinates']:
-                    # Create a new row for each coordinate pair, retaining the original data
-                    new_row = {
-                        'batch_index': batch_index, 
-                        'matchings_index': idx,
-                        'confidence': row['confidence'],
-                        'distance': row['distance'],
-                        'duration': row['duration'],
-                        'weight_name': row['weight_name'],
-                        'weight': row['weight'],
-                        'roadsnap_lat': coord[1],
-                        'roadsnap_long': coord[0]
-                    }
-                    batch_rows.append(new_row)
-            all_batches_rows.extend(batch_rows)
-        
-        # Convert list of dictionaries to a DataFrame
-        flatsnap_df = pd.DataFrame(all_batches_rows)
+        matchings_df, coords, counts = RoadSnap._flat_matchings(snapped_jsons)
+        # One row per coordinate pair, repeating the attributes of its matching
+        flatsnap_df = pd.DataFrame({
+            'batch_index': np.repeat(matchings_df['batch_index'].to_numpy(), counts),
+            'matchings_index': np.repeat(matchings_df.index.to_numpy(), counts),
+            **{col: np.repeat(matchings_df[col].to_numpy(), counts)
+               for col in ['confidence', 'distance', 'duration', 'weight_name', 'weight']},
+            'roadsnap_lat': coords[:, 1],
+            'roadsnap_long': coords[:, 0],
+        })
         flatsnap_gdf = gpd.GeoDataFrame(flatsnap_df, 
-                               geometry=gpd.points_from_xy(flatsnap_df.roadsnap_lat, flatsnap_df.roadsnap_lat),
+                               geometry=gpd.points_from_xy(flatsnap_df.roadsnap_long, flatsnap_df.roadsnap_lat),
                                crs="EPSG:4326")
         return flatsnap_gdf 
 
@@ -80,25 +87,11 @@ class RoadSnap:
         Make a DataFrame containing information of all 'legs' from all batches of snapped responses,
         a 'leg' being a feature of the original OSRM json grouping certain coords together
         """
-        # Initialize list to store flattened rows
-        all_batches_rows = []
-        for batch_index, snapped_json in enumerate(snapped_jsons):
-            snapped_df = pd.json_normalize(snapped_json['matchings'])
-
-            geometries = [LineString(coords) for coords in snapped_df['geometry.coordinates']]
-            geo_series = gpd.GeoSeries(geometries)
-            gdf = gpd.GeoDataFrame(
-                snapped_df.drop(columns=['geometry.coordinates', 'geometry.type']), 
-                geometry=geo_series, 
-                crs="EPSG:4326"
-            )
-            gdf['batch_index'] = batch_index
-            all_batches_rows.append(gdf)
-
-        all_legs_df = pd.concat(all_batches_rows)
-        # Reorder so batch_index is the first column
-        all_legs_df = all_legs_df[['batch_index'] + [col for col in all_legs_df.columns if col != 'batch_index']]
-        return all_legs_df
+        matchings_df, coords, counts = RoadSnap._flat_matchings(snapped_jsons)
+        # All LineStrings at once, from the flat coordinates and the matching each belongs to
+        geometries = shapely.linestrings(coords, indices=np.repeat(np.arange(len(counts)), counts))
+        return gpd.GeoDataFrame(matchings_df, geometry=gpd.GeoSeries(geometries, index=matchings_df.index),
+                                crs="EPSG:4326")
 
     @staticmethod
     def make_tracedf(snapped_jsons: list) -> pd.DataFrame:
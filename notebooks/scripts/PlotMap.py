@@ -1,6 +1,6 @@
 import folium
 from folium import FeatureGroup
-from folium.plugins import MousePosition
+from folium.plugins import HeatMap, HeatMapWithTime, MousePosition
 from shapely.geometry import LineString
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
@@ -297,4 +297,46 @@ class PlotMap:
                 tooltip=tooltip, 
                 popup=tooltip,
                 name=name
-            ).add_to(self.folium_map)
\ No newline at end of file
+            ).add_to(self.folium_map)
+
+    def _heat_points(self, pyramid, zoom, bbox, bucket=None):
+        """[lat, long, weight] of the pyramid cells, with weights scaled to [0, 1] (see HeatmapPyramid.scale)"""
+        lat, long, count = pyramid.query(zoom, bbox, bucket)
+        weight = (count / pyramid.scale(zoom)).clip(0, 1)
+        return [[la, lo, w] for la, lo, w in zip(lat.tolist(), long.tolist(), weight.tolist())]
+
+    def heatmap(self, pyramid, zoom=14, bbox=None, bucket=None, name='Heatmap: all persons'):
+        """
+        Add the point density of the whole corpus from a precomputed pyramid, instead of
+        every raw point (see flask-app/scripts/Heatmap.py)
+        @param:
+            - pyramid: HeatmapPyramid (HeatmapPyramid.load(path))
+            - zoom: zoom level of the cells to draw
+            - bbox: (min_long, min_lat, max_long, max_lat), defaults to the bounds of person_df
+            - bucket: optional time bucket to draw, e.g. the hour of the day
+        """
+        if bbox is None:
+            bbox = (self.person_df['long'].min(), self.person_df['lat'].min(),
+                    self.person_df['long'].max(), self.person_df['lat'].max())
+        fg = FeatureGroup(name=name)
+        HeatMap(data=self._heat_points(pyramid, zoom, bbox, bucket), radius=12, blur=15,
+                min_opacity=0.2).add_to(fg)
+        fg.add_to(self.folium_map)
+
+    def heatmap_with_time(self, pyramid, zoom=14, bbox=None):
+        """
+        Animate the density of every time bucket of a pyramid built with a time_bucket
+        (e.g. hour of the day), one frame per bucket
+        """
+        if not pyramid.options['time_bucket']:
+            raise ValueError("The pyramid has no time buckets, build it with a time_bucket")
+        if bbox is None:
+            bbox = (self.person_df['long'].min(), self.person_df['lat'].min(),
+                    self.person_df['long'].max(), self.person_df['lat'].max())
+        n_buckets = {'hour': 24, 'weekday': 7, 'month': 12}[pyramid.options['time_bucket']]
+        HeatMapWithTime(
+            data=[self._heat_points(pyramid, zoom, bbox, bucket) for bucket in range(n_buckets)],
+            index=[f"{pyramid.options['time_bucket']} {bucket}" for bucket in range(n_buckets)],
+            radius=12,
+            display_index=True
+        ).add_to(self.folium_map)